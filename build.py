@@ -22,10 +22,16 @@ default_task = ['clean', 'analyze', 'package']
 @init
 def set_properties(project):
     project.depends_on('boto')
-    project.depends_on('gnupg')
     project.depends_on('docopt')
     project.depends_on('yamlreader')
-    project.depends_on('paramiko')
+    # The pipelined sftp deletes use internals of paramiko's SFTPClient
+    # (_async_request, _finish_responses, _convert_status, _adjust_cwd),
+    # so only the tested releases are allowed
+    project.depends_on('paramiko', '>=2.4,<6')
+    # encryption: aes-gcm and the compression types zstd and lz4
+    project.depends_on('cryptography')
+    project.depends_on('zstandard')
+    project.depends_on('lz4')
     project.build_depends_on('mock')
     project.build_depends_on('moto')
     project.build_depends_on('unittest2')
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare the copy methods of the file target on large files.
+
+Usage:
+  filecopy_benchmark.py [options]
+
+Options:
+  -h --help               Show this
+  -s --size SIZE          Size of the test file. [default: 2GB]
+  --source-dir DIR        Directory of the test file. [default: /var/tmp]
+  --target-dir DIR        Directory of the copies. [default: /var/tmp]
+  --no-fsync              Do not fsync the copies
+  -r --repeat N           Copy N times per method, the best run counts.
+                          [default: 3]
+
+Put source and target directory on the same filesystem to measure reflinks
+and hardlinks, use a copy on write filesystem (btrfs, xfs) for reflinks.
+"""
+
+import os
+import time
+import tempfile
+
+from docopt import docopt
+from backuptool.backup import parse_size
+from backuptool.filecopy import COPY_METHODS, copy_file
+
+
+def create_test_file(directory, size):
+    """Write a file of random data with the given size"""
+    fd, path = tempfile.mkstemp(prefix='filecopy-benchmark-', dir=directory)
+    block = os.urandom(1024 * 1024)
+    with os.fdopen(fd, 'wb') as test_file:
+        written = 0
+        while written < size:
+            written += test_file.write(block[:size - written])
+        os.fsync(test_file.fileno())
+    return path
+
+
+def measure(method, source_path, target_dir, fsync, repeat):
+    """Return the best time of copying with the given method or None"""
+    target_path = '{0}/filecopy-benchmark-{1}'.format(target_dir, method)
+    timings = []
+    try:
+        for _ in range(repeat):
+            started = time.time()
+            copy_file(source_path, target_path, method, fsync=fsync)
+            timings.append(time.time() - started)
+            os.remove(target_path)
+    except OSError as error:
+        print('{0:<16}not supported ({1})'.format(method, error.strerror))
+        return None
+    finally:
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+    return min(timings)
+
+
+def main():
+    """Executed, when script is called directly"""
+    arguments = docopt(__doc__)
+    size = parse_size(arguments['--size'])
+    repeat = int(arguments['--repeat'])
+    fsync = not arguments['--no-fsync']
+    source_path = create_test_file(arguments['--source-dir'], size)
+    try:
+        for method in COPY_METHODS:
+            seconds = measure(method, source_path, arguments['--target-dir'],
+                              fsync, repeat)
+            if seconds is not None:
+                throughput = size / 1024.0 / 1024 / max(seconds, 1e-6)
+                print('{0:<16}{1:>8.3f}s {2:>10.1f}MB/s'.format(
+                    method, seconds, throughput))
+    finally:
+        os.remove(source_path)
+
+
+if __name__ == '__main__':
+    main()
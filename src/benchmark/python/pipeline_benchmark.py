@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Measure create and restore of synthetic datasets phase by phase.
+
+Usage:
+  pipeline_benchmark.py [options] [--set SETTING]... [--target URL]...
+
+Options:
+  -h --help               Show this
+  --dataset DATASET       Layout of the generated files: small (many small
+                          files), large (few huge files) or mixed.
+                          [default: mixed]
+  --data DATA             Content of the files: compressible or random.
+                          [default: compressible]
+  -s --size SIZE          Total size of the dataset. [default: 256MB]
+  --target URL            Target to measure, could be given multiple times,
+                          e.g. ftp://localhost:2121 for a local stand-in.
+                          Without it a file:// target in the base directory
+                          is used.
+  --target-config FILE    Yaml file with the settings of the targets
+                          (credentials, s3_endpoint_url, ...).
+  --set SETTING           Backup setting as KEY=VALUE (yaml value), e.g.
+                          stream=True or compression=zstd, could be given
+                          multiple times.
+  --base-dir DIR          Directory of the dataset and the file target.
+                          [default: /var/tmp]
+  --no-restore            Only measure create
+  -r --repeat N           Run N times per target, the best run counts.
+                          [default: 1]
+
+Restores write the files back into the generated dataset, so nothing
+outside of the base directory is touched. Local stand-ins for the remote
+targets are e.g. pyftpdlib (ftp), a local sshd (sftp) and minio or the
+moto server (s3).
+"""
+
+import os
+import json
+import yaml
+import shutil
+import getpass
+import tempfile
+
+from docopt import docopt
+from backuptool.backup import parse_size
+from backuptool.targets import open_backup
+
+
+# (number of files, share of the total size) per layout
+DATASETS = {
+    'small': [(None, 1.0)],
+    'large': [(4, 1.0)],
+    'mixed': [(None, 0.2), (4, 0.8)]
+}
+SMALL_FILE_SIZE = 4096
+FILES_PER_DIRECTORY = 1000
+
+# Maps every byte to a letter, more frequent letters get more bytes
+TEXT_LETTERS = (b'          eeeeeeeeeeeeetttttttttaaaaaaaaooooooooiiiiiii'
+                b'nnnnnnnsssssshhhhhhrrrrrrddddlllluuucccmmmwwffggyyppbb'
+                b'vk\n')
+TEXT_TABLE = (TEXT_LETTERS * (256 // len(TEXT_LETTERS) + 1))[:256]
+
+
+def file_data(size, data_type):
+    """Return size bytes of compressible or random data
+
+    Compressible data are random letters with the frequencies of english
+    text, which gzip shrinks to roughly half of its size.
+    """
+    data = os.urandom(size)
+    if data_type == 'random':
+        return data
+    return data.translate(TEXT_TABLE)
+
+
+def create_dataset(directory, layout, data_type, size):
+    """Write the synthetic file tree and return the number of files"""
+    count = 0
+    for number, share in DATASETS[layout]:
+        part_size = int(size * share)
+        if number is None:
+            number = max(part_size // SMALL_FILE_SIZE, 1)
+        file_size = part_size // number
+        block_size = min(file_size, 1024 * 1024)
+        for _ in range(number):
+            subdirectory = '{0}/dir_{1}'.format(
+                directory, count // FILES_PER_DIRECTORY)
+            if not os.path.isdir(subdirectory):
+                os.makedirs(subdirectory)
+            path = '{0}/file_{1}'.format(subdirectory, count)
+            with open(path, 'wb') as dataset_file:
+                written = 0
+                while written < file_size:
+                    # Fresh blocks, so repetitions do not help compressors
+                    block = file_data(block_size, data_type)
+                    written += dataset_file.write(
+                        block[:file_size - written])
+            count += 1
+    return count
+
+
+def run(operation, target, config, base_dir):
+    """Run create or restore once and return its phase records"""
+    metrics_path = '{0}/metrics.json'.format(base_dir)
+    config = dict(config, metrics_file=metrics_path)
+    workdir = tempfile.mkdtemp(prefix='benchmark-workdir-', dir=base_dir)
+    try:
+        backup = open_backup('benchmark', config, workdir)
+        getattr(backup, operation)()
+    finally:
+        shutil.rmtree(workdir)
+    with open(metrics_path) as metrics_file:
+        records = [json.loads(line) for line in metrics_file]
+    os.remove(metrics_path)
+    return records
+
+
+def best_run(operation, target, config, base_dir, repeat):
+    """Return the phase records of the fastest of repeat runs"""
+    runs = [run(operation, target, config, base_dir) for _ in range(repeat)]
+    return min(runs, key=lambda records: sum(record['wall_seconds']
+                                             for record in records))
+
+
+def print_records(operation, target, records):
+    """Print the time and throughput of every phase"""
+    print('{0} {1}'.format(operation, target))
+    for record in records:
+        moved = max(record['bytes_in'], record['bytes_out'])
+        throughput = moved / 1024.0 / 1024 / max(record['wall_seconds'],
+                                                 1e-6)
+        ratio = ''
+        if record['compression_ratio'] is not None:
+            ratio = '{0:.2f}x'.format(record['compression_ratio'])
+        print('  {0:<18}{1:>8.3f}s {2:>8.3f}s cpu {3:>10.1f}MB/s '
+              '{4:>8} {5:>8.0f}MB rss'.format(
+                  record['phase'], record['wall_seconds'],
+                  record['cpu_seconds'], throughput, ratio,
+                  record['peak_rss_bytes'] / 1024.0 / 1024))
+    total = sum(record['wall_seconds'] for record in records)
+    print('  {0:<18}{1:>8.3f}s'.format('total', total))
+
+
+def parse_settings(settings):
+    """Return the KEY=VALUE settings as dict with yaml values"""
+    config = {}
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        config[key] = yaml.safe_load(value)
+    return config
+
+
+def main():
+    """Executed, when script is called directly"""
+    arguments = docopt(__doc__)
+    size = parse_size(arguments['--size'])
+    repeat = int(arguments['--repeat'])
+    base_dir = tempfile.mkdtemp(prefix='pipeline-benchmark-',
+                                dir=arguments['--base-dir'])
+    try:
+        source_dir = '{0}/source'.format(base_dir)
+        count = create_dataset(source_dir, arguments['--dataset'],
+                               arguments['--data'], size)
+        print('Dataset: {0} files, {1:.1f}MB {2}'.format(
+            count, size / 1024.0 / 1024, arguments['--data']))
+        targets = arguments['--target']
+        if not targets:
+            os.makedirs('{0}/target'.format(base_dir))
+            targets = ['file://{0}/target'.format(base_dir)]
+        config = {}
+        if arguments['--target-config']:
+            with open(arguments['--target-config']) as config_file:
+                config.update(yaml.safe_load(config_file) or {})
+        config.update(parse_settings(arguments['--set']))
+        config.update({
+            'user': getpass.getuser(),
+            'files': [source_dir],
+            'rotate': 1,
+            'state_dir': '{0}/state'.format(base_dir),
+            'listing_cache_ttl': 0
+        })
+        for target in targets:
+            target_config = dict(config, target=target)
+            records = best_run('create', target, target_config, base_dir,
+                               repeat)
+            print_records('create', target, records)
+            if not arguments['--no-restore']:
+                records = best_run('restore', target, target_config,
+                                   base_dir, repeat)
+                print_records('restore', target, records)
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from .backup import CallingUserError
-from .backup import DecryptionError
+from .encryption import DecryptionError
+from .encryption import EncryptionError
+from .stream import StreamError
+from .compression import CompressionError
+from .snapshot import SnapshotError
+from .archiveindex import ArchiveIndexError
+from .targets import TargetError
 
 from .bashcolor import BashColor
 
@@ -9,5 +15,11 @@ from .bashcolor import BashColor
 __all__ = [
     'CallingUserError',
     'DecryptionError',
+    'EncryptionError',
+    'StreamError',
+    'CompressionError',
+    'SnapshotError',
+    'ArchiveIndexError',
+    'TargetError',
     'BashColor'
 ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from functools import partial
+
+from .targets import open_backup
+
+
+class AsyncBackup(object):
+    """Asyncio interface of a backup and all of its targets
+
+    The target classes do blocking network I/O, so every call runs in the
+    given thread pool (the default executor of the loop without one). The
+    event loop drives the calls of many backups at once, so their round
+    trips overlap instead of adding up. The targets of a backup are
+    fetched concurrently, too. Only the network bound commands (list,
+    rotate and delete) use it, create and restore run in processes.
+    """
+
+    def __init__(self, backup, executor=None):
+        self.backup = backup
+        self.executor = executor
+
+    @classmethod
+    async def open(cls, name, config, workdir, executor=None):
+        """Open the targets of the given backup (see open_backup())"""
+        loop = asyncio.get_running_loop()
+        backup = await loop.run_in_executor(
+            executor, open_backup, name, config, workdir)
+        return cls(backup, executor)
+
+    def _run(self, function, *args):
+        """Return a future of function(*args) running in the executor
+
+        Only to be called from a coroutine on the running loop.
+        """
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(function, *args))
+
+    async def fetch_listings(self):
+        """Fetch the listings of all targets concurrently"""
+        await asyncio.gather(*[self._run(target.backups)
+                               for target in self.backup.healthy_targets()])
+
+    async def list(self):
+        """List the backups of every target"""
+        await self.fetch_listings()
+        self.backup.list_targets()
+
+    async def rotate(self):
+        """Rotate the backups of every target"""
+        await self._run(self.backup.rotate)
+
+    async def plan_rotation(self):
+        """Return what rotate() would delete (see Backup.plan_rotation())"""
+        return await self._run(self.backup.plan_rotation)
+
+    async def delete(self, name):
+        """Delete the given backup on every target"""
+        await self._run(self.backup.delete_backup, name)
+
+    async def close(self):
+        """Release the connections of all targets"""
+        await self._run(self.backup.close)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import json
+import bisect
+import fnmatch
+
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index'
+
+
+class ArchiveIndexError(Exception):
+    """Exception class for throwing ArchiveIndexError exceptions"""
+    pass
+
+
+def index_name(name):
+    """Return the name of the index of the given archive"""
+    return '{0}{1}'.format(name, INDEX_SUFFIX)
+
+
+def path_matches(path, pattern):
+    """Check if the path matches the glob pattern
+
+    A pattern matching a directory matches everything below it, too.
+    """
+    return (fnmatch.fnmatch(path, pattern) or
+            fnmatch.fnmatch(path, '{0}/*'.format(pattern.rstrip('/'))))
+
+
+class ArchiveIndex(object):
+    """Index of the members of an archive file
+
+    For every member the original path, the offset and the length of its
+    tar entry in the uncompressed archive, the file size and the sha256 sum
+    of regular files are recorded. The blocks map the uncompressed offsets
+    at which the decompression could start to the offsets in the compressed
+    archive (None for uncompressed archives, where every offset works). With
+    both a single member could be read from the archive file with a ranged
+    read of the blocks around it.
+    """
+
+    def __init__(self, compression='none', blocks=None, members=None):
+        self.compression = compression
+        self.blocks = blocks
+        self.members = members or []
+
+    def add(self, path, offset, length, size, digest):
+        """Record a member of the archive"""
+        self.members.append({
+            'path': path,
+            'offset': offset,
+            'length': length,
+            'size': size,
+            'sha256': digest
+        })
+
+    def dumps(self):
+        """Return the index as json encoded bytes"""
+        return json.dumps({
+            'version': INDEX_VERSION,
+            'compression': self.compression,
+            'blocks': self.blocks,
+            'members': self.members
+        }).encode('utf-8')
+
+    @classmethod
+    def loads(cls, data):
+        """Return the index of the given json encoded bytes"""
+        try:
+            index = json.loads(data.decode('utf-8'))
+        except ValueError as error:
+            raise ArchiveIndexError('Invalid archive index: {0}'.format(error))
+        if index.get('version') != INDEX_VERSION:
+            raise ArchiveIndexError('Unsupported archive index version')
+        return cls(index['compression'], index['blocks'], index['members'])
+
+    def find(self, pattern):
+        """Return the members matching the glob pattern"""
+        return [member for member in self.members
+                if path_matches(member['path'], pattern)]
+
+    def block_range(self, offset, end):
+        """Return the block range which contains the given archive range
+
+        The result is the uncompressed and the compressed offset of the
+        first block and the compressed end offset (None for the end of the
+        archive).
+        """
+        if self.blocks is None:
+            return offset, offset, end
+        starts = [block[0] for block in self.blocks]
+        first = bisect.bisect_right(starts, offset) - 1
+        last = bisect.bisect_left(starts, end)
+        compressed_end = None
+        if last < len(self.blocks):
+            compressed_end = self.blocks[last][1]
+        return self.blocks[first][0], self.blocks[first][1], compressed_end
+
+    def ranges(self, members):
+        """Group the members into ranges which are read at once
+
+        Yields (uncompressed offset, compressed offset, compressed end,
+        members) with the members sorted by their offset. Members in the
+        same or in neighbouring blocks share a range.
+        """
+        current = None
+        for member in sorted(members, key=lambda member: member['offset']):
+            start, compressed_start, compressed_end = self.block_range(
+                member['offset'], member['offset'] + member['length'])
+            if current is not None and (current[2] is None or
+                                        compressed_start <= current[2]):
+                if current[2] is not None and (compressed_end is None or
+                                               current[2] < compressed_end):
+                    current[2] = compressed_end
+                current[3].append(member)
+                continue
+            if current is not None:
+                yield tuple(current)
+            current = [start, compressed_start, compressed_end, [member]]
+        if current is not None:
+            yield tuple(current)
+
+
+class RangeReader(object):
+    """Readable file object of a range of a remote file
+
+    read is a function returning length bytes from offset on (like
+    Backup.read_range()), the range is read piece by piece, so it never has
+    to fit into memory.
+    """
+
+    def __init__(self, read, start, end, piece_size):
+        self.read_piece = read
+        self.position = start
+        self.end = end
+        self.piece_size = piece_size
+        self.buffer = b''
+        self.buffer_position = 0
+
+    def read(self, size=-1):
+        """Return up to size bytes, all remaining bytes for size < 0"""
+        if size < 0:
+            return b''.join(iter(lambda: self.read(self.piece_size), b''))
+        buffered = len(self.buffer) - self.buffer_position
+        if buffered == 0 and self.position < self.end:
+            length = min(max(size, self.piece_size),
+                         self.end - self.position)
+            self.buffer = self.read_piece(self.position, length)
+            self.buffer_position = 0
+            self.position += len(self.buffer)
+            buffered = len(self.buffer)
+        size = min(size, buffered)
+        data = self.buffer[self.buffer_position:self.buffer_position + size]
+        self.buffer_position += size
+        return data
+
+
+class LimitedReader(object):
+    """Readable file object returning at most length bytes of fileobj"""
+
+    def __init__(self, fileobj, length):
+        self.fileobj = fileobj
+        self.remaining = length
+
+    def read(self, size=-1):
+        """Return up to size bytes of the remaining bytes"""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def skip(self):
+        """Read and drop the remaining bytes"""
+        while self.read(1024 * 1024):
+            pass
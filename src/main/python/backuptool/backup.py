@@ -1,18 +1,58 @@
 # -*- coding: utf-8 -*-
 
+import io
 import os
+import re
+import json
 import time
-import gnupg
 import errno
+import stat
 import shutil
 import getpass
+import hashlib
 import tarfile
 import subprocess
 
 from glob import glob
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 from datetime import datetime
-from contextlib import closing
+from contextlib import closing, contextmanager
+
+from .stream import ArchiveStream, StreamError, tee
+from .targets import TargetError, state_name
+from .exclude import ExcludeMatcher
+from .listing import SHARED_LISTINGS, ListingCache
+from .metrics import Metrics
+from .snapshot import open_snapshot
+from .transfer import ChecksumFile, TransferJournal, file_checksum
+from .chunkstore import ChunkStore
+from .throttle import Priority, RateLimit, open_throttle
+from .archiveindex import (
+    ArchiveIndex,
+    ArchiveIndexError,
+    LimitedReader,
+    RangeReader,
+    index_name,
+    path_matches
+)
+from .encryption import (
+    EXTENSIONS as ENCRYPTION_EXTENSIONS,
+    AESGCMCipher,
+    encryption_by_name,
+    open_cipher,
+    strip_extension
+)
+from .incremental import FileIndex, HashingReader
+from .compression import (
+    EXTENSIONS,
+    check_compression,
+    compression_by_name,
+    file_extension,
+    open_reader,
+    open_writer,
+    split_extension
+)
 
 
 class CallingUserError(Exception):
@@ -20,9 +60,52 @@ class CallingUserError(Exception):
     pass
 
 
-class DecryptionError(Exception):
-    """Exception class for throwing DecryptionError exceptions"""
-    pass
+def default_state_dir():
+    """Return the default state directory of the calling user
+
+    root keeps the state in /var/lib/backuptool, other users below their
+    XDG state directory.
+    """
+    if os.geteuid() == 0:
+        return '/var/lib/backuptool'
+    state_home = (os.environ.get('XDG_STATE_HOME') or
+                  os.path.expanduser('~/.local/state'))
+    return os.path.join(state_home, 'backuptool')
+
+
+def parse_size(value):
+    """Return the number of bytes of a size like 1024, '64KB' or '8MB'"""
+    if isinstance(value, int):
+        return value
+    units = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*$',
+                     str(value).upper())
+    if not match:
+        raise ValueError('Invalid size: {0}'.format(value))
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
+def parse_rate_limit(value):
+    """Return the RateLimit of a value like '10MB' or '08:00-18:00=1MB'
+
+    The rate is a size per second. Comma separated time windows with their
+    own rate could follow the default rate or replace it, then there is no
+    limit outside of the windows. A rate of 0 means unlimited.
+    """
+    if value is None:
+        return None
+    rate = None
+    windows = []
+    for part in str(value).split(','):
+        times, _, window_rate = part.rpartition('=')
+        if not times:
+            rate = parse_size(window_rate)
+            continue
+        start, _, end = times.partition('-')
+        if not end:
+            raise ValueError('Invalid time window: {0}'.format(times))
+        windows.append((start, end, parse_size(window_rate)))
+    return RateLimit(rate, windows)
 
 
 class Backup(object):
@@ -39,28 +122,86 @@ class Backup(object):
         self.filename_abs = None
         self.mysql_databases = None
         self.filename_prefix = 'backup-{0}'.format(self.name)
+        self.backup_pattern = re.compile(
+            r'^{0}-(\d+)(?:\.inc)?\.(?:tar(?:\.gz|\.zst|\.lz4)?|manifest)'
+            r'(?:\.gpg|\.aes)?$'.format(re.escape(self.filename_prefix)))
         self.rotation_num = self.config.get('rotate', 3)
         self.encrypt = self.config.get('encrypt', False)
+        self.stream = self.config.get('stream', False)
+        self.dedup = self.config.get('dedup', False)
+        self.incremental = self.config.get('incremental', False)
+        self.full_every = self.config.get('full_every', 7)
+        self.state_dir = self.config.get('state_dir') or default_state_dir()
+        self.transfer_chunk_size = parse_size(
+            self.config.get('transfer_chunk_size', '8MB'))
+        self.read_throttle = self.open_throttle('read')
+        self.upload_throttle = self.open_throttle('upload')
+        self.priority = Priority(self.config.get('nice'),
+                                 self.config.get('ionice'))
+        self.target = self.config.get('target')
+        self.state_name = state_name(self.name, self.config)
+        # All targets of the backup, the first one builds the archives
+        self.targets = [self]
+        self.target_failures = []
+        self.target_retries = self.config.get('target_retries', 0)
+        self.target_retry_delay = self.config.get('target_retry_delay', 30)
+        self.existing_backups = None
+        self.listing_cache = ListingCache(
+            '{0}/{1}.listing'.format(self.state_dir, self.state_name),
+            self.config.get('target'),
+            self.config.get('listing_cache_ttl', 300))
+        self.compression = self.config.get('compression', 'gzip')
+        self.compression_level = self.config.get('compression_level')
+        self.compression_threads = self.config.get('compression_threads', 0)
+        check_compression(self.compression)
+        self.index_archives = self.config.get('archive_index', True)
+        self.archive_index = None
+        self.encryption = self.config.get('encryption', 'gpg')
         if self.encrypt:
-            self.gpg = gnupg.GPG()
-            self.gpg_key_id = self.config['gpg_key_id']
+            # Fail early on unusable encryption settings
+            open_cipher(self.encryption, self.config)
         if 'files' in self.config:
             self.files = self.config['files']
+        max_file_size = self.config.get('max_file_size')
+        if max_file_size is not None:
+            max_file_size = parse_size(max_file_size)
+        self.matcher = ExcludeMatcher(
+            self.config.get('exclude'), max_file_size,
+            self.config.get('skip_special_files', False))
+        self.snapshot_config = self.config.get('snapshot')
+        self.snapshot = None
         if 'mysql_databases' in self.config:
             self.mysql_databases = self.config['mysql_databases']
             self.mysql_user = self.config['mysql_user']
             self.mysql_password = self.config['mysql_password']
+        self.mysql_dump_jobs = self.config.get('mysql_dump_jobs', 1)
+        self.mysql_dump_options = []
+        if self.config.get('mysql_single_transaction'):
+            self.mysql_dump_options.append('--single-transaction')
+        if self.config.get('mysql_quick'):
+            self.mysql_dump_options.append('--quick')
+        self.mysql_restore_jobs = self.config.get('mysql_restore_jobs', 1)
+        self.mysql_import_options = []
+        if self.config.get('mysql_disable_checks'):
+            self.mysql_import_options.append(
+                '--init-command=SET SESSION FOREIGN_KEY_CHECKS=0, '
+                'SESSION UNIQUE_CHECKS=0')
+        self.dump_stats = {}
         self.ldap_backup = self.config.get('ldap_backup')
         if self.ldap_backup:
-            self.ldap_datadir = self.ldap_backup.get('datadir', '/var/lib/ldap')
+            self.ldap_datadir = self.ldap_backup.get('datadir',
+                                                     '/var/lib/ldap')
             self.ldap_system_user = self.ldap_backup.get('system_user',
                                                          'openldap')
             self.ldap_system_group = self.ldap_backup.get('system_group',
                                                           'openldap')
+        self.metrics = Metrics(self.name,
+                               self.config.get('metrics_file'),
+                               self.config.get('metrics_textfile_dir'))
         self.devnull = open(os.devnull, 'w')
 
     def _needs_configured_user(original_function):
-        """Decorator method to ensure that current user is the configured one"""
+        """Decorator method to ensure the current user is the configured one"""
         @wraps(original_function)
         def new_function(self, *args, **kwargs):
             if getpass.getuser() != self.user:
@@ -69,6 +210,53 @@ class Backup(object):
             return original_function(self, *args, **kwargs)
         return new_function
 
+    def _instrumented(operation):
+        """Decorator method to write the phase metrics of an operation"""
+        def decorator(original_function):
+            @wraps(original_function)
+            def new_function(self, *args, **kwargs):
+                self.metrics.start(operation)
+                succeeded = False
+                try:
+                    result = original_function(self, *args, **kwargs)
+                    succeeded = True
+                    return result
+                finally:
+                    self.metrics.write(succeeded)
+            return new_function
+        return decorator
+
+    def _measured(phase):
+        """Decorator method to record the metrics of a phase"""
+        def decorator(original_function):
+            @wraps(original_function)
+            def new_function(self, *args, **kwargs):
+                with self.metrics.phase(phase):
+                    return original_function(self, *args, **kwargs)
+            return new_function
+        return decorator
+
+    def print_listing(self, target_type):
+        """Print all existing backups as a tree"""
+        print('{0} ({1}):'.format(self.name, target_type))
+        entries = self.backups()
+        if not entries:
+            print('  <no backups>\n')
+            return
+        for entry, more_items in self._lookahead(entries):
+            size = '{0:.2f}MB'.format(float(entry['size'] or 0) / 1024 / 1024)
+            date = ''
+            if entry['mtime'] is not None:
+                date = datetime.fromtimestamp(entry['mtime']).strftime(
+                    '%Y-%m-%dT%H:%M:%S')
+            if more_items:
+                tree_prefix = '├─ '
+            else:
+                tree_prefix = '└─ '
+            print('{0}{1:<53}{2:<10}{3}'.format(tree_prefix, entry['name'],
+                                                size, date))
+        print('')
+
     @staticmethod
     def _lookahead(iterable):
         """Indicator for the last element in a iterable
@@ -84,14 +272,579 @@ class Backup(object):
             last = value
         yield last, False
 
+    @_measured('download')
     def download(self):
-        """Dummy method, will be overwritten by child classes"""
-        raise NotImplementedError  # pragma: no cover
+        """Download the newest backup into the working directory"""
+        newest_backup = self.newest_backup()
+        if not newest_backup:
+            return False
+        file_target = '{0}/{1}'.format(self.workdir, newest_backup)
+        self.download_file(newest_backup, file_target)
+        self.metrics.count(bytes_in=os.path.getsize(file_target))
+        self.check_encryption_by_name(newest_backup)
+        return True
 
+    @_measured('upload')
     def upload(self):
+        """Upload the composed (and encrypted) backup file to all targets"""
+        filename = self.encrypted_name(self.filename)
+        filename_abs = self.encrypted_name(self.filename_abs)
+        index = self.archive_index
+
+        def upload_to(target):
+            target.upload_file(filename_abs, filename)
+            target.upload_index(filename, index)
+        self.for_each_target(upload_to, self.target_retries)
+        self.metrics.count(bytes_out=os.path.getsize(filename_abs))
+
+    def upload_index(self, name, index):
+        """Upload the member index of the given archive, if there is one
+
+        The index is encrypted like the archive, its name is the name of
+        the archive plus '.index'.
+        """
+        if index is None:
+            return
+        data = index.dumps()
+        if self.encrypt:
+            data = open_cipher(self.encryption, self.config).encrypt(data)
+        self.upload_fileobj(io.BytesIO(data), index_name(name))
+
+    def load_index(self, name):
+        """Return the member index of the given archive or None"""
+        if self.remote_size(index_name(name)) is None:
+            return None
+        fileobj = io.BytesIO()
+        self.download_fileobj(index_name(name), fileobj)
+        data = fileobj.getvalue()
+        encryption = encryption_by_name(name)
+        if encryption is not None:
+            data = open_cipher(encryption, self.config).decrypt(data)
+        return ArchiveIndex.loads(data)
+
+    def open_throttle(self, kind):
+        """Return the throttle of the configured <kind>_limit
+
+        Targets with the same limit share it, so the limit applies to the
+        sum of their transfers.
+        """
+        limit = self.config.get('{0}_limit'.format(kind))
+        return open_throttle(kind, self.name, parse_rate_limit(limit),
+                             str(limit))
+
+    def start_process(self, cmd, **kwargs):
+        """Start a dump command with the configured priority"""
+        process = subprocess.Popen(cmd, **kwargs)
+        try:
+            self.priority.apply(process.pid)
+        except Exception:
+            # Nobody would wait for the process else
+            process.kill()
+            process.wait()
+            raise
+        return process
+
+    def disconnect(self):
+        """Release the connection to the target, if there is one"""
+        pass
+
+    def close(self):
+        """Release the connections of all targets"""
+        for target in self.targets:
+            target.disconnect()
+
+    def healthy_targets(self):
+        """Return the targets which did not fail in this run"""
+        failed = [target for target, _ in self.target_failures]
+        return [target for target in self.targets
+                if target.target not in failed]
+
+    def target_failed(self, target, error):
+        """Report and record the failure of a single target"""
+        print('Target {0} of {1} failed: {2}'.format(target.target,
+                                                     self.name, error))
+        self.target_failures.append((target.target, error))
+
+    def check_targets(self):
+        """Raise a TargetError, if a target failed in this run"""
+        if not self.target_failures:
+            return
+        failed = [target for target, _ in self.target_failures]
+        # Targets which could not be opened are not in targets
+        opened = [target.target for target in self.targets]
+        total = len(opened) + len([target for target in failed
+                                   if target not in opened])
+        raise TargetError('{0} of {1} targets failed: {2}'.format(
+            len(failed), total, ', '.join(str(target) for target in failed)))
+
+    def retried(self, function, target, retries):
+        """Call function(target), retry it up to retries times on errors"""
+        for attempt in range(retries + 1):
+            try:
+                return function(target)
+            except Exception as error:
+                if attempt == retries:
+                    raise
+                print('Retrying on target {0} of {1} after error: {2}'.format(
+                    target.target, self.name, error))
+                time.sleep(self.target_retry_delay)
+
+    def for_each_target(self, function, retries=0):
+        """Call function(target) for all healthy targets concurrently
+
+        A failing target does not stop the others, it is reported and left
+        out for the rest of the run. With a single target errors are raised
+        as they are.
+        """
+        if len(self.targets) == 1:
+            self.retried(function, self, retries)
+            return
+        targets = self.healthy_targets()
+        with ThreadPoolExecutor(max_workers=len(targets) or 1) as pool:
+            futures = [pool.submit(self.retried, function, target, retries)
+                       for target in targets]
+        for target, future in zip(targets, futures):
+            if future.exception() is not None:
+                self.target_failed(target, future.exception())
+        if not self.healthy_targets():
+            self.check_targets()
+
+    def tee_to_targets(self, stream, consume):
+        """Call consume(target, fileobj) with the stream for all targets
+
+        The stream is read once and handed over to all healthy targets
+        concurrently. A stream could not be read again, so there are no
+        retries.
+        """
+        if len(self.targets) == 1:
+            consume(self, stream)
+            return
+        targets = self.healthy_targets()
+        errors = tee(stream, [partial(consume, target) for target in targets],
+                     self.transfer_chunk_size)
+        for target, error in zip(targets, errors):
+            if error is not None:
+                self.target_failed(target, error)
+        if not self.healthy_targets():
+            self.check_targets()
+
+    def upload_stream(self, stream, name):
+        """Upload the archive stream under the given name to all targets
+
+        If the archive could not be produced, the upload fails and a
+        partially written file is removed from the targets, so it never
+        counts as a backup.
+        """
+        try:
+            self.tee_to_targets(
+                stream, lambda target, fileobj: target.upload_fileobj(
+                    fileobj, name))
+        except StreamError:
+            for target in self.healthy_targets():
+                try:
+                    target.delete_names([name], ignore_missing=True)
+                except Exception as error:
+                    print('Unable to remove the partial upload {0} from '
+                          '{1}: {2}'.format(name, target.target, error))
+            raise
+
+    def upload_fileobj(self, fileobj, name, offset=0):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def download_fileobj(self, name, fileobj, offset=0):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def remote_size(self, name):
         """Will be overwritten by child class method"""
         raise NotImplementedError  # pragma: no cover
 
+    def read_range(self, name, offset, length):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def fetch_entries(self, prefix):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def listing_key(self):
+        """Return an identifier of the listed location or None
+
+        Backups with the same key share their listing during a pass of
+        SHARED_LISTINGS.
+        """
+        return None
+
+    def fetch_backups(self):
+        """Return the entries of all backups of this backup on the target
+
+        fetch_entries() returns all files starting with the given prefix.
+        In a shared pass the files of all backups at the location are
+        fetched once.
+        """
+        entries = SHARED_LISTINGS.get(self.listing_key(),
+                                      lambda: self.fetch_entries('backup-'))
+        if entries is None:
+            entries = self.fetch_entries(
+                '{0}-'.format(self.filename_prefix))
+        return [entry for entry in entries
+                if self.is_backup_name(entry['name'])]
+
+    def set_existing_backups(self):
+        """Fetch the listing of all existing backups from the target"""
+        entries = sorted(self.fetch_backups(),
+                         key=lambda entry: self.backup_time(entry['name']))
+        self.existing_backups = entries
+        self.listing_cache.save(entries)
+
+    def backups(self, refresh=False):
+        """Return the entries of all existing backups, sorted by name
+
+        An entry is a dict with name, size, mtime and etag of a backup.
+        The listing is only fetched, if it is used and not cached locally,
+        or with refresh.
+        """
+        if refresh:
+            self.set_existing_backups()
+        if self.existing_backups is None:
+            self.existing_backups = self.listing_cache.load()
+        if self.existing_backups is None:
+            self.set_existing_backups()
+        return self.existing_backups
+
+    def listing_changed(self, name, deleted=False):
+        """Keep the listing in sync with an own upload or delete"""
+        if not self.is_backup_name(name):
+            return
+        if deleted:
+            if self.existing_backups is not None:
+                self.existing_backups = [entry
+                                         for entry in self.existing_backups
+                                         if entry['name'] != name]
+            self.listing_cache.remove(name)
+        else:
+            self.existing_backups = None
+            self.listing_cache.invalidate()
+
+    def newest_backup(self):
+        """Return the name of the newest backup or None"""
+        entries = self.backups()
+        if not entries:
+            return None
+        return entries[-1]['name']
+
+    def backup_names(self, refresh=False):
+        """Return the names of all existing backups, see backups()"""
+        return [entry['name'] for entry in self.backups(refresh)]
+
+    def list_names(self, directory):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def make_directory(self, directory):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def delete(self, name):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def delete_names(self, names, ignore_missing=False):
+        """Delete the given files, skip missing ones with ignore_missing
+
+        The remote targets overwrite this to batch or pipeline the
+        deletes.
+        """
+        for name in names:
+            if ignore_missing and self.remote_size(name) is None:
+                continue
+            self.delete(name)
+
+    def is_backup_name(self, name):
+        """Check if the given name is a backup (or manifest) of this backup"""
+        return bool(self.backup_pattern.match(name))
+
+    def backup_time(self, name):
+        """Return the creation time of the given backup as sortable value"""
+        match = self.backup_pattern.match(name)
+        if not match:
+            return datetime.min, name
+        try:
+            return datetime.strptime(match.group(1), '%Y%m%d%H%M%S'), name
+        except ValueError:
+            return datetime.min, name
+
+    @staticmethod
+    def is_incremental_name(name):
+        """Check if the given name is an incremental backup"""
+        return '.inc.' in name
+
+    def expired_backups(self, names):
+        """Return the backups which exceed the configured rotation
+
+        Incremental backups do not count, they are kept as long as the full
+        backup they are based on is kept.
+        """
+        names = sorted(names, reverse=True)
+        if self.rotation_num <= 0:
+            return names
+        full_backups = 0
+        for position, name in enumerate(names):
+            if not self.is_incremental_name(name):
+                full_backups += 1
+            if full_backups == self.rotation_num:
+                return names[position + 1:]
+        return []
+
+    def rotate(self):
+        """Rotate the backups of every target independently"""
+        self.for_each_target(lambda target: target.rotate_backups(),
+                             self.target_retries)
+        self.check_targets()
+
+    def rotation_plan(self):
+        """Return the expired backups and the unused chunks of the target
+
+        For deduplicated backups the chunks which are not referenced by one
+        of the remaining manifests are unused. The plan is destructive, so
+        it is made from a fresh listing instead of the cached one, which
+        could miss new backups or still have deleted ones.
+        """
+        names = self.backup_names(refresh=True)
+        expired = self.expired_backups(names)
+        chunks = []
+        if self.dedup:
+            manifests = [name for name in names
+                         if name not in expired and '.manifest' in name]
+            chunks = ChunkStore(self).unused_chunks(manifests)
+        return expired, chunks
+
+    def rotate_backups(self):
+        """Only keep the given amount of backups and delete the rest
+
+        The backups and their indexes are deleted in one batch, the unused
+        chunks after them.
+        """
+        expired, chunks = self.rotation_plan()
+        self.delete_names(sorted(expired))
+        self.delete_names([index_name(name) for name in sorted(expired)],
+                          ignore_missing=True)
+        self.delete_names(chunks)
+
+    def plan_rotation(self):
+        """Return the (target, rotation plan) of every healthy target"""
+        plans = {}
+
+        def plan(target):
+            plans[target.target] = target.rotation_plan()
+        self.for_each_target(plan, self.target_retries)
+        return [(target, plans[target.target])
+                for target in self.healthy_targets()
+                if target.target in plans]
+
+    def print_rotation(self, plans):
+        """Print what a rotation with the given plans would delete"""
+        for target, (expired, chunks) in plans:
+            print('{0} ({1}):'.format(self.name, target.target))
+            if not expired and not chunks:
+                print('  <nothing to delete>')
+            for name in sorted(expired):
+                print('  would delete {0}'.format(name))
+            if chunks:
+                print('  would delete {0} unused chunks'.format(len(chunks)))
+        self.check_targets()
+
+    def delete_archive(self, name):
+        """Delete the given backup together with its index"""
+        self.delete(name)
+        self.delete_names([index_name(name)], ignore_missing=True)
+
+    def delete_backup(self, name):
+        """Delete the given backup on every target"""
+        self.for_each_target(lambda target: target.delete_archive(name),
+                             self.target_retries)
+        self.check_targets()
+
+    def list_targets(self):
+        """List the backups of every target"""
+        for target in self.targets:
+            target.list()
+        self.check_targets()
+
+    def transfer_journal(self):
+        """Return the journal of interrupted transfers of this backup"""
+        return TransferJournal('{0}/{1}.transfer'.format(self.state_dir,
+                                                         self.state_name))
+
+    def pending_path(self, name):
+        """Return where the local file of an interrupted transfer is kept"""
+        return '{0}/pending/{1}/{2}'.format(self.state_dir, self.state_name,
+                                            name)
+
+    def keep_pending(self, path, name, journal):
+        """Keep the local file of a failed transfer in the state directory
+
+        The working directory is removed after every run, so the file is
+        linked (or copied) out of it to be able to resume the transfer in
+        the next run. It is not moved, other targets may still read it.
+        """
+        state = journal.load()
+        pending_path = self.pending_path(name)
+        if not state or state['name'] != name or path == pending_path:
+            return
+        try:
+            self.create_directory(os.path.dirname(pending_path))
+            if os.path.lexists(pending_path):
+                os.remove(pending_path)
+            try:
+                os.link(path, pending_path)
+            except OSError:
+                shutil.copyfile(path, pending_path)
+        except (IOError, OSError):
+            return
+        state['path'] = pending_path
+        journal.save(state)
+
+    def verified_offset(self, state, fileobj, name, size):
+        """Return the offset an interrupted transfer could be resumed at
+
+        Only complete chunks of the available size count. The last of them
+        is compared with its journaled checksum, locally and on the target,
+        so a resume is only trusted if both sides still hold the same data.
+        """
+        chunk_size = state['chunk_size']
+        chunks = min(len(state['checksums']), size // chunk_size)
+        if not chunks:
+            return 0
+        offset = (chunks - 1) * chunk_size
+        expected = state['checksums'][chunks - 1]
+        if file_checksum(fileobj, offset, chunk_size) != expected:
+            return 0
+        remote_data = self.read_range(name, offset, chunk_size)
+        if hashlib.sha256(remote_data).hexdigest() != expected:
+            return 0
+        del state['checksums'][chunks:]
+        return chunks * chunk_size
+
+    def upload_file(self, path, name):
+        """Upload a local file, resume an interrupted upload of it
+
+        If the upload fails, the file is kept in the state directory until
+        resume_pending_upload() finishes the transfer.
+        """
+        journal = self.transfer_journal()
+        try:
+            self.resume_upload(path, name, journal)
+        except Exception:
+            self.keep_pending(path, name, journal)
+            raise
+        journal.clear()
+        # The kept file of an earlier failed attempt is not needed anymore
+        if os.path.isfile(self.pending_path(name)):
+            os.remove(self.pending_path(name))
+
+    def resume_upload(self, path, name, journal):
+        """Upload the file from the last verified chunk on the target on"""
+        size = os.path.getsize(path)
+        state = journal.load()
+        if (not state or state['direction'] != 'upload' or
+                state['name'] != name or state['size'] != size):
+            state = {
+                'direction': 'upload',
+                'name': name,
+                'size': size,
+                'chunk_size': self.transfer_chunk_size,
+                'checksums': []
+            }
+        with open(path, 'rb') as source:
+            offset = 0
+            if state['checksums']:
+                remote_size = self.remote_size(name) or 0
+                offset = self.verified_offset(state, source, name,
+                                              remote_size)
+            if offset:
+                print('Resuming upload of {0} at byte {1}'.format(name,
+                                                                  offset))
+            else:
+                state['checksums'] = []
+            state['path'] = path
+            journal.save(state)
+            source.seek(offset)
+            reader = ChecksumFile(source, state['chunk_size'],
+                                  state['checksums'],
+                                  lambda: journal.save(state))
+            self.upload_fileobj(reader, name, offset=offset)
+
+    def resume_pending_upload(self):
+        """Finish the upload of an archive an earlier run left behind"""
+        journal = self.transfer_journal()
+        state = journal.load()
+        if not state or state['direction'] != 'upload':
+            return
+        if not os.path.isfile(state.get('path', '')):
+            self.discard_transfer(state)
+            journal.clear()
+            return
+        print('Resuming upload of backup: {0}'.format(state['name']))
+        self.upload_file(state['path'], state['name'])
+
+    def discard_transfer(self, state):
+        """Release what the target keeps of a journaled, abandoned transfer
+
+        Nothing by default, the partial data is overwritten by the next
+        transfer of the same name.
+        """
+        pass
+
+    def download_file(self, name, path):
+        """Download a backup into a local file, resume an interrupted one"""
+        journal = self.transfer_journal()
+        try:
+            self.resume_download(name, path, journal)
+        except Exception:
+            self.keep_pending(path, name, journal)
+            raise
+        journal.clear()
+
+    def resume_download(self, name, path, journal):
+        """Download the backup from the last verified local chunk on"""
+        size = self.remote_size(name)
+        state = journal.load()
+        pending_path = self.pending_path(name)
+        offset = 0
+        if (state and state['direction'] == 'download' and
+                state['name'] == name and state['size'] == size and
+                os.path.isfile(pending_path)):
+            shutil.move(pending_path, path)
+            with open(path, 'rb') as partial:
+                offset = self.verified_offset(state, partial, name,
+                                              os.path.getsize(path))
+        else:
+            state = {
+                'direction': 'download',
+                'name': name,
+                'size': size,
+                'chunk_size': self.transfer_chunk_size,
+                'checksums': []
+            }
+        if offset:
+            print('Resuming download of {0} at byte {1}'.format(name, offset))
+        else:
+            state['checksums'] = []
+        state['path'] = path
+        journal.save(state)
+        with open(path, 'r+b' if offset else 'wb') as target:
+            target.truncate(offset)
+            target.seek(offset)
+
+            def checkpoint():
+                target.flush()
+                journal.save(state)
+            writer = ChecksumFile(target, state['chunk_size'],
+                                  state['checksums'], checkpoint)
+            self.download_fileobj(name, writer, offset=offset)
+
     @staticmethod
     def create_directory(directory):
         """Create the given directory, if not exist, else do nothing"""
@@ -108,105 +861,805 @@ class Backup(object):
             if error.errno != errno.ENOENT:
                 raise
 
-    def copy_files(self):
-        """Copy the entries from file list to its temporary target"""
+    @contextmanager
+    def source_snapshot(self):
+        """Read the configured files from a snapshot while in this context"""
+        if not self.snapshot_config:
+            yield
+            return
+        with open_snapshot(self.name, self.snapshot_config,
+                           self.workdir) as snapshot:
+            self.snapshot = snapshot
+            try:
+                yield
+            finally:
+                self.snapshot = None
+
+    def source_pattern(self, pattern):
+        """Return the pattern to find the configured files at"""
+        if self.snapshot is None:
+            return pattern
+        return self.snapshot.snapshot_path(pattern)
+
+    def original_path(self, path):
+        """Return the configured path of a (maybe snapshotted) file"""
+        if self.snapshot is None:
+            return path
+        return self.snapshot.original_path(path)
+
+    def archive_path(self, path):
+        """Return the path of a source file/directory inside the archive"""
+        return './files/{0}'.format(self.original_path(path).lstrip('/'))
+
+    def source_stats(self, path):
+        """Return the stats of a source path or None, if it is excluded"""
+        try:
+            stats = os.lstat(path)
+        except OSError:
+            # Vanished since it was listed
+            return None
+        if self.matcher.excludes(self.original_path(path), stats):
+            return None
+        if stat.S_ISSOCK(stats.st_mode):
+            # tar has no member type for sockets, tar.add() skipped them, too
+            self.matcher.pruned_files += 1
+            return None
+        return stats
+
+    def iter_source_files(self):
+        """Generate (path, stats) of all configured files and directories
+
+        Directories are walked recursively (top down), symbolic links are
+        not followed. Excluded directories are pruned from the walk, so
+        nothing below them is read. The files are read directly from their
+        source paths (or from the snapshot of them).
+        """
         if not self.files:
             return
         for entry in self.files:
-            dst = '{0}/files/{1}'.format(self.workdir, os.path.dirname(entry))
-            for member in glob(entry):
-                if os.path.isfile(member):
-                    if not os.path.exists(dst):
-                        self.create_directory(dst)
-                    shutil.copy(member, dst)
-                elif os.path.isdir(member):
-                    move_dst = '{0}/{1}'.format(dst, os.path.basename(member))
-                    shutil.copytree(member, move_dst, symlinks=True)
+            for member in glob(self.source_pattern(entry)):
+                stats = self.source_stats(member)
+                if stats is None:
+                    continue
+                yield member, stats
+                if not stat.S_ISDIR(stats.st_mode):
+                    continue
+                for root, dirs, files in os.walk(member):
+                    kept_dirs = []
+                    for name in dirs:
+                        path = os.path.join(root, name)
+                        stats = self.source_stats(path)
+                        if stats is None:
+                            continue
+                        if stat.S_ISDIR(stats.st_mode):
+                            kept_dirs.append(name)
+                        yield path, stats
+                    dirs[:] = kept_dirs
+                    for name in files:
+                        path = os.path.join(root, name)
+                        stats = self.source_stats(path)
+                        if stats is not None:
+                            yield path, stats
+
+    def print_pruned(self):
+        """Report the files and directories left out of the backup"""
+        if self.matcher.pruned_files or self.matcher.pruned_directories:
+            message = 'Excluded {0} files ({1:.2f}MB) and {2} directories'
+            print(message.format(self.matcher.pruned_files,
+                                 float(self.matcher.pruned_bytes) / 1024 /
+                                 1024,
+                                 self.matcher.pruned_directories))
+
+    def add_dumps(self, tar):
+        """Add the database and ldap dumps of the working directory"""
+        for dump_dir in ['mysql', 'ldap']:
+            dump_path = '{0}/{1}'.format(self.workdir, dump_dir)
+            if os.path.isdir(dump_path):
+                tar.add(dump_path, arcname='./{0}'.format(dump_dir))
+                for dump_file in os.listdir(dump_path):
+                    self.metrics.count(bytes_in=os.path.getsize(
+                        os.path.join(dump_path, dump_file)))
+
+    def open_compressor(self, fileobj, compress=True, blocks=False):
+        """Return a file object which compresses into the given one
+
+        With blocks the data is compressed in independent blocks, whose
+        offsets are recorded in the blocks attribute of the writer.
+        """
+        return open_writer(fileobj,
+                           self.compression if compress else 'none',
+                           self.compression_level,
+                           self.compression_threads,
+                           blocks=blocks,
+                           initializer=self.priority.apply)
+
+    def open_archive_writer(self, fileobj, compress=True):
+        """Return the compressor of a new archive and start its index
+
+        Only compressed archives get an index, the members of deduplicated
+        archives are spread over the chunks.
+        """
+        self.archive_index = None
+        if compress and self.index_archives:
+            self.archive_index = ArchiveIndex(self.compression)
+        return self.open_compressor(fileobj, compress,
+                                    blocks=self.archive_index is not None)
+
+    def finish_archive_index(self, writer):
+        """Take the block offsets of the closed writer into the index"""
+        if self.archive_index is not None:
+            self.archive_index.blocks = writer.blocks
+
+    def write_archive(self, fileobj, compress=True):
+        """Write a compressed tar stream of all backup sources into fileobj
+
+        The configured files are read once from their source paths, the
+        archive paths keep the directory layout below files/ which
+        restore_files() expects. Only the (small) database and ldap dumps
+        are taken from the working directory.
+        """
+        writer = self.open_archive_writer(fileobj, compress)
+        with closing(writer):
+            # Python 2.6 has no support for the context manager protocol
+            with closing(tarfile.open(fileobj=writer, mode='w|')) as tar:
+                for path, _ in self.iter_source_files():
+                    self.add_source_file(tar, path)
+                self.add_dumps(tar)
+        self.finish_archive_index(writer)
+
+    def add_source_file(self, tar, path):
+        """Add a single source path (without its content) to the archive
+
+        Returns the sha256 of a regular file, None for other types. The
+        position of the tar entry is recorded in the archive index.
+        """
+        offset = tar.offset
+        tarinfo = tar.gettarinfo(path, self.archive_path(path))
+        digest = None
+        if tarinfo is None:
+            # No tar member type for it, e.g. replaced by a socket since
+            # source_stats()
+            self.matcher.pruned_files += 1
+            return None
+        if not tarinfo.isreg():
+            tar.addfile(tarinfo)
+        else:
+            self.metrics.count(bytes_in=tarinfo.size)
+            with open(path, 'rb') as source:
+                reader = HashingReader(self.read_throttle.reader(source))
+                tar.addfile(tarinfo, reader)
+            digest = reader.hexdigest()
+        if self.archive_index is not None:
+            self.archive_index.add(self.original_path(path), offset,
+                                   tar.offset - offset, tarinfo.size, digest)
+        return digest
+
+    def write_incremental_archive(self, fileobj, index, full):
+        """Write a compressed tar stream of all new or modified files
+
+        Unchanged files are only checked by their stat values. The paths
+        which were deleted since the last backup are written to the member
+        incremental/info.json, together with the type of the backup.
+        """
+        writer = self.open_archive_writer(fileobj)
+        # Python 2.6 has no support for the context manager protocol
+        with closing(writer), closing(tarfile.open(fileobj=writer,
+                                                   mode='w|')) as tar:
+            for path, stats in self.iter_source_files():
+                original_path = self.original_path(path)
+                if not full and not index.is_modified(original_path, stats):
+                    index.mark_seen(original_path)
+                    continue
+                digest = self.add_source_file(tar, path)
+                index.update(original_path, stats, digest)
+            info = {
+                'type': 'full' if full else 'incremental',
+                'deleted': [] if full else index.deleted_paths()
+            }
+            data = json.dumps(info).encode('utf-8')
+            tarinfo = tarfile.TarInfo('./incremental/info.json')
+            tarinfo.size = len(data)
+            tarinfo.mtime = time.time()
+            tar.addfile(tarinfo, io.BytesIO(data))
+            self.add_dumps(tar)
+        self.finish_archive_index(writer)
 
     @_needs_configured_user
+    @_instrumented('create')
     def create(self):
-        """Collect data, encrypt it and upload the result"""
-        self.copy_files()
+        """Collect data, encrypt it and upload the result to all targets
+
+        The archive is built once, even if there are several targets. A
+        failed target does not stop the others, but fails the backup.
+        """
+        archive_file = not (self.dedup or self.incremental or self.stream)
+        try:
+            with self.source_snapshot():
+                if self.dedup:
+                    self.create_dedup()
+                elif self.incremental:
+                    self.create_incremental()
+                elif self.stream:
+                    self.create_stream()
+                else:
+                    self.for_each_target(
+                        lambda target: target.resume_pending_upload())
+                    self.dump_database()
+                    self.dump_ldap()
+                    self.tar_workdir()
+        finally:
+            self.print_pruned()
+        if archive_file:
+            self.upload()
+        self.check_targets()
+
+    def create_stream(self):
+        """Archive, compress, encrypt and upload the backup as one stream
+
+        No copies of the configured files and no intermediate archive files
+        are written to the working directory.
+        """
         self.dump_database()
         self.dump_ldap()
-        self.tar_workdir()
-        self.encrypt_archive()
-        self.upload()
+        self.set_filename()
+        filename = self.encrypted_name(self.filename)
+        with self.metrics.phase('archive_upload'):
+            with ArchiveStream(self.write_archive,
+                               self.encryption_stage()) as stream:
+                self.upload_stream(stream, filename)
+            self.metrics.count(bytes_out=stream.bytes_read)
+            index = self.archive_index
+            self.for_each_target(
+                lambda target: target.upload_index(filename, index),
+                self.target_retries)
+
+    def create_dedup(self):
+        """Store the backup as deduplicated chunks plus a manifest
 
-    def decrypt_archive(self):
-        """Decrypt the gpg file"""
+        The uncompressed tar stream is split into content defined chunks,
+        only chunks which are not yet on the target get uploaded.
+        """
+        self.dump_database()
+        self.dump_ldap()
+        self.set_filename('manifest')
+        filename = self.encrypted_name(self.filename)
+        # Every target has its own chunk store
+        stores = {}
+
+        def producer(fileobj):
+            self.write_archive(fileobj, compress=False)
+
+        def store_chunks(target, fileobj):
+            store = ChunkStore(target)
+            stores[target] = store, store.store(fileobj)
+
+        def write_manifest(target):
+            store, chunk_ids = stores[target]
+            store.write_manifest(filename, chunk_ids)
+        with self.metrics.phase('archive_upload'):
+            with ArchiveStream(producer) as stream:
+                self.tee_to_targets(stream, store_chunks)
+            self.for_each_target(write_manifest, self.target_retries)
+            self.metrics.count(bytes_out=sum(
+                store.uploaded_bytes for store, _ in stores.values()))
+
+    def index_path(self):
+        """Return the path of the file index of this backup"""
+        try:
+            self.create_directory(self.state_dir)
+        except OSError as error:
+            raise CallingUserError(
+                'Unable to create the state directory for the file index '
+                '({0}), set state_dir to a writable directory'.format(error))
+        return '{0}/{1}.index'.format(self.state_dir, self.name)
+
+    def needs_full_backup(self, index):
+        """Check if the next incremental backup has to be a full one"""
+        if index.is_empty():
+            return True
+        full_backups = [name for name in self.backup_names()
+                        if not self.is_incremental_name(name)]
+        if not full_backups:
+            return True
+        incrementals = int(index.get_meta('incrementals', 0))
+        return incrementals + 1 >= self.full_every
+
+    def create_incremental(self):
+        """Upload only the files which changed since the last backup
+
+        Every full_every-th backup is a full backup, the others only
+        contain new or modified files and the list of deleted files. If a
+        target failed, the index is not committed, so the next backup
+        contains the changes again for all targets.
+        """
+        self.dump_database()
+        self.dump_ldap()
+        index = FileIndex(self.index_path())
+        try:
+            full = self.needs_full_backup(index)
+            if full:
+                self.set_filename()
+            else:
+                self.set_filename('inc.{0}'.format(
+                    EXTENSIONS[self.compression]))
+            filename = self.encrypted_name(self.filename)
+
+            def producer(fileobj):
+                self.write_incremental_archive(fileobj, index, full)
+            with self.metrics.phase('archive_upload'):
+                with ArchiveStream(producer,
+                                   self.encryption_stage()) as stream:
+                    self.upload_stream(stream, filename)
+                self.metrics.count(bytes_out=stream.bytes_read)
+                archive_index = self.archive_index
+                self.for_each_target(
+                    lambda target: target.upload_index(filename,
+                                                       archive_index),
+                    self.target_retries)
+            if not self.target_failures:
+                index.commit(full)
+        finally:
+            index.close()
+
+    def encrypted_name(self, name):
+        """Return the name of the given file after the encryption"""
         if not self.encrypt:
-            return
-        with open('{0}.gpg'.format(self.filename_abs), 'rb') as gpg_file:
-            status = self.gpg.decrypt_file(gpg_file, self.gpg_key_id,
-                                           output=self.filename_abs)
-        if not status.ok:
-            raise DecryptionError('Unable to decrypt backup file')
+            return name
+        return '{0}.{1}'.format(name, ENCRYPTION_EXTENSIONS[self.encryption])
+
+    def encryption_stage(self, decrypt=False):
+        """Return the stream stage which en- or decrypts or None
+
+        The stage is a function, which wraps a file object into a writer
+        which encrypts (decrypts) the written data into the file object.
+        """
+        if not self.encrypt:
+            return None
+        cipher = open_cipher(self.encryption, self.config)
+        if decrypt:
+            return cipher.decryptor
+        return cipher.encryptor
 
+    @_measured('dump_database')
     def dump_database(self):
-        """Create a sql dump of given mysql databases"""
+        """Create compressed sql dumps of given mysql databases
+
+        Up to mysql_dump_jobs dumps run concurrently. The timing and the
+        byte counts of every dump are recorded in dump_stats.
+        """
         if self.mysql_databases is not None:
             self.create_directory('{0}/mysql'.format(self.workdir))
-            for database in self.mysql_databases:
-                cmd = [
-                    'mysqldump',
-                    '-u', self.mysql_user,
-                    '-p{0}'.format(self.mysql_password),
-                    '--result-file',
-                    '{0}/mysql/{1}.sql'.format(self.workdir, database),
-                    database
-                ]
-                subprocess.check_call(cmd, stdout=self.devnull,
-                                      stderr=subprocess.STDOUT)
+            # The compression of the dumps runs in the threads of the pool
+            with ThreadPoolExecutor(max_workers=self.mysql_dump_jobs,
+                                    initializer=self.priority.apply) as pool:
+                futures = [pool.submit(self.dump_single_database, database)
+                           for database in self.mysql_databases]
+                for future in futures:
+                    future.result()
 
+    def dump_single_database(self, database):
+        """Dump a single database, compressed while mysqldump writes it"""
+        cmd = [
+            'mysqldump',
+            '-u', self.mysql_user,
+            '-p{0}'.format(self.mysql_password)
+        ] + self.mysql_dump_options + [database]
+        dump_path = '{0}/mysql/{1}.sql{2}'.format(
+            self.workdir, database, file_extension(self.compression))
+        started = time.time()
+        dumped_bytes = 0
+        process = self.start_process(cmd, stdout=subprocess.PIPE,
+                                     stderr=self.devnull)
+        try:
+            with open(dump_path, 'wb') as dump_file:
+                with closing(self.open_compressor(dump_file)) as writer:
+                    for data in iter(lambda: process.stdout.read(65536), b''):
+                        writer.write(data)
+                        dumped_bytes += len(data)
+        finally:
+            process.stdout.close()
+            return_code = process.wait()
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, cmd)
+        self.dump_stats[database] = {
+            'seconds': time.time() - started,
+            'bytes': dumped_bytes,
+            'compressed_bytes': os.path.getsize(dump_path)
+        }
+        self.metrics.count(dumped_bytes, os.path.getsize(dump_path))
+
+    @_measured('dump_ldap')
     def dump_ldap(self):
         """Create a complete ldap dump"""
         if self.ldap_backup:
             self.create_directory('{0}/ldap'.format(self.workdir))
-            cmd = [
-                'slapcat', '-n1', '-l',
-                '{0}/ldap/dump.ldif'.format(self.workdir)
-            ]
-            subprocess.check_call(cmd, stdout=self.devnull,
-                                  stderr=subprocess.STDOUT)
-
-    def encrypt_archive(self):
-        """Encrypt the created tarball with gpg"""
-        if not self.encrypt:
-            return
-        gpg_target_file = "{0}.gpg".format(self.filename_abs)
-        with open(self.filename_abs, 'rb') as tared_file:
-            crypt = self.gpg.encrypt_file(tared_file,
-                                          self.gpg_key_id,
-                                          always_trust=True,
-                                          output=gpg_target_file)
-            if not crypt.ok:
-                raise NameError('GPG encryption was not successfull!')
+            dump_path = '{0}/ldap/dump.ldif'.format(self.workdir)
+            cmd = ['slapcat', '-n1', '-l', dump_path]
+            process = self.start_process(cmd, stdout=self.devnull,
+                                         stderr=subprocess.STDOUT)
+            return_code = process.wait()
+            if return_code != 0:
+                raise subprocess.CalledProcessError(return_code, cmd)
+            if os.path.isfile(dump_path):
+                self.metrics.count(bytes_out=os.path.getsize(dump_path))
 
     @_needs_configured_user
-    def restore(self):
-        """Call all necessary methods to do an backup restore"""
+    @_instrumented('restore')
+    def restore(self, archive=None, pattern=None):
+        """Call all necessary methods to do an backup restore
+
+        With archive the given backup is restored instead of the newest
+        one, with pattern only the paths matching the glob pattern.
+        """
+        if archive is not None or pattern is not None:
+            self.restore_selected(archive, pattern)
+            return
+        if self.dedup:
+            self.restore_dedup()
+            return
+        if self.incremental:
+            self.restore_incremental()
+            return
+        if self.stream:
+            self.restore_stream()
+            return
         if self.download():
             print('Restoring backup: {0}'.format(self.name))
-            self.decrypt_archive()
             self.untar_backup_file()
             self.restore_files()
             self.restore_database()
             self.restore_ldap()
 
+    def restore_stream(self):
+        """Download, decrypt and extract the newest backup as one stream
+
+        The archive members are written directly to their final place and
+        database dumps are fed directly into the mysql client, so no full
+        size copies of the backup are written to the working directory.
+        """
+        newest_backup = self.newest_backup()
+        if not newest_backup:
+            return
+        print('Restoring backup: {0}'.format(self.name))
+        self.check_encryption_by_name(newest_backup)
+
+        def producer(fileobj):
+            self.download_fileobj(newest_backup, fileobj)
+        with self.metrics.phase('download_extract'):
+            with ArchiveStream(producer,
+                               self.encryption_stage(decrypt=True)) as stream:
+                self.extract_stream(stream,
+                                    compression_by_name(newest_backup))
+            self.metrics.count(bytes_in=stream.bytes_read)
+        self.restore_ldap()
+
+    def restore_dedup(self):
+        """Restore the newest deduplicated backup chunk by chunk"""
+        newest_backup = self.newest_backup()
+        if not newest_backup:
+            return
+        print('Restoring backup: {0}'.format(self.name))
+        store = ChunkStore(self)
+        manifest = store.read_manifest(newest_backup)
+
+        def producer(fileobj):
+            store.restore(manifest, fileobj)
+        with self.metrics.phase('download_extract'):
+            with ArchiveStream(producer) as stream:
+                self.extract_stream(stream, 'none')
+            self.metrics.count(bytes_in=stream.bytes_read)
+        self.restore_ldap()
+
+    def restore_selected(self, archive=None, pattern=None):
+        """Restore a specific backup or only the paths matching pattern
+
+        Without archive the paths are taken from the newest backup, for
+        incremental backups from the newest backup of the chain which
+        contains them. Selected paths are read with ranged reads around
+        their entries in the archive index, where possible.
+        """
+        names = self.backup_names()
+        if archive is not None:
+            if archive not in names:
+                raise ArchiveIndexError(
+                    'Backup {0} does not exist'.format(archive))
+            chain = [archive]
+        elif self.incremental:
+            chain = list(reversed(self.restore_chain()))
+        else:
+            chain = names[-1:]
+        if not chain:
+            return
+        print('Restoring backup: {0}'.format(self.name))
+        with self.metrics.phase('download_extract'):
+            if pattern is None:
+                self.restore_archive(chain[0])
+            else:
+                restored = set()
+                for name in chain:
+                    self.restore_paths(name, pattern, restored)
+                if not restored:
+                    print('No files match {0}'.format(pattern))
+        if pattern is None:
+            self.restore_ldap()
+
+    def restore_archive(self, name, select=None):
+        """Stream and extract a single backup
+
+        With select only the files for whose original path select returns
+        True are restored, the dumps are left out then.
+        """
+        if '.manifest' in name:
+            store = ChunkStore(self)
+            manifest = store.read_manifest(name)
+            compression = 'none'
+            stage = None
+
+            def producer(fileobj):
+                store.restore(manifest, fileobj)
+        else:
+            self.check_encryption_by_name(name)
+            compression = compression_by_name(name)
+            stage = self.encryption_stage(decrypt=True)
+
+            def producer(fileobj):
+                self.download_fileobj(name, fileobj)
+        with ArchiveStream(producer, stage) as stream:
+            self.extract_stream(stream, compression,
+                                restore_dumps=select is None, select=select)
+        self.metrics.count(bytes_in=stream.bytes_read)
+        self.apply_deletions()
+
+    def plain_range_reader(self, name):
+        """Return a function reading plain ranges of the archive and its size
+
+        Returns None, if the archive could not be read in ranges, like gpg
+        encrypted archives.
+        """
+        size = self.remote_size(name)
+        encryption = encryption_by_name(name)
+        if encryption is None:
+            return lambda offset, length: self.read_range(name, offset,
+                                                          length), size
+        cipher = open_cipher(encryption, self.config)
+        if not isinstance(cipher, AESGCMCipher):
+            return None
+        reader = cipher.plain_reader(
+            lambda offset, length: self.read_range(name, offset, length),
+            size)
+        return reader.read, reader.size
+
+    def restore_paths(self, name, pattern, restored):
+        """Restore the paths matching pattern from a single backup
+
+        Paths in restored were already restored from a newer backup, the
+        newly restored paths are added to it. Without a usable index the
+        whole archive is streamed and filtered.
+        """
+        index = None
+        reader = None
+        if '.manifest' not in name:
+            index = self.load_index(name)
+            reader = self.plain_range_reader(name)
+        if index is None or reader is None:
+            def select(path):
+                if path in restored or not path_matches(path, pattern):
+                    return False
+                restored.add(path)
+                return True
+            self.restore_archive(name, select)
+            return
+        read, size = reader
+        members = [member for member in index.find(pattern)
+                   if member['path'] not in restored]
+        self.extract_ranges(index, read, size, members, restored)
+
+    def extract_ranges(self, index, read, size, members, restored):
+        """Extract the given members of an indexed archive by ranged reads
+
+        The target of a hardlink could be in a block which was not read,
+        it is extracted first, unless it was restored already.
+        """
+        def extract_link_target(path):
+            if path in restored:
+                return
+            targets = [member for member in index.members
+                       if member['path'] == path]
+            if not targets:
+                raise ArchiveIndexError('Hardlink target {0} is not in the '
+                                        'index'.format(path))
+            self.extract_ranges(index, read, size, targets, restored)
+        for start, compressed_start, compressed_end, group in index.ranges(
+                members):
+            if compressed_end is None:
+                compressed_end = size
+            stream = open_reader(
+                RangeReader(read, compressed_start, compressed_end,
+                            self.transfer_chunk_size), index.compression)
+            self.metrics.count(bytes_in=compressed_end - compressed_start)
+            position = start
+            for member in group:
+                LimitedReader(stream, member['offset'] - position).skip()
+                self.extract_member(LimitedReader(stream, member['length']),
+                                    member, extract_link_target)
+                position = member['offset'] + member['length']
+                restored.add(member['path'])
+
+    def extract_member(self, fileobj, member, extract_link_target):
+        """Extract a single tar entry and verify it against the index
+
+        extract_link_target(path) is called with the original path of the
+        target of a hardlink before the link is extracted.
+        """
+        # Python 2.6 has no support for the context manager protocol
+        with closing(tarfile.open(fileobj=fileobj, mode='r|')) as tar:
+            for tarinfo in tar:
+                tarinfo.name = os.path.normpath(tarinfo.name).partition(
+                    '/')[2]
+                if tarinfo.islnk():
+                    tarinfo.linkname = os.path.normpath(
+                        tarinfo.linkname).partition('/')[2]
+                    extract_link_target('/' + tarinfo.linkname)
+                tar.extract(tarinfo, path='/')
+                self.metrics.count(bytes_out=tarinfo.size)
+        fileobj.skip()
+        if member['sha256'] is None:
+            return
+        with open(member['path'], 'rb') as restored_file:
+            digest = file_checksum(restored_file, 0, member['size'])
+        if digest != member['sha256']:
+            raise ArchiveIndexError('Checksum mismatch of restored file '
+                                    '{0}'.format(member['path']))
+
+    def restore_chain(self):
+        """Return the newest full backup and all newer incrementals"""
+        names = sorted(self.backup_names())
+        for position in range(len(names) - 1, -1, -1):
+            if not self.is_incremental_name(names[position]):
+                return names[position:]
+        return []
+
+    def restore_incremental(self):
+        """Restore the newest full backup and apply all incrementals"""
+        chain = self.restore_chain()
+        if not chain:
+            return
+        print('Restoring backup: {0}'.format(self.name))
+        with self.metrics.phase('download_extract'):
+            for name, more_items in self._lookahead(chain):
+                self.check_encryption_by_name(name)
+
+                def producer(fileobj, name=name):
+                    self.download_fileobj(name, fileobj)
+                with ArchiveStream(
+                        producer,
+                        self.encryption_stage(decrypt=True)) as stream:
+                    # Only the newest backup contains the relevant dumps
+                    self.extract_stream(stream, compression_by_name(name),
+                                        restore_dumps=not more_items)
+                self.metrics.count(bytes_in=stream.bytes_read)
+                self.apply_deletions()
+        self.restore_ldap()
+
+    def apply_deletions(self):
+        """Remove the files which were deleted since the last backup"""
+        info_path = '{0}/incremental/info.json'.format(self.workdir)
+        if not os.path.isfile(info_path):
+            return
+        with open(info_path) as info_file:
+            info = json.load(info_file)
+        os.remove(info_path)
+        # Reverse order removes the content of directories first
+        for path in sorted(info['deleted'], reverse=True):
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+    def extract_stream(self, fileobj, compression='gzip', restore_dumps=True,
+                       select=None):
+        """Restore all members of the given (compressed) tar stream
+
+        Files are extracted directly to the system, mysql dumps get imported
+        and the remaining members (like the ldap dump) are extracted to the
+        working directory. Without restore_dumps only the files and the
+        incremental information are restored. With select only the files
+        for whose original path select returns True are restored.
+
+        With mysql_restore_jobs > 1 the (still compressed) dumps are written
+        to the working directory and imported concurrently, while the
+        extraction of the stream goes on.
+        """
+        reader = open_reader(fileobj, compression)
+        pool = ThreadPoolExecutor(max_workers=self.mysql_restore_jobs)
+        imports = []
+        # Python 2.6 has no support for the context manager protocol
+        with pool, closing(tarfile.open(fileobj=reader, mode='r|')) as tar:
+            for member in tar:
+                path = os.path.normpath(member.name)
+                section, _, relative_path = path.partition('/')
+                if not relative_path:
+                    continue
+                if section == 'files':
+                    if select is not None and \
+                            not select('/' + relative_path):
+                        continue
+                    member.name = relative_path
+                    if member.islnk():
+                        # Hardlinks name their target by its archive path
+                        member.linkname = os.path.normpath(
+                            member.linkname).partition('/')[2]
+                    tar.extract(member, path='/')
+                    self.metrics.count(bytes_out=member.size)
+                elif select is not None or (not restore_dumps and
+                                            section != 'incremental'):
+                    continue
+                elif section == 'mysql' and member.isfile():
+                    if self.mysql_restore_jobs > 1:
+                        tar.extract(member, path=self.workdir)
+                        imports.append(pool.submit(
+                            self.import_dump_file,
+                            os.path.join(self.workdir, path)))
+                        continue
+                    database, compression = self.split_dump_name(
+                        relative_path)
+                    self.import_database(database, open_reader(
+                        tar.extractfile(member), compression))
+                else:
+                    tar.extract(member, path=self.workdir)
+            for future in imports:
+                future.result()
+        # Consume the padding behind the end of the archive, so the
+        # producer of the stream is not cut off
+        while fileobj.read(65536):
+            pass
+
+    def import_database(self, database, fileobj):
+        """Feed the sql dump from the given file object into mysql"""
+        cmd = [
+            'mysql',
+            '-u', self.mysql_user,
+            '-p{0}'.format(self.mysql_password)
+        ] + self.mysql_import_options + [database]
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        try:
+            shutil.copyfileobj(fileobj, process.stdin)
+        finally:
+            process.stdin.close()
+            return_code = process.wait()
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, cmd)
+
+    @staticmethod
+    def split_dump_name(name):
+        """Return the database name and the compression of a dump file"""
+        name, compression = split_extension(name)
+        return '.'.join(name.split('.')[:-1]), compression
+
+    def import_dump_file(self, dump_path):
+        """Import a (compressed) sql dump file and remove it afterwards"""
+        database, compression = self.split_dump_name(
+            os.path.basename(dump_path))
+        with open(dump_path, 'rb') as dump:
+            self.import_database(database, open_reader(dump, compression))
+        os.remove(dump_path)
+
+    @_measured('restore_database')
     def restore_database(self):
-        """Import the given sql dumps into local mysql"""
+        """Import the given (compressed) sql dumps into local mysql
+
+        Up to mysql_restore_jobs databases are imported concurrently.
+        """
         backup_path = '{0}/mysql'.format(self.workdir)
         if os.path.isdir(backup_path):
-            cmd = 'mysql -u {0} -p{1} {2} < {3}/mysql/{4}'
-            for dump_file in os.listdir(backup_path):
-                formatted_cmd = cmd.format(self.mysql_user,
-                                           self.mysql_password,
-                                           '.'.join(dump_file.split('.')[:-1]),
-                                           self.workdir,
-                                           dump_file)
-                subprocess.check_call(formatted_cmd, shell=True)
+            dump_paths = ['{0}/{1}'.format(backup_path, dump_file)
+                          for dump_file in sorted(os.listdir(backup_path))]
+            with ThreadPoolExecutor(
+                    max_workers=self.mysql_restore_jobs) as pool:
+                for _ in pool.map(self.import_dump_file, dump_paths):
+                    pass
 
+    @_measured('restore_ldap')
     def restore_ldap(self):
         """Wipe ldap and import the dump from backup"""
         if os.path.isdir('{0}/ldap'.format(self.workdir)):
@@ -224,37 +1677,69 @@ class Backup(object):
                 subprocess.check_call(cmd, shell=True)
             subprocess.check_call('service slapd start', shell=True)
 
+    @_measured('restore_files')
     def restore_files(self):
         """Copy the file tree from temporary space to the system"""
         if os.path.isdir('{0}/files'.format(self.workdir)):
             cmd = 'rsync -a {0}/files/ /'.format(self.workdir)
             subprocess.check_call(cmd, shell=True)
 
-    def tar_workdir(self):
-        """Tar the prepared working directory"""
+    def set_filename(self, extension=None):
+        """Set the name of a new backup file based on the current time"""
+        if extension is None:
+            extension = EXTENSIONS[self.compression]
         timestamp = time.time()
         formatted_timestamp = datetime.fromtimestamp(timestamp)
         formatted_timestamp = formatted_timestamp.strftime('%Y%m%d%H%M%S')
-        filename = '{0}-{1}.tar.gz'
+        filename = '{0}-{1}.{2}'
         self.filename = filename.format(self.filename_prefix,
-                                        formatted_timestamp)
+                                        formatted_timestamp,
+                                        extension)
         self.filename_abs = '{0}/{1}'.format(self.workdir, self.filename)
-        # Python 2.6 has no support for the context manager protocol
-        with closing(tarfile.open(self.filename_abs, 'w:gz')) as tar:
-            tar.add(self.workdir, arcname='.')
 
+    @_measured('tar_workdir')
+    def tar_workdir(self):
+        """Archive the configured files and the dumps of the workdir
+
+        With encryption the archive is encrypted while it is written, so
+        only the encrypted file ends up in the working directory.
+        """
+        self.set_filename()
+        archive_path = self.encrypted_name(self.filename_abs)
+        stage = self.encryption_stage()
+        with open(archive_path, 'wb') as archive_file:
+            if stage is None:
+                self.write_archive(archive_file)
+            else:
+                with closing(stage(archive_file)) as writer:
+                    self.write_archive(writer)
+        self.metrics.count(bytes_out=os.path.getsize(archive_path))
+
+    @_measured('untar_backup_file')
     def untar_backup_file(self):
-        """Extract the backup tarball"""
-        # Python 2.6 has no support for the context manager protocol
-        with closing(tarfile.open(self.filename_abs)) as tar:
-            tar.extractall(path=self.workdir)
+        """Extract the (decrypted while it is read) backup tarball"""
+        compression = compression_by_name(self.filename)
+        archive_path = self.encrypted_name(self.filename_abs)
+
+        def producer(fileobj):
+            with open(archive_path, 'rb') as archive_file:
+                shutil.copyfileobj(archive_file, fileobj, 1024 * 1024)
+        with ArchiveStream(producer,
+                           self.encryption_stage(decrypt=True)) as stream:
+            reader = open_reader(stream, compression)
+            # Python 2.6 has no support for the context manager protocol
+            with closing(tarfile.open(fileobj=reader, mode='r|')) as tar:
+                tar.extractall(path=self.workdir)
+            # Consume the padding behind the end of the archive
+            while stream.read(65536):
+                pass
+        self.metrics.count(bytes_in=os.path.getsize(archive_path))
 
     def check_encryption_by_name(self, name):
         """Check if the given name seems to be a encrypted backup"""
-        if name.split('.')[-1] == 'gpg':
-            self.encrypt = True
-            self.filename = '.'.join(name.split('.')[:-1])
-        else:
-            self.encrypt = False
-            self.filename = name
+        encryption = encryption_by_name(name)
+        self.encrypt = encryption is not None
+        if self.encrypt:
+            self.encryption = encryption
+        self.filename = strip_extension(name)
         self.filename_abs = '{0}/{1}'.format(self.workdir, self.filename)
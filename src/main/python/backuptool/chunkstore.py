@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import hmac
+import zlib
+import hashlib
+
+from .encryption import (
+    EXTENSIONS,
+    EncryptionError,
+    encryption_by_name,
+    open_cipher
+)
+
+
+MANIFEST_VERSION = 2
+
+
+def _hash_bits(length, salt):
+    """Return a deterministic pseudo random string of '0' and '1' characters
+
+    The values are derived from sha256, so the chunk boundaries stay the same
+    across runs, hosts and python versions.
+    """
+    bits = ''
+    counter = 0
+    while len(bits) < length:
+        seed = '{0}-{1}'.format(salt, counter).encode('ascii')
+        digest = hashlib.sha256(seed).digest()
+        for value in bytearray(digest):
+            bits += '{0:08b}'.format(value)
+        counter += 1
+    return bits[:length]
+
+
+class Chunker(object):
+    """Content defined chunking with a rolling window fingerprint
+
+    Every byte of the data is mapped to a single pseudo random bit and a
+    chunk boundary is set right after a fixed bit pattern occurs in this bit
+    sequence. So the boundaries only depend on the content of a small window
+    in front of them: an insertion or deletion in the data only changes the
+    chunks around it, all other chunks stay the same and can be
+    deduplicated. Mapping and pattern search are done with bytes.translate()
+    and bytes.find(), which run at C speed instead of hashing byte by byte
+    in python.
+    """
+
+    TABLE = bytes(bytearray(ord(bit) for bit in _hash_bits(256, 'table')))
+
+    def __init__(self, average_size=1024 * 1024):
+        self.min_size = average_size // 4
+        self.max_size = average_size * 4
+        window = max((average_size - self.min_size).bit_length() - 1, 1)
+        pattern = '0' + _hash_bits(window - 2, 'pattern') + '1'
+        self.pattern = pattern[:window].encode('ascii')
+
+    def find_boundary(self, data):
+        """Return the length of the first chunk of the given data"""
+        end = min(len(data), self.max_size)
+        if end <= self.min_size:
+            return end
+        start = max(self.min_size - len(self.pattern), 0)
+        bits = data[start:end].translate(self.TABLE)
+        position = bits.find(self.pattern)
+        if position < 0:
+            return end
+        return start + position + len(self.pattern)
+
+    def chunks(self, fileobj):
+        """Generate the chunks of the data read from the given file object"""
+        buf = b''
+        eof = False
+        while not eof:
+            data = fileobj.read(self.max_size)
+            if not data:
+                eof = True
+            buf += data
+            while len(buf) >= self.max_size or (eof and buf):
+                boundary = self.find_boundary(buf)
+                yield buf[:boundary]
+                buf = buf[boundary:]
+
+
+class ChunkStore(object):
+    """Deduplicating store of content defined chunks on a backup target
+
+    Every chunk is compressed (and optionally encrypted) on its own and
+    stored once below a chunk directory of the backup target, named by the
+    sha256 sum of its content. Encrypted chunks are named by a HMAC-SHA256
+    keyed with the encryption key instead, so the names do not reveal
+    whether the backup contains some known data. Only the in-process
+    aes-gcm encryption is supported, a gpg process per chunk would be far
+    too slow. A backup itself is just a small manifest of the ordered chunk
+    ids. The backup target has to provide the methods
+    upload_fileobj(), download_fileobj(), list_names(), make_directory()
+    and delete_names().
+    """
+
+    def __init__(self, backup):
+        self.backup = backup
+        self.directory = 'chunks-{0}'.format(backup.name)
+        self.chunker = Chunker(backup.config.get('chunk_size', 1024 * 1024))
+        self.existing_chunks = None
+        self.uploaded_bytes = 0
+        self.encryption = None
+        self.id_key = None
+        self.ciphers = {}
+        if backup.encrypt:
+            if backup.encryption != 'aes-gcm':
+                raise EncryptionError('Deduplicated backups could only be '
+                                      'encrypted with aes-gcm')
+            self.encryption = backup.encryption
+            self.id_key = hmac.new(self._cipher(self.encryption).key,
+                                   b'backuptool-chunk-id',
+                                   hashlib.sha256).digest()
+
+    def _cipher(self, encryption):
+        """Return the (cached) cipher of the given encryption type"""
+        if encryption not in self.ciphers:
+            self.ciphers[encryption] = open_cipher(encryption,
+                                                   self.backup.config)
+        return self.ciphers[encryption]
+
+    def _encode(self, data):
+        """Compress and (optionally) encrypt the given data"""
+        data = zlib.compress(data, 6)
+        if self.encryption:
+            data = self._cipher(self.encryption).encrypt(data)
+        return data
+
+    def _decode(self, data, encryption):
+        """Decrypt (if necessary) and decompress the given data"""
+        if encryption:
+            data = self._cipher(encryption).decrypt(data)
+        return zlib.decompress(data)
+
+    def chunk_id(self, chunk):
+        """Return the id of a chunk, keyed for encrypted chunks"""
+        if self.id_key is None:
+            return hashlib.sha256(chunk).hexdigest()
+        return hmac.new(self.id_key, chunk, hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def object_name(chunk_id, encryption):
+        """Return the name of a chunk object on the target"""
+        if encryption:
+            return '{0}.{1}'.format(chunk_id, EXTENSIONS[encryption])
+        return chunk_id
+
+    def _download(self, name):
+        """Download the given object from the target into memory"""
+        buf = io.BytesIO()
+        self.backup.download_fileobj(name, buf)
+        return buf.getvalue()
+
+    def load_existing_chunks(self):
+        """Read the names of all chunks which are already on the target"""
+        self.backup.make_directory(self.directory)
+        self.existing_chunks = set(self.backup.list_names(self.directory))
+
+    def store(self, fileobj):
+        """Store the data of the file object and return its chunk ids"""
+        if self.existing_chunks is None:
+            self.load_existing_chunks()
+        chunk_ids = []
+        for chunk in self.chunker.chunks(fileobj):
+            chunk_id = self.chunk_id(chunk)
+            name = self.object_name(chunk_id, self.encryption)
+            if name not in self.existing_chunks:
+                data = self._encode(chunk)
+                path = '{0}/{1}'.format(self.directory, name)
+                self.backup.upload_fileobj(io.BytesIO(data), path)
+                self.existing_chunks.add(name)
+                self.uploaded_bytes += len(data)
+            chunk_ids.append(chunk_id)
+        return chunk_ids
+
+    def restore(self, manifest, fileobj):
+        """Write the content of the chunks of a manifest into fileobj"""
+        encryption = manifest['encryption']
+        for chunk_id in manifest['chunks']:
+            path = '{0}/{1}'.format(self.directory,
+                                    self.object_name(chunk_id, encryption))
+            fileobj.write(self._decode(self._download(path), encryption))
+
+    def write_manifest(self, name, chunk_ids):
+        """Upload the manifest of a backup"""
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'encryption': self.encryption,
+            'chunks': chunk_ids
+        }
+        data = json.dumps(manifest).encode('utf-8')
+        if self.encryption:
+            data = self._cipher(self.encryption).encrypt(data)
+        self.backup.upload_fileobj(io.BytesIO(data), name)
+
+    def read_manifest(self, name):
+        """Download and parse the manifest with the given name"""
+        data = self._download(name)
+        encryption = encryption_by_name(name)
+        if encryption:
+            data = self._cipher(encryption).decrypt(data)
+        return json.loads(data.decode('utf-8'))
+
+    def unused_chunks(self, manifest_names):
+        """Return the paths of the chunks not used by the given manifests"""
+        referenced = set()
+        for name in manifest_names:
+            manifest = self.read_manifest(name)
+            for chunk_id in manifest['chunks']:
+                referenced.add(self.object_name(
+                    chunk_id, manifest['encryption']))
+        self.load_existing_chunks()
+        return ['{0}/{1}'.format(self.directory, name)
+                for name in sorted(self.existing_chunks - referenced)]
+
+    def collect_garbage(self, manifest_names):
+        """Delete all chunks which are not used by the given manifests
+
+        This must not run concurrently to a create of the same backup, as
+        the chunks of a new backup are not referenced until its manifest is
+        uploaded.
+        """
+        unused = self.unused_chunks(manifest_names)
+        self.backup.delete_names(unused)
+        self.existing_chunks.difference_update(
+            path.split('/', 1)[1] for path in unused)
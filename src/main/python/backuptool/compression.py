@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import functools
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Archive file extensions of the supported compression types
+EXTENSIONS = {
+    'none': 'tar',
+    'gzip': 'tar.gz',
+    'pgzip': 'tar.gz',
+    'zstd': 'tar.zst',
+    'lz4': 'tar.lz4'
+}
+
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'pgzip': 6,
+    'zstd': 3,
+    'lz4': 0
+}
+
+
+class CompressionError(Exception):
+    """Exception class for throwing CompressionError exceptions"""
+    pass
+
+
+class ParallelBlockWriter(object):
+    """Block parallel compression
+
+    The written data is split into blocks which are compressed concurrently
+    with the given function into independent gzip members (zstd or lz4
+    frames). Concatenated members (frames) are a valid compressed file, so
+    the result could be read by any reader of the format. The compressors
+    release the GIL, so threads are sufficient to use multiple cores. At
+    most two blocks per thread are held in memory.
+
+    The (uncompressed offset, compressed offset) of every block is recorded
+    in blocks, decompression could start at each of them. The initializer
+    is called in every worker thread (e.g. to lower its priority).
+    """
+
+    def __init__(self, fileobj, compress, threads=None,
+                 block_size=1024 * 1024, initializer=None):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.threads,
+                                           initializer=initializer)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.blocks = []
+        self.offset = 0
+        self.compressed_offset = 0
+        self.closed = False
+
+    def write(self, data):
+        """Buffer the data and compress every completed block"""
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        """Compress the block in the background, keep the order of blocks"""
+        self.pending.append((self.offset,
+                             self.executor.submit(self.compress, block)))
+        self.offset += len(block)
+        while len(self.pending) > self.threads * 2:
+            self._write_next()
+
+    def _write_next(self):
+        """Write the oldest compressed block to the file object"""
+        offset, future = self.pending.popleft()
+        data = future.result()
+        self.blocks.append([offset, self.compressed_offset])
+        self.fileobj.write(data)
+        self.compressed_offset += len(data)
+
+    def flush(self):
+        """Nothing to do, only completed blocks are written"""
+        pass
+
+    def close(self):
+        """Compress the remaining data, the file object stays open"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                del self.buffer[:]
+            while self.pending:
+                self._write_next()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ParallelGzipWriter(ParallelBlockWriter):
+    """Block parallel gzip compression (like pigz)"""
+
+    def __init__(self, fileobj, level=6, threads=None,
+                 block_size=1024 * 1024, initializer=None):
+        super(ParallelGzipWriter, self).__init__(
+            fileobj, functools.partial(gzip.compress, compresslevel=level,
+                                       mtime=0),
+            threads, block_size, initializer)
+
+
+class _PassThroughWriter(object):
+    """Writer without compression, which leaves the file object open"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        # Every offset is a block boundary
+        self.blocks = None
+
+    def write(self, data):
+        """Write the data as it is"""
+        return self.fileobj.write(data)
+
+    def flush(self):
+        """Nothing to do, the data is written directly"""
+        pass
+
+    def close(self):
+        """Nothing to do, the file object stays open"""
+        pass
+
+
+def _import_zstandard():
+    """Import the optional zstandard module"""
+    try:
+        import zstandard
+    except ImportError:
+        raise CompressionError('Compression "zstd" needs the zstandard module')
+    return zstandard
+
+
+def _import_lz4():
+    """Import the optional lz4 module"""
+    try:
+        import lz4.frame
+    except ImportError:
+        raise CompressionError('Compression "lz4" needs the lz4 module')
+    return lz4.frame
+
+
+def check_compression(compression):
+    """Raise a CompressionError, if the compression type is not usable"""
+    if compression not in EXTENSIONS:
+        raise CompressionError(
+            'Compression "{0}" is not supported'.format(compression))
+    if compression == 'zstd':
+        _import_zstandard()
+    elif compression == 'lz4':
+        _import_lz4()
+
+
+def compression_by_name(name):
+    """Return the compression type of the given backup file name"""
+    for extension in ['.gpg', '.aes']:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    if name.endswith('.tar.zst'):
+        return 'zstd'
+    if name.endswith('.tar.lz4'):
+        return 'lz4'
+    if name.endswith('.tar'):
+        return 'none'
+    return 'gzip'
+
+
+def file_extension(compression):
+    """Return the file extension of a single compressed file"""
+    return EXTENSIONS[compression][len('tar'):]
+
+
+def split_extension(name):
+    """Split a file name into its base name and its compression type"""
+    for compression in ['gzip', 'zstd', 'lz4']:
+        extension = file_extension(compression)
+        if name.endswith(extension):
+            return name[:-len(extension)], compression
+    return name, 'none'
+
+
+def _block_compressor(compression, level):
+    """Return a function which compresses a block into a complete frame"""
+    if compression in ['gzip', 'pgzip']:
+        return functools.partial(gzip.compress, compresslevel=level,
+                                 mtime=0)
+    if compression == 'zstd':
+        zstandard = _import_zstandard()
+
+        def compress(block):
+            # Compressor objects must not be shared between threads
+            return zstandard.ZstdCompressor(level=level).compress(block)
+        return compress
+    return functools.partial(_import_lz4().compress, compression_level=level)
+
+
+def open_writer(fileobj, compression='gzip', level=None, threads=0,
+                blocks=False, initializer=None):
+    """Return a file object which writes compressed data into fileobj
+
+    Closing the returned file object finishes the compression, but does not
+    close fileobj. A thread count of 0 uses all available cores. With
+    blocks the data is compressed in independent blocks, the returned
+    writer records them in its blocks attribute. The initializer is called
+    in the worker threads of block parallel compression.
+    """
+    check_compression(compression)
+    threads = threads or os.cpu_count() or 1
+    if level is None:
+        level = DEFAULT_LEVELS.get(compression)
+    if compression == 'none':
+        return _PassThroughWriter(fileobj)
+    if blocks:
+        return ParallelBlockWriter(fileobj,
+                                   _block_compressor(compression, level),
+                                   threads, initializer=initializer)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='wb',
+                             compresslevel=level, mtime=0)
+    if compression == 'pgzip':
+        return ParallelGzipWriter(fileobj, level, threads,
+                                  initializer=initializer)
+    if compression == 'zstd':
+        zstandard = _import_zstandard()
+        compressor = zstandard.ZstdCompressor(level=level,
+                                              threads=threads)
+        return compressor.stream_writer(fileobj, closefd=False)
+    lz4_frame = _import_lz4()
+    return lz4_frame.LZ4FrameFile(fileobj, mode='wb',
+                                  compression_level=level)
+
+
+def open_reader(fileobj, compression='gzip'):
+    """Return a file object which reads the decompressed data of fileobj
+
+    The file object does not need to be seekable, so this works on streams.
+    """
+    check_compression(compression)
+    if compression == 'none':
+        return fileobj
+    if compression in ['gzip', 'pgzip']:
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compression == 'zstd':
+        zstandard = _import_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True, closefd=False)
+    return _import_lz4().LZ4FrameFile(fileobj, mode='rb')
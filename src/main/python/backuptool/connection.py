@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import atexit
+import threading
+
+from functools import wraps
+
+
+class ConnectionPool(object):
+    """Per process pool of connections to ftp and sftp servers
+
+    Connections are keyed by (protocol, host, port, user), so all backups
+    and operations of a process which go to the same account share them
+    instead of doing a handshake each. A connection is only used by one
+    backup at a time, it is checked before it is handed out again and
+    replaced, if it is broken. Idle connections get a keepalive every
+    keepalive seconds (the interval of the connection), so the server does
+    not close them between two backups.
+
+    Connections inherited from a parent process (e.g. by the workers of
+    the scheduler) are dropped without closing them, they belong to the
+    parent.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.thread = None
+
+    def _check_process(self):
+        """Forget the connections of the parent after a fork"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle = {}
+            self.thread = None
+
+    def acquire(self, key, connect):
+        """Return a healthy idle connection for key or connect()"""
+        while True:
+            with self.lock:
+                self._check_process()
+                connections = self.idle.get(key)
+                if not connections:
+                    break
+                connection = connections.pop()
+            if connection.is_healthy():
+                return connection
+            connection.close()
+        return connect()
+
+    def release(self, key, connection):
+        """Give a connection back for the next user"""
+        with self.lock:
+            self._check_process()
+            connection.last_used = time.time()
+            self.idle.setdefault(key, []).append(connection)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._keep_alive)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _keep_alive(self):
+        """Send keepalives over idle connections every second"""
+        while True:
+            time.sleep(1)
+            if not self.send_keepalives():
+                return
+
+    def send_keepalives(self):
+        """Send keepalives over idle connections, drop broken ones
+
+        The due connections are taken out of the pool while their keepalive
+        is sent, so a slow server never blocks acquire() and release() of
+        the others. Returns False in a forked child, which has no
+        connections of its own.
+        """
+        due = []
+        with self.lock:
+            if self.pid != os.getpid():
+                return False
+            now = time.time()
+            for key, connections in self.idle.items():
+                for connection in list(connections):
+                    if now - connection.last_used >= connection.keepalive:
+                        connections.remove(connection)
+                        due.append((key, connection))
+        for key, connection in due:
+            connection.last_used = time.time()
+            try:
+                connection.send_keepalive()
+            except Exception:
+                connection.close()
+                continue
+            with self.lock:
+                if self.pid != os.getpid():
+                    return False
+                self.idle.setdefault(key, []).append(connection)
+        return True
+
+    def close_all(self):
+        """Close all idle connections"""
+        with self.lock:
+            self._check_process()
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+POOL = ConnectionPool()
+atexit.register(POOL.close_all)
+
+
+class Connection(object):
+    """Base of a pooled connection
+
+    Child classes open the connection on creation and implement the
+    health check, the keepalive and the close.
+    """
+
+    def __init__(self, keepalive=30):
+        self.keepalive = keepalive
+        self.last_used = time.time()
+
+    def is_healthy(self):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def send_keepalive(self):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def close(self):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+
+def reconnecting(retry=True):
+    """Decorator which replaces a broken connection after an error
+
+    If an operation fails and the connection of the backup does not pass
+    the health check anymore, a new connection is made and the operation
+    is repeated once. Operations on streams can not be repeated, with retry
+    False only the connection is replaced for the next operation.
+    """
+    def decorator(original_function):
+        @wraps(original_function)
+        def new_function(self, *args, **kwargs):
+            try:
+                return original_function(self, *args, **kwargs)
+            except Exception:
+                if self.connection is None or \
+                        self.connection.is_healthy():
+                    raise
+                self.reconnect()
+                if not retry:
+                    raise
+            return original_function(self, *args, **kwargs)
+        return new_function
+    return decorator
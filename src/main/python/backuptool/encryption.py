@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import struct
+import binascii
+import threading
+import subprocess
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# File extensions of the supported encryption types
+EXTENSIONS = {
+    'gpg': 'gpg',
+    'aes-gcm': 'aes'
+}
+
+AESGCM_MAGIC = b'backuptool-aesgcm'
+AESGCM_VERSION = 1
+AESGCM_TAG_SIZE = 16
+AESGCM_SALT_SIZE = 32
+AESGCM_HEADER_SIZE = len(AESGCM_MAGIC) + 5 + AESGCM_SALT_SIZE
+
+
+class EncryptionError(Exception):
+    """Exception class for throwing EncryptionError exceptions"""
+    pass
+
+
+class DecryptionError(Exception):
+    """Exception class for throwing DecryptionError exceptions"""
+    pass
+
+
+def _import_aesgcm():
+    """Import the optional cryptography module"""
+    try:
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise EncryptionError(
+            'Encryption "aes-gcm" needs the cryptography module')
+    return hashes, HKDF, AESGCM
+
+
+def check_encryption(encryption):
+    """Raise an EncryptionError, if the encryption type is not usable"""
+    if encryption not in EXTENSIONS:
+        raise EncryptionError(
+            'Encryption "{0}" is not supported'.format(encryption))
+    if encryption == 'aes-gcm':
+        _import_aesgcm()
+
+
+def encryption_by_name(name):
+    """Return the encryption type of the given file name or None"""
+    for encryption, extension in EXTENSIONS.items():
+        if name.endswith('.{0}'.format(extension)):
+            return encryption
+    return None
+
+
+def strip_extension(name):
+    """Return the file name without its encryption extension"""
+    encryption = encryption_by_name(name)
+    if encryption is None:
+        return name
+    return name[:-len(EXTENSIONS[encryption]) - 1]
+
+
+class _ProcessWriter(object):
+    """Writer which pipes the data through a subprocess into fileobj
+
+    The output of the process is copied into fileobj by a thread, so the
+    process never blocks on a full pipe. Closing the writer waits for the
+    process, but does not close fileobj.
+    """
+
+    def __init__(self, cmd, fileobj, error_class, message):
+        self.fileobj = fileobj
+        self.error_class = error_class
+        self.message = message
+        self.error = None
+        self.closed = False
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._copy_output)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _copy_output(self):
+        """Copy the output of the process into the file object"""
+        for data in iter(lambda: self.process.stdout.read(65536), b''):
+            if self.error is not None:
+                # Keep draining, so the process does not block
+                continue
+            try:
+                self.fileobj.write(data)
+            except Exception as error:
+                self.error = error
+        self.process.stdout.close()
+
+    def write(self, data):
+        """Feed the data into the process"""
+        self.process.stdin.write(data)
+        return len(data)
+
+    def flush(self):
+        """Nothing to do, the process gets the data directly"""
+        pass
+
+    def close(self):
+        """Wait for the process and raise its errors"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.process.stdin.close()
+        finally:
+            self.thread.join()
+            return_code = self.process.wait()
+        if self.error is not None:
+            raise self.error
+        if return_code != 0:
+            raise self.error_class(self.message)
+
+
+class _ChunkedWriter(object):
+    """Base of writers which transform fixed size chunks concurrently
+
+    Written data is split into chunks of chunk_size, which are transformed
+    in a thread pool and written in order to fileobj. A chunk is only
+    transformed once more data follows it (or on close), so the last chunk
+    is always known. At most two chunks per thread are held in memory.
+    """
+
+    def __init__(self, fileobj, chunk_size, threads=None):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.counter = 0
+        self.closed = False
+
+    def write(self, data):
+        """Buffer the data and transform every chunk followed by more data"""
+        self.buffer.extend(data)
+        while len(self.buffer) > self.chunk_size:
+            self._submit(bytes(self.buffer[:self.chunk_size]), False)
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def _submit(self, chunk, final):
+        """Transform the chunk in the background, keep the order"""
+        self.pending.append(self.executor.submit(self.transform, chunk,
+                                                 self.counter, final))
+        self.counter += 1
+        while len(self.pending) > self.threads * 2:
+            self._write_next()
+
+    def _write_next(self):
+        """Write the oldest transformed chunk to the file object"""
+        self.fileobj.write(self.pending.popleft().result())
+
+    def transform(self, chunk, counter, final):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def flush(self):
+        """Nothing to do, only completed chunks are written"""
+        pass
+
+    def finish(self):
+        """Transform the remaining data as the final chunk"""
+        self._submit(bytes(self.buffer), True)
+        del self.buffer[:]
+
+    def close(self):
+        """Write the remaining data, the file object stays open"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.finish()
+            while self.pending:
+                self._write_next()
+        finally:
+            self.executor.shutdown()
+
+
+def _nonce(counter, final):
+    """Return the nonce of a chunk: 11 bytes counter and the final flag"""
+    return struct.pack('>QxxxB', counter, 1 if final else 0)
+
+
+def _parse_header(header, key):
+    """Return the chunk size and the aead instance of an aes-gcm header"""
+    if len(header) != AESGCM_HEADER_SIZE or \
+            not header.startswith(AESGCM_MAGIC):
+        raise DecryptionError('Not an aes-gcm encrypted backup')
+    version, chunk_size = struct.unpack(
+        '>BI', header[len(AESGCM_MAGIC):len(AESGCM_MAGIC) + 5])
+    if version != AESGCM_VERSION:
+        raise DecryptionError('Unsupported aes-gcm format version')
+    return chunk_size, AESGCMCipher.derive(key, header[-AESGCM_SALT_SIZE:])
+
+
+def _decrypt_chunk(aead, header, chunk, counter, final):
+    """Verify and decrypt a single chunk"""
+    from cryptography.exceptions import InvalidTag
+    try:
+        return aead.decrypt(_nonce(counter, final), chunk, header)
+    except InvalidTag:
+        raise DecryptionError('Backup is corrupted, truncated or '
+                              'encrypted with another key')
+
+
+class _AESGCMEncryptor(_ChunkedWriter):
+    """Writer which encrypts into the chunked aes-gcm format"""
+
+    def __init__(self, fileobj, key, chunk_size, threads=None):
+        super(_AESGCMEncryptor, self).__init__(fileobj, chunk_size, threads)
+        salt = os.urandom(AESGCM_SALT_SIZE)
+        self.header = AESGCM_MAGIC + struct.pack(
+            '>BI', AESGCM_VERSION, chunk_size) + salt
+        self.aead = AESGCMCipher.derive(key, salt)
+        self.fileobj.write(self.header)
+
+    def transform(self, chunk, counter, final):
+        """Encrypt and authenticate the chunk together with the header"""
+        return self.aead.encrypt(_nonce(counter, final), chunk, self.header)
+
+
+class _AESGCMDecryptor(_ChunkedWriter):
+    """Writer which decrypts the chunked aes-gcm format into fileobj"""
+
+    def __init__(self, fileobj, key, threads=None):
+        # The chunk size is only known after the header was read
+        super(_AESGCMDecryptor, self).__init__(fileobj, None, threads)
+        self.key = key
+        self.header = None
+        self.aead = None
+
+    def write(self, data):
+        """Parse the header first, then decrypt the chunks"""
+        if self.header is not None:
+            return super(_AESGCMDecryptor, self).write(data)
+        self.buffer.extend(data)
+        if len(self.buffer) < AESGCM_HEADER_SIZE:
+            return len(data)
+        header = bytes(self.buffer[:AESGCM_HEADER_SIZE])
+        del self.buffer[:AESGCM_HEADER_SIZE]
+        chunk_size, self.aead = _parse_header(header, self.key)
+        self.header = header
+        self.chunk_size = chunk_size + AESGCM_TAG_SIZE
+        super(_AESGCMDecryptor, self).write(b'')
+        return len(data)
+
+    def transform(self, chunk, counter, final):
+        """Verify and decrypt the chunk"""
+        return _decrypt_chunk(self.aead, self.header, chunk, counter, final)
+
+    def finish(self):
+        """Decrypt the final chunk, which has to exist"""
+        if self.header is None:
+            raise DecryptionError('Backup is truncated')
+        super(_AESGCMDecryptor, self).finish()
+
+
+class Cipher(object):
+    """Parent class of the encryption types
+
+    encryptor() and decryptor() return stream stages: writers which
+    transform the written data into the given file object, so they could be
+    put in front of any target of a pipeline. Closing a stage finishes it,
+    but leaves the file object open.
+    """
+
+    def encryptor(self, fileobj):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def decryptor(self, fileobj):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def _run_stage(self, stage, data):
+        """Run the given data through a stage and return the result"""
+        output = io.BytesIO()
+        writer = stage(output)
+        try:
+            writer.write(data)
+        finally:
+            writer.close()
+        return output.getvalue()
+
+    def encrypt(self, data):
+        """Return the encrypted data"""
+        return self._run_stage(self.encryptor, data)
+
+    def decrypt(self, data):
+        """Return the decrypted data"""
+        return self._run_stage(self.decryptor, data)
+
+
+class GPGCipher(Cipher):
+    """Public key encryption with gpg
+
+    gpg's own compression is disabled, as the archives are compressed
+    already. The symmetric cipher of the message could be chosen.
+    """
+
+    def __init__(self, config):
+        self.key_id = config.get('gpg_key_id')
+        self.cipher_algo = config.get('gpg_cipher', 'AES256')
+
+    def encryptor(self, fileobj):
+        """Return a writer which encrypts into fileobj with gpg"""
+        if not self.key_id:
+            raise EncryptionError('gpg_key_id is needed for encryption')
+        cmd = [
+            'gpg', '--batch', '--yes', '--trust-model', 'always',
+            '--cipher-algo', self.cipher_algo, '--compress-algo', 'none',
+            '--recipient', self.key_id, '--encrypt'
+        ]
+        return _ProcessWriter(cmd, fileobj, EncryptionError,
+                              'GPG encryption was not successfull!')
+
+    def decryptor(self, fileobj):
+        """Return a writer which decrypts into fileobj with gpg"""
+        cmd = ['gpg', '--batch', '--yes', '--decrypt']
+        return _ProcessWriter(cmd, fileobj, DecryptionError,
+                              'Unable to decrypt backup file')
+
+
+class AESGCMCipher(Cipher):
+    """Symmetric, chunked AES-256-GCM encryption
+
+    The file starts with a header (magic, version, chunk size and a random
+    salt). The key of the file is derived from the configured key and the
+    salt with HKDF-SHA256, every chunk is encrypted with a nonce of its
+    number and a flag for the last chunk, which authenticates the order and
+    the end of the chunks. Chunks are en- and decrypted concurrently.
+    """
+
+    def __init__(self, config):
+        _import_aesgcm()
+        self.chunk_size = config.get('encryption_chunk_size', 1024 * 1024)
+        self.threads = config.get('encryption_threads', 0)
+        key_file = config.get('encryption_key_file')
+        if not key_file:
+            raise EncryptionError('encryption_key_file is needed for aes-gcm')
+        self.key = self.read_key(key_file)
+
+    @staticmethod
+    def read_key(key_file):
+        """Read a 256 bit key, given as 32 raw bytes or as hex string"""
+        try:
+            with open(key_file, 'rb') as key_fileobj:
+                key = key_fileobj.read()
+        except (IOError, OSError) as error:
+            raise EncryptionError('Unable to read key file: {0}'.format(error))
+        if len(key.strip()) == 64:
+            try:
+                key = binascii.unhexlify(key.strip())
+            except (TypeError, ValueError):
+                pass
+        if len(key) != 32:
+            raise EncryptionError('Key file has to contain a 256 bit key')
+        return key
+
+    @staticmethod
+    def derive(key, salt):
+        """Return the aead instance for the key of a single file"""
+        hashes, HKDF, AESGCM = _import_aesgcm()
+        file_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt,
+                        info=AESGCM_MAGIC).derive(key)
+        return AESGCM(file_key)
+
+    def encryptor(self, fileobj):
+        """Return a writer which encrypts into fileobj"""
+        return _AESGCMEncryptor(fileobj, self.key, self.chunk_size,
+                                self.threads)
+
+    def decryptor(self, fileobj):
+        """Return a writer which decrypts into fileobj"""
+        return _AESGCMDecryptor(fileobj, self.key, self.threads)
+
+    def plain_reader(self, read, size):
+        """Return a reader of ranges of the plain data of an encrypted file
+
+        read is a function returning length bytes of the encrypted file of
+        the given size from offset on (like Backup.read_range()).
+        """
+        return _AESGCMRangeReader(self.key, read, size)
+
+
+class _AESGCMRangeReader(object):
+    """Read ranges of the plain data of an aes-gcm encrypted file
+
+    Only the chunks around a range are read and decrypted.
+    """
+
+    def __init__(self, key, read, size):
+        self.read_encrypted = read
+        self.header = read(0, AESGCM_HEADER_SIZE)
+        self.chunk_size, self.aead = _parse_header(self.header, key)
+        self.frame_size = self.chunk_size + AESGCM_TAG_SIZE
+        self.chunks = max(-(-(size - AESGCM_HEADER_SIZE) //
+                            self.frame_size), 1)
+        self.encrypted_size = size
+        self.size = size - AESGCM_HEADER_SIZE - \
+            self.chunks * AESGCM_TAG_SIZE
+
+    def read(self, offset, length):
+        """Return length bytes of the plain data from offset on"""
+        length = min(length, self.size - offset)
+        if length <= 0:
+            return b''
+        first = offset // self.chunk_size
+        last = (offset + length - 1) // self.chunk_size
+        start = AESGCM_HEADER_SIZE + first * self.frame_size
+        end = min(AESGCM_HEADER_SIZE + (last + 1) * self.frame_size,
+                  self.encrypted_size)
+        data = self.read_encrypted(start, end - start)
+        plain = []
+        for counter in range(first, last + 1):
+            position = (counter - first) * self.frame_size
+            plain.append(_decrypt_chunk(
+                self.aead, self.header,
+                data[position:position + self.frame_size], counter,
+                counter == self.chunks - 1))
+        skip = offset - first * self.chunk_size
+        return b''.join(plain)[skip:skip + length]
+
+
+CIPHERS = {
+    'gpg': GPGCipher,
+    'aes-gcm': AESGCMCipher
+}
+
+
+def open_cipher(encryption, config):
+    """Return the cipher of the given encryption type"""
+    check_encryption(encryption)
+    return CIPHERS[encryption](config)
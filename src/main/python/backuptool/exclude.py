@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import re
+import stat
+
+
+def translate_pattern(pattern):
+    """Translate a gitignore style pattern into a regular expression
+
+    Patterns without a slash match the name of a file or directory at any
+    depth, patterns starting with a slash match the absolute path and other
+    patterns with a slash match the end of a path. '*' and '?' do not match
+    a slash, '**' matches across directories.
+    """
+    if pattern.startswith('/'):
+        prefix = '^/'
+        pattern = pattern.lstrip('/')
+    else:
+        prefix = '(?:^|/)'
+    result = ''
+    position = 0
+    while position < len(pattern):
+        character = pattern[position]
+        if pattern.startswith('**/', position):
+            result += '(?:.*/)?'
+            position += 3
+            continue
+        if pattern.startswith('**', position):
+            result += '.*'
+            position += 2
+            continue
+        if character == '*':
+            result += '[^/]*'
+        elif character == '?':
+            result += '[^/]'
+        elif character == '[':
+            end = pattern.find(']', position + 2)
+            if end < 0:
+                result += re.escape(character)
+            else:
+                content = pattern[position + 1:end].replace('\\', '\\\\')
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                result += '[{0}]'.format(content)
+                position = end
+        else:
+            result += re.escape(character)
+        position += 1
+    return '{0}{1}$'.format(prefix, result)
+
+
+class ExcludeMatcher(object):
+    """Decide which files and directories are left out of the backup
+
+    The gitignore style patterns are compiled once. Without negated
+    patterns ('!pattern') all patterns are combined into a single regular
+    expression, otherwise the last matching pattern wins like in git.
+    Patterns with a trailing slash only match directories. Excluded
+    directories are pruned by the walk, so their content is never read.
+    """
+
+    def __init__(self, patterns=None, max_file_size=None,
+                 skip_special_files=False):
+        self.max_file_size = max_file_size
+        self.skip_special_files = skip_special_files
+        self.rules = []
+        for pattern in patterns or []:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+            directory_only = pattern.endswith('/')
+            regex = translate_pattern(pattern.rstrip('/'))
+            self.rules.append((regex, negate, directory_only))
+        self.any_regex = None
+        self.directory_regex = None
+        if not any(negate for _, negate, _ in self.rules):
+            self.any_regex = self._combine(
+                [regex for regex, _, directory_only in self.rules
+                 if not directory_only])
+            self.directory_regex = self._combine(
+                [regex for regex, _, directory_only in self.rules
+                 if directory_only])
+        else:
+            self.rules = [(re.compile(regex), negate, directory_only)
+                          for regex, negate, directory_only in self.rules]
+        self.pruned_files = 0
+        self.pruned_directories = 0
+        self.pruned_bytes = 0
+
+    @staticmethod
+    def _combine(regexes):
+        """Compile the given regular expressions into a single one"""
+        if not regexes:
+            return None
+        return re.compile('|'.join('(?:{0})'.format(regex)
+                                   for regex in regexes))
+
+    def matches(self, path, is_directory):
+        """Check if the path matches the exclude patterns"""
+        if self.any_regex is not None or self.directory_regex is not None:
+            if self.any_regex is not None and self.any_regex.search(path):
+                return True
+            return bool(is_directory and self.directory_regex is not None and
+                        self.directory_regex.search(path))
+        for regex, negate, directory_only in reversed(self.rules):
+            if directory_only and not is_directory:
+                continue
+            if regex.search(path):
+                return not negate
+        return False
+
+    def excludes(self, path, stats):
+        """Check if the path is excluded and count it, if so"""
+        mode = stats.st_mode
+        is_directory = stat.S_ISDIR(mode)
+        excluded = self.matches(path, is_directory)
+        if not excluded and stat.S_ISREG(mode):
+            excluded = (self.max_file_size is not None and
+                        stats.st_size > self.max_file_size)
+        elif not excluded and not is_directory and not stat.S_ISLNK(mode):
+            excluded = self.skip_special_files
+        if excluded:
+            if is_directory:
+                self.pruned_directories += 1
+            else:
+                self.pruned_files += 1
+                if stat.S_ISREG(mode):
+                    self.pruned_bytes += stats.st_size
+        return excluded
@@ -5,6 +5,9 @@ import time
 import shutil
 
 from .backup import Backup
+from .archiveindex import INDEX_SUFFIX
+from .filecopy import copy_file, fsync_directory
+from .transfer import file_checksum
 
 
 class FileBackup(Backup):
@@ -14,22 +17,126 @@ class FileBackup(Backup):
         super(FileBackup, self).__init__(*args, **kwargs)
         self.backup_dir = '/{0}'.format(self.config['target'].split('//')[1])
         self.existing_backup_files = []
+        self.blocksize = self.config.get('blocksize', 1024 * 1024)
+        self.copy_method = self.config.get('file_copy_method', 'auto')
+        self.fsync = self.config.get('file_fsync', True)
         self.set_existing_backups()
 
     def set_existing_backups(self):
         """Set a list of all existing backups entries"""
         if not os.path.isdir(self.backup_dir):
             raise NameError('configured backup directory does not exist')
-        self.existing_backup_files = os.listdir(self.backup_dir)
+        # Hidden files are incomplete copies, indexes belong to a backup
+        self.existing_backup_files = [
+            entry for entry in os.listdir(self.backup_dir)
+            if os.path.isfile('{0}/{1}'.format(self.backup_dir, entry)) and
+            not entry.startswith('.') and not entry.endswith(INDEX_SUFFIX)
+        ]
         self.existing_backup_files.sort()
 
-    def upload(self):
-        """Copy the created backup file to the configured target"""
-        if self.encrypt:
-            filename_abs = '{0}.gpg'.format(self.filename_abs)
-        else:
-            filename_abs = self.filename_abs
-        shutil.copy(filename_abs, '/{0}/'.format(self.backup_dir))
+    def partial_path(self, name):
+        """Return the path a file is written to until it is complete"""
+        directory, filename = os.path.split(name)
+        return os.path.join(self.backup_dir, directory,
+                            '.{0}.part'.format(filename))
+
+    def commit_file(self, partial_path, path):
+        """Give a completely written file its final name"""
+        os.rename(partial_path, path)
+        if self.fsync:
+            fsync_directory(os.path.dirname(path))
+
+    def upload_fileobj(self, fileobj, name, offset=0):
+        """Write the content of the given file object to the target
+
+        The data is written to a hidden partial file, which is renamed
+        after it is complete. So a crash never leaves a truncated backup.
+        With an offset the partial file is written from this position on,
+        fileobj has to be positioned at the same offset already.
+        """
+        partial_path = self.partial_path(name)
+        fileobj = self.upload_throttle.reader(fileobj)
+        with open(partial_path, 'r+b' if offset else 'wb') as target:
+            target.seek(offset)
+            target.truncate()
+            shutil.copyfileobj(fileobj, target, self.blocksize)
+            target.flush()
+            if self.fsync:
+                os.fsync(target.fileno())
+        self.commit_file(partial_path, '{0}/{1}'.format(self.backup_dir, name))
+
+    def resume_upload(self, path, name, journal):
+        """Copy the file to the target with the fastest available method
+
+        A partial copy of an interrupted run is continued, if the last
+        complete chunk of it matches the source.
+        """
+        partial_path = self.partial_path(name)
+        size = os.path.getsize(path)
+        offset = self.resume_offset(path, partial_path)
+        if offset:
+            print('Resuming upload of {0} at byte {1}'.format(name, offset))
+        journal.save({
+            'direction': 'upload',
+            'name': name,
+            'path': path,
+            'size': size
+        })
+        if self.upload_throttle.buckets:
+            # The kernel copy methods could not be rate limited
+            with open(path, 'rb') as source:
+                source.seek(offset)
+                self.upload_fileobj(source, name, offset)
+            return
+        copy_file(path, partial_path, self.copy_method, offset, self.fsync)
+        self.commit_file(partial_path, '{0}/{1}'.format(self.backup_dir, name))
+
+    def resume_download(self, name, path, journal):
+        """Copy the backup to the working directory, which is local, too
+
+        The copy is kept in the state directory if it fails, the next
+        download continues it like an interrupted upload.
+        """
+        source_path = '{0}/{1}'.format(self.backup_dir, name)
+        size = os.path.getsize(source_path)
+        state = journal.load()
+        pending_path = self.pending_path(name)
+        offset = 0
+        if (state and state['direction'] == 'download' and
+                state['name'] == name and state['size'] == size and
+                os.path.isfile(pending_path)):
+            shutil.move(pending_path, path)
+            offset = self.resume_offset(source_path, path)
+        if offset:
+            print('Resuming download of {0} at byte {1}'.format(name, offset))
+        journal.save({
+            'direction': 'download',
+            'name': name,
+            'path': path,
+            'size': size
+        })
+        copy_file(source_path, path, self.copy_method, offset, fsync=False)
+
+    def resume_offset(self, source_path, partial_path):
+        """Return the offset a partial copy of source_path is continued at
+
+        Only complete chunks count, the last of them has to match the
+        source, else the copy starts over.
+        """
+        if not os.path.isfile(partial_path):
+            return 0
+        chunk_size = self.transfer_chunk_size
+        offset = min(os.path.getsize(partial_path),
+                     os.path.getsize(source_path)) // chunk_size * chunk_size
+        if not offset:
+            return 0
+        with open(source_path, 'rb') as source:
+            expected = file_checksum(source, offset - chunk_size, chunk_size)
+        with open(partial_path, 'rb') as partial:
+            if file_checksum(partial, offset - chunk_size,
+                             chunk_size) != expected:
+                return 0
+        return offset
 
     def list(self):
         """List all available file backups"""
@@ -50,25 +157,54 @@ class FileBackup(Backup):
             print('{0}{1:<53}{2:<10}{3}'.format(tree_prefix, name, size, date))
         print('')
 
-    def rotate(self):
-        """Only keep the given amount of backup files and delete the rest"""
-        files = self.existing_backup_files
-        files.reverse()
-        files_to_be_deleted = files[self.rotation_num:]
-        for backup_file in files_to_be_deleted:
-            self.rmfile('{0}/{1}'.format(self.backup_dir, backup_file))
+    def backup_names(self, refresh=False):
+        """Return the names of all existing backups"""
+        if refresh:
+            self.set_existing_backups()
+        return list(self.existing_backup_files)
+
+    def list_names(self, directory):
+        """Return the names of all files in the given directory"""
+        return os.listdir('{0}/{1}'.format(self.backup_dir, directory))
+
+    def make_directory(self, directory):
+        """Create the given directory below the backup directory"""
+        self.create_directory('{0}/{1}'.format(self.backup_dir, directory))
 
     def delete(self, name):
-        """Delete the given backup file"""
+        """Delete the given backup file and a partial copy of it"""
         self.rmfile('{0}/{1}'.format(self.backup_dir, name))
+        self.rmfile(self.partial_path(name))
 
-    def download(self):
-        """Copy the newest backup to the temporary directory"""
+    def newest_backup(self):
+        """Return the name of the newest backup or None"""
         if not self.existing_backup_files:
-            return False
-        newest_backup = self.existing_backup_files[-1]
-        file_target = '{0}/{1}'.format(self.workdir, newest_backup)
-        file_source = '{0}/{1}'.format(self.backup_dir, newest_backup)
-        shutil.copy(file_source, file_target)
-        self.check_encryption_by_name(newest_backup)
-        return True
+            return None
+        return self.existing_backup_files[-1]
+
+    def download_fileobj(self, name, fileobj, offset=0):
+        """Write the content of the given backup into the file object"""
+        file_source = '{0}/{1}'.format(self.backup_dir, name)
+        with open(file_source, 'rb') as source:
+            source.seek(offset)
+            shutil.copyfileobj(source, fileobj, self.blocksize)
+
+    def existing_path(self, name):
+        """Return the path of the complete or else the partial file"""
+        file_path = '{0}/{1}'.format(self.backup_dir, name)
+        if os.path.isfile(file_path):
+            return file_path
+        return self.partial_path(name)
+
+    def remote_size(self, name):
+        """Return the size of the given file or None, if it not exists"""
+        file_path = self.existing_path(name)
+        if not os.path.isfile(file_path):
+            return None
+        return os.path.getsize(file_path)
+
+    def read_range(self, name, offset, length):
+        """Return length bytes of the given file from offset on"""
+        with open(self.existing_path(name), 'rb') as source:
+            source.seek(offset)
+            return source.read(length)
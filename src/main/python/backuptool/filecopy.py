@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import fcntl
+import shutil
+
+
+# ioctl request of linux to clone the extents of a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+COPY_METHODS = ['reflink', 'hardlink', 'copy_file_range', 'sendfile',
+                'stream']
+
+# Errors which only mean that a copy method is not supported for the given
+# files, so the next method is tried
+_UNSUPPORTED_ERRORS = set([
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EPERM,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP
+])
+
+
+class CopyError(Exception):
+    """Exception class for throwing CopyError exceptions"""
+    pass
+
+
+def _reflink(source, target, offset, size):
+    """Clone the extents of the source file (copy on write)"""
+    if offset:
+        raise OSError(errno.EINVAL, 'Reflinks clone whole files only')
+    fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+
+def _copy_file_range(source, target, offset, size):
+    """Copy inside the kernel, servers and filesystems could offload it"""
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    while offset < size:
+        copied = os.copy_file_range(source.fileno(), target.fileno(),
+                                    size - offset, offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+
+
+def _sendfile(source, target, offset, size):
+    """Copy inside the kernel without passing the data through python"""
+    target.seek(offset)
+    while offset < size:
+        sent = os.sendfile(target.fileno(), source.fileno(), offset,
+                           min(size - offset, 1024 * 1024 * 1024))
+        if sent == 0:
+            break
+        offset += sent
+
+
+def _stream(source, target, offset, size, blocksize=1024 * 1024):
+    """Copy block by block through userspace, works everywhere"""
+    source.seek(offset)
+    target.seek(offset)
+    shutil.copyfileobj(source, target, blocksize)
+
+
+_COPY_FUNCTIONS = {
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'stream': _stream
+}
+
+
+def fsync_directory(directory):
+    """Persist the directory entries (e.g. after a rename)"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_file(source_path, target_path, method='auto', offset=0,
+              fsync=True):
+    """Copy source_path to target_path and return the used method
+
+    With method 'auto' all methods are tried from the cheapest one on
+    (reflink, hardlink, copy_file_range, sendfile, stream) until one is
+    supported for the given files. With an offset the data in front of it
+    is expected to be in the target file already and only the rest is
+    copied, this excludes reflinks and hardlinks.
+    """
+    if method == 'auto':
+        methods = COPY_METHODS
+    elif method in COPY_METHODS:
+        methods = [method]
+    else:
+        raise CopyError('Copy method "{0}" is not supported'.format(method))
+    for candidate in methods:
+        try:
+            _copy_with(candidate, source_path, target_path, offset, fsync)
+            return candidate
+        except OSError as error:
+            if method != 'auto' or error.errno not in _UNSUPPORTED_ERRORS:
+                raise
+    raise CopyError('No copy method worked for {0}'.format(source_path))
+
+
+def _copy_with(method, source_path, target_path, offset, fsync):
+    """Copy the file with the given method"""
+    if method == 'hardlink':
+        if offset:
+            raise OSError(errno.EINVAL, 'Hardlinks link whole files only')
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+        os.link(source_path, target_path)
+        if fsync:
+            with open(target_path, 'rb') as target:
+                os.fsync(target.fileno())
+        return
+    size = os.path.getsize(source_path)
+    with open(source_path, 'rb') as source:
+        with open(target_path, 'r+b' if offset else 'wb') as target:
+            target.truncate(offset)
+            _COPY_FUNCTIONS[method](source, target, offset, size)
+            target.flush()
+            if fsync:
+                os.fsync(target.fileno())
@@ -1,9 +1,48 @@
 # -*- coding: utf-8 -*-
 
 import re
+import time
 import ftplib  # nosec
+import calendar
+import posixpath
 
 from .backup import Backup
+from .connection import POOL, Connection, reconnecting
+
+# 550 is the reply to a missing file, but also to a denied access, so only
+# replies with a text like this mean that the file is missing
+MISSING_FILE_REPLY = re.compile(
+    r"^550 .*(no such file|not found|does not exist|can'?t find)", re.I)
+
+
+class FTPConnection(Connection):
+    """Pooled control connection to an ftp server"""
+
+    def __init__(self, host, port, user, password, keepalive=30,
+                 timeout=None):
+        super(FTPConnection, self).__init__(keepalive)
+        self.ftp = ftplib.FTP(timeout=timeout)  # nosec
+        self.ftp.connect(host, port)
+        self.ftp.login(user, password)
+
+    def is_healthy(self):
+        """Check the connection with a NOOP"""
+        try:
+            self.ftp.voidcmd('NOOP')
+        except (EOFError, OSError, ftplib.Error):
+            return False
+        return True
+
+    def send_keepalive(self):
+        """Keep the idle connection open"""
+        self.ftp.voidcmd('NOOP')
+
+    def close(self):
+        """Log out, or just close the connection, if this fails"""
+        try:
+            self.ftp.quit()
+        except (EOFError, OSError, ftplib.Error):
+            self.ftp.close()
 
 
 class FTPBackup(Backup):
@@ -11,87 +50,221 @@ class FTPBackup(Backup):
 
     def __init__(self, *args, **kwargs):
         super(FTPBackup, self).__init__(*args, **kwargs)
-        self.ftp = None
-        self.existing_backup_files = []
+        self.connection = None
+        self.blocksize = self.config.get('ftp_blocksize', 8192)
+        self.pooling = self.config.get('connection_pooling', True)
+        self.keepalive = self.config.get('connection_keepalive', 30)
+        self.timeout = self.config.get('connection_timeout')
+        self.pipeline_depth = self.config.get('delete_pipeline_depth', 64)
+        match = re.search(r'ftp://([^:/]+):*([^/]*)', self.config['target'])
+        self.host = match.group(1)
+        self.port = int(match.group(2) or 21)
+        self.connection_key = ('ftp', self.host, self.port,
+                               self.config['ftp_user'])
         self.connect()
-        self.set_existing_backups()
 
     def __del__(self):
-        if self.ftp:
-            self.ftp.quit()
+        self.disconnect()
+
+    @property
+    def ftp(self):
+        """Return the ftplib object of the current connection"""
+        return self.connection.ftp
+
+    def open_connection(self):
+        """Log in to the configured ftp server"""
+        return FTPConnection(self.host, self.port, self.config['ftp_user'],
+                             self.config['ftp_password'], self.keepalive,
+                             self.timeout)
 
     def connect(self):
-        """Connect against the configured ftp server"""
-        match = re.search(r'ftp://([^:/]+):*([^/]*)', self.config['target'])
-        host = match.group(1)
-        port = 21
-        if match.group(2):
-            port = match.group(2)
-        self.ftp = ftplib.FTP()  # nosec
-        self.ftp.connect(host, port)
-        self.ftp.login(self.config['ftp_user'], self.config['ftp_password'])
-
-        self.ftp = ftplib.FTP(self.config['target'].split('//')[1])  # nosec
-        self.ftp.login(self.config['ftp_user'], self.config['ftp_password'])
-
-    def set_existing_backups(self):
-        """Set a list of all existing backups entries found on ftp server"""
-        existing_backup_listings = []
-        self.ftp.dir(existing_backup_listings.append)
-        self.existing_backup_files = []
-        for entry in existing_backup_listings:
-            pattern = r'^{0}-\d+.tar.gz(?:.gpg)?$'
-            pattern = pattern.format(self.filename_prefix)
-            if re.match(pattern, entry.split()[8]):
-                self.existing_backup_files.append(entry.split()[8])
-
-    def upload(self):
-        """Upload the composed (and encrypted) backup file"""
-        if self.encrypt:
-            filename = '{0}.gpg'.format(self.filename)
-            filename_abs = '{0}.gpg'.format(self.filename_abs)
+        """Take a connection to the ftp server from the pool
+
+        A new connection is only made, if there is no idle one.
+        """
+        if not self.pooling:
+            self.connection = self.open_connection()
+            return
+        self.connection = POOL.acquire(self.connection_key,
+                                       self.open_connection)
+
+    def reconnect(self):
+        """Replace a broken connection"""
+        connection, self.connection = self.connection, None
+        connection.close()
+        self.connect()
+
+    def disconnect(self):
+        """Give the connection back to the pool"""
+        connection, self.connection = getattr(self, 'connection',
+                                              None), None
+        if connection is None:
+            return
+        if self.pooling:
+            POOL.release(self.connection_key, connection)
         else:
-            filename = self.filename
-            filename_abs = self.filename_abs
-        self.ftp.storbinary("STOR " + filename, open(filename_abs, 'rb'), 1024)
+            connection.close()
+
+    def listing_key(self):
+        """Backups of the same ftp account share the listing"""
+        return self.connection_key
+
+    @reconnecting()
+    def fetch_entries(self, prefix):
+        """Return the entries of all files starting with the prefix
+
+        MLSD delivers machine readable sizes and modification times, the
+        LIST output is only parsed for servers without MLSD support.
+        """
+        try:
+            listing = list(self.ftp.mlsd(facts=['type', 'size', 'modify']))
+        except ftplib.error_perm:
+            return self.fetch_entries_by_list(prefix)
+        entries = []
+        for name, facts in listing:
+            if facts.get('type', 'file') != 'file':
+                continue
+            if not name.startswith(prefix):
+                continue
+            mtime = None
+            if 'modify' in facts:
+                mtime = calendar.timegm(time.strptime(
+                    facts['modify'][:14], '%Y%m%d%H%M%S'))
+            entries.append({
+                'name': name,
+                'size': int(facts.get('size', 0)),
+                'mtime': mtime,
+                'etag': None
+            })
+        return entries
+
+    def fetch_entries_by_list(self, prefix):
+        """Return the entries of all files found in the LIST output"""
+        lines = []
+        self.ftp.dir(lines.append)
+        entries = []
+        for line in lines:
+            fields = line.split(None, 8)
+            if len(fields) == 9 and fields[8].startswith(prefix):
+                entries.append({
+                    'name': fields[8],
+                    'size': int(fields[4]),
+                    'mtime': None,
+                    'etag': None
+                })
+        return entries
+
+    @reconnecting(retry=False)
+    def upload_fileobj(self, fileobj, name, offset=0):
+        """Upload the content of the given file object to the ftp server
+
+        With an offset the upload is resumed with REST, fileobj has to be
+        positioned at the same offset already. If reading fileobj fails,
+        the reply to the STOR is never read, so the connection is replaced.
+        """
+        fileobj = self.upload_throttle.reader(fileobj)
+        try:
+            self.ftp.storbinary("STOR " + name, fileobj, self.blocksize,
+                                rest=offset or None)
+        except Exception:
+            try:
+                self.reconnect()
+            except (EOFError, OSError, ftplib.Error):
+                # The original error is the relevant one
+                pass
+            raise
+        self.listing_changed(name)
 
     def list(self):
         """List all available backups on ftp server"""
-        print('{0} (FTP):'.format(self.name))
-        if not self.existing_backup_files:
-            print('  <no backups>\n')
-            return
-        for entry, more_items in self._lookahead(self.existing_backup_listings):
-            date = ' '.join(entry.split()[5:8])
-            size = '{0:.2f}MB'.format(float(entry.split()[4]) / 1024 / 1024)
-            name = entry.split()[8]
-            if more_items:
-                tree_prefix = '├─ '
-            else:
-                tree_prefix = '└─ '
-            print('{0}{1:<53}{2:<10}{3}'.format(tree_prefix, name, size, date))
-        print('')
-
-    def rotate(self):
-        """Only keep the given amount of backup files and delete the rest"""
-        files = sorted(self.existing_backup_files, reverse=True)
-        files_to_be_deleted = files[self.rotation_num:]
-        for backup_file in files_to_be_deleted:
-            self.ftp.delete(backup_file)
+        self.print_listing('FTP')
+
+    @reconnecting()
+    def list_names(self, directory):
+        """Return the names of all files in the given directory"""
+        try:
+            names = self.ftp.nlst(directory)
+        except ftplib.error_perm:
+            # Some servers answer with an error on empty directories
+            return []
+        return [posixpath.basename(name) for name in names]
+
+    @reconnecting()
+    def make_directory(self, directory):
+        """Create the given directory on the ftp server, if not exist"""
+        try:
+            self.ftp.mkd(directory)
+        except ftplib.error_perm:
+            pass
 
+    @reconnecting()
     def delete(self, name):
         """Delete the given backup file from ftp server"""
         self.ftp.delete(name)
+        self.listing_changed(name, deleted=True)
 
-    def download(self):
-        """Download the newest backup from ftp server"""
-        if not self.existing_backup_files:
-            return False
-        newest_backup = self.existing_backup_files[-1]
-        file_target = '{0}/{1}'.format(self.workdir, newest_backup)
-        with open(file_target, 'wb') as target:
-            def callback(data):
-                target.write(data)
-            self.ftp.retrbinary("RETR " + newest_backup, callback)
-        self.check_encryption_by_name(newest_backup)
-        return True
+    @reconnecting(retry=False)
+    def delete_names(self, names, ignore_missing=False):
+        """Delete the given files with pipelined DELE commands
+
+        Up to delete_pipeline_depth commands are sent before their replies
+        are read, so the deletes do not wait for a round trip each. All
+        replies are read before the first error (e.g. a missing file, if
+        not ignore_missing) is raised.
+        """
+        error = None
+        for start in range(0, len(names), self.pipeline_depth):
+            batch = names[start:start + self.pipeline_depth]
+            for name in batch:
+                self.ftp.putcmd('DELE ' + name)
+            for name in batch:
+                try:
+                    self.ftp.voidresp()
+                except ftplib.Error as reply:
+                    # The other replies are read anyway, so the next
+                    # command gets its own reply
+                    missing = bool(MISSING_FILE_REPLY.match(str(reply)))
+                    if error is None and not (ignore_missing and missing):
+                        error = reply
+                    continue
+                self.listing_changed(name, deleted=True)
+        if error is not None:
+            raise error
+
+    @reconnecting(retry=False)
+    def download_fileobj(self, name, fileobj, offset=0):
+        """Write the content of the given backup into the file object"""
+        self.ftp.retrbinary("RETR " + name, fileobj.write, self.blocksize,
+                            rest=offset or None)
+
+    @reconnecting()
+    def remote_size(self, name):
+        """Return the size of the given file or None, if it not exists"""
+        try:
+            # SIZE is only reliable in binary mode
+            self.ftp.voidcmd('TYPE I')
+            return self.ftp.size(name)
+        except ftplib.error_perm:
+            return None
+
+    @reconnecting()
+    def read_range(self, name, offset, length):
+        """Return length bytes of the given file from offset on"""
+        self.ftp.voidcmd('TYPE I')
+        data = bytearray()
+        connection = self.ftp.transfercmd('RETR ' + name, rest=offset)
+        try:
+            while len(data) < length:
+                block = connection.recv(min(self.blocksize,
+                                            length - len(data)))
+                if not block:
+                    break
+                data.extend(block)
+        finally:
+            connection.close()
+        try:
+            self.ftp.voidresp()
+        except (ftplib.error_temp, ftplib.error_perm):
+            # The transfer was aborted before the end of the file
+            pass
+        return bytes(data)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import hashlib
+
+
+class HashingReader(object):
+    """File object wrapper which calculates the sha256 of the read data"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        """Read from the wrapped file object and update the checksum"""
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        """Return the sha256 of all data read so far"""
+        return self.digest.hexdigest()
+
+
+class FileIndex(object):
+    """Persistent index of the files which are contained in the backups
+
+    For every backed up path the size, mtime, inode and content hash is
+    stored in a sqlite database. A file is seen as modified if one of the
+    stat values differs from the index. Every create run is a new
+    generation, all paths which were not seen in the current generation
+    have been deleted since the last backup.
+
+    The changes are only written to disk with commit(), so an aborted
+    create leaves the index of the last successful backup untouched.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The archive is written in a producer thread, but never
+        # concurrently to the main thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+            'inode INTEGER, hash TEXT, generation INTEGER)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        self.generation = int(self.get_meta('generation', 0)) + 1
+
+    def get_meta(self, key, default=None):
+        """Return the stored value of the given meta key"""
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set_meta(self, key, value):
+        """Store the value of the given meta key"""
+        self.connection.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, value))
+
+    def is_empty(self):
+        """Check if there are no files in the index"""
+        row = self.connection.execute('SELECT 1 FROM files LIMIT 1')
+        return row.fetchone() is None
+
+    def is_modified(self, path, stats):
+        """Check if the path is new or has changed since the last backup"""
+        row = self.connection.execute(
+            'SELECT size, mtime, inode FROM files WHERE path = ?',
+            (path,)).fetchone()
+        if row is None:
+            return True
+        return row != (stats.st_size, stats.st_mtime, stats.st_ino)
+
+    def mark_seen(self, path):
+        """Mark an unchanged path as existing in the current generation"""
+        self.connection.execute(
+            'UPDATE files SET generation = ? WHERE path = ?',
+            (self.generation, path))
+
+    def update(self, path, stats, digest=None):
+        """Store the current state of the given path"""
+        self.connection.execute(
+            'INSERT OR REPLACE INTO files '
+            '(path, size, mtime, inode, hash, generation) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (path, stats.st_size, stats.st_mtime, stats.st_ino, digest,
+             self.generation))
+
+    def deleted_paths(self):
+        """Return all paths which were not seen in the current generation"""
+        rows = self.connection.execute(
+            'SELECT path FROM files WHERE generation != ? ORDER BY path',
+            (self.generation,))
+        return [row[0] for row in rows]
+
+    def commit(self, full):
+        """Persist the current generation
+
+        Deleted paths get dropped and the counter of incremental backups
+        since the last full backup is updated.
+        """
+        self.connection.execute('DELETE FROM files WHERE generation != ?',
+                                (self.generation,))
+        if full:
+            self.set_meta('incrementals', 0)
+        else:
+            self.set_meta('incrementals',
+                          int(self.get_meta('incrementals', 0)) + 1)
+        self.set_meta('generation', self.generation)
+        self.connection.commit()
+
+    def close(self):
+        """Close the database, uncommitted changes get discarded"""
+        self.connection.rollback()
+        self.connection.close()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+
+from contextlib import contextmanager
+
+
+class ListingCache(object):
+    """Local cache of the backup listing of a remote target
+
+    The entries (name, size, mtime and etag of every backup) are stored as
+    json in the state directory. A cached listing expires after ttl
+    seconds or as soon as the configured target changes. The cache is only
+    an optimization, so a state directory which is not writable just
+    disables it.
+    """
+
+    def __init__(self, path, target, ttl=300):
+        self.path = path
+        self.target = target
+        self.ttl = ttl
+
+    def load(self):
+        """Return the cached entries or None, if there is no valid cache"""
+        if self.ttl <= 0:
+            return None
+        try:
+            with open(self.path) as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if cache.get('target') != self.target:
+            return None
+        if time.time() - cache.get('time', 0) > self.ttl:
+            return None
+        return cache['entries']
+
+    def save(self, entries, timestamp=None):
+        """Store the given entries as the current listing"""
+        if self.ttl <= 0:
+            return
+        cache = {
+            'target': self.target,
+            'time': timestamp or time.time(),
+            'entries': entries
+        }
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write to a temporary file first, so concurrent readers never
+            # see a partial cache
+            temp_path = '{0}.{1}'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as cache_file:
+                json.dump(cache, cache_file)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def remove(self, name):
+        """Drop a single (deleted) entry, the age of the cache is kept"""
+        try:
+            with open(self.path) as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return
+        entries = [entry for entry in cache.get('entries', [])
+                   if entry['name'] != name]
+        self.save(entries, cache.get('time'))
+
+    def invalidate(self):
+        """Remove the cache, the next listing is fetched from the target"""
+        try:
+            os.remove(self.path)
+        except (IOError, OSError):
+            pass
+
+
+class SharedListings(object):
+    """Listings of target locations, shared by all backups of a pass
+
+    Backups which go to the same location (e.g. the same bucket or ftp
+    account) need a listing of the same directory. While sharing() is
+    active, the listing of a location is only fetched by the first backup,
+    the others wait for it and take their entries from it. Outside of a
+    pass every backup fetches its own listing, so it is never outdated.
+    """
+
+    def __init__(self):
+        self.listings = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.active = False
+
+    @contextmanager
+    def sharing(self):
+        """Share the listings until the end of the block"""
+        self.active = True
+        try:
+            yield self
+        finally:
+            self.active = False
+            self.listings = {}
+            self.locks = {}
+
+    def get(self, key, fetch):
+        """Return the shared entries of the location, None if inactive"""
+        if not self.active or key is None:
+            return None
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.listings:
+                self.listings[key] = fetch()
+            return self.listings[key]
+
+
+SHARED_LISTINGS = SharedListings()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import resource
+import threading
+
+from contextlib import contextmanager
+
+
+def _cpu_seconds():
+    """Return the cpu time of this process and its waited for children"""
+    total = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _peak_rss():
+    """Return the peak resident set size of this process or a child
+
+    Linux reports ru_maxrss in kilobytes. It is a high watermark of the
+    whole process, so it never goes down from one phase to the next.
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+class Phase(object):
+    """Measurements of a single phase of a backup run"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.peak_rss = 0
+        self.succeeded = False
+        self._cpu_started = _cpu_seconds()
+
+    def finish(self, succeeded):
+        """Stop the clocks of the phase"""
+        self.wall_seconds = time.time() - self.started
+        self.cpu_seconds = _cpu_seconds() - self._cpu_started
+        self.peak_rss = _peak_rss()
+        self.succeeded = succeeded
+
+    @property
+    def compression_ratio(self):
+        """Return bytes_in / bytes_out or None, if a count is missing"""
+        if not self.bytes_in or not self.bytes_out:
+            return None
+        return float(self.bytes_in) / self.bytes_out
+
+    def as_dict(self):
+        """Return the measurements as a json serializable dict"""
+        return {
+            'phase': self.name,
+            'started': self.started,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'compression_ratio': self.compression_ratio,
+            'peak_rss_bytes': self.peak_rss,
+            'succeeded': self.succeeded
+        }
+
+
+class Metrics(object):
+    """Record wall time, cpu time, bytes and memory per phase of a backup
+
+    Phases are expected to run one after another, the work of a phase may
+    be spread over threads (like the producer of an archive stream), which
+    count their bytes into the currently running phase. The cpu time
+    covers the whole process including finished subprocesses, so phases of
+    concurrently running backups (--jobs) see each other's cpu time.
+
+    The results are appended as json lines to json_path and written as a
+    Prometheus textfile collector file (one file per backup) into
+    textfile_dir, if configured.
+    """
+
+    PROMETHEUS_METRICS = [
+        ('wall_seconds', 'Wall clock time of the phase'),
+        ('cpu_seconds', 'Cpu time of the phase including subprocesses'),
+        ('bytes_in', 'Bytes read by the phase'),
+        ('bytes_out', 'Bytes written by the phase'),
+        ('compression_ratio', 'Ratio of bytes read to bytes written'),
+        ('peak_rss_bytes', 'Peak resident set size at the end of the phase')
+    ]
+
+    def __init__(self, name, json_path=None, textfile_dir=None):
+        self.name = name
+        self.json_path = json_path
+        self.textfile_dir = textfile_dir
+        self.operation = None
+        self.phases = []
+        self.current = None
+        self.lock = threading.Lock()
+
+    def start(self, operation):
+        """Start recording a new run of the given operation"""
+        self.operation = operation
+        self.phases = []
+        self.current = None
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the code run in this context as a phase"""
+        phase = Phase(name)
+        previous = self.current
+        self.current = phase
+        succeeded = False
+        try:
+            yield phase
+            succeeded = True
+        finally:
+            phase.finish(succeeded)
+            self.current = previous
+            self.phases.append(phase)
+
+    def count(self, bytes_in=0, bytes_out=0):
+        """Add the given byte counts to the running phase"""
+        with self.lock:
+            if self.current is None:
+                return
+            self.current.bytes_in += bytes_in
+            self.current.bytes_out += bytes_out
+
+    def records(self, succeeded):
+        """Return one dict per recorded phase"""
+        records = []
+        for phase in self.phases:
+            record = phase.as_dict()
+            record['backup'] = self.name
+            record['operation'] = self.operation
+            record['run_succeeded'] = succeeded
+            records.append(record)
+        return records
+
+    def write(self, succeeded):
+        """Write the recorded phases to the configured outputs
+
+        Metrics are best effort, a backup never fails because of them.
+        """
+        try:
+            if self.json_path:
+                self.write_json(succeeded)
+            if self.textfile_dir:
+                self.write_textfile(succeeded)
+        except (IOError, OSError) as error:
+            print('Unable to write metrics of {0}: {1}'.format(self.name,
+                                                               error))
+
+    def write_json(self, succeeded):
+        """Append one json line per recorded phase"""
+        with open(self.json_path, 'a') as json_file:
+            for record in self.records(succeeded):
+                json_file.write(json.dumps(record, sort_keys=True))
+                json_file.write('\n')
+
+    @staticmethod
+    def _escape(value):
+        """Escape a prometheus label value"""
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+    def prometheus_lines(self, succeeded):
+        """Return the recorded phases in the prometheus text format"""
+        lines = []
+        records = self.records(succeeded)
+        for key, description in self.PROMETHEUS_METRICS:
+            metric = 'backuptool_phase_{0}'.format(key)
+            lines.append('# HELP {0} {1}'.format(metric, description))
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for record in records:
+                if record[key] is None:
+                    continue
+                lines.append('{0}{{backup="{1}",operation="{2}",'
+                             'phase="{3}"}} {4!r}'.format(
+                                 metric, self._escape(self.name),
+                                 self.operation,
+                                 self._escape(record['phase']),
+                                 float(record[key])))
+        labels = '{{backup="{0}",operation="{1}"}}'.format(
+            self._escape(self.name), self.operation)
+        lines.extend([
+            '# HELP backuptool_last_run_timestamp_seconds End of the last run',
+            '# TYPE backuptool_last_run_timestamp_seconds gauge',
+            'backuptool_last_run_timestamp_seconds{0} {1!r}'.format(
+                labels, time.time()),
+            '# HELP backuptool_last_run_success 1 if the last run succeeded',
+            '# TYPE backuptool_last_run_success gauge',
+            'backuptool_last_run_success{0} {1}'.format(
+                labels, 1 if succeeded else 0)
+        ])
+        return lines
+
+    def write_textfile(self, succeeded):
+        """Replace the textfile of this backup and operation atomically
+
+        The collector could read the file at any time, so it is written to
+        a temporary file first, which is renamed afterwards.
+        """
+        if not os.path.isdir(self.textfile_dir):
+            os.makedirs(self.textfile_dir)
+        path = '{0}/backuptool_{1}_{2}.prom'.format(
+            self.textfile_dir, self.name, self.operation)
+        temporary_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w') as textfile:
+            textfile.write('\n'.join(self.prometheus_lines(succeeded)))
+            textfile.write('\n')
+        os.rename(temporary_path, path)
@@ -1,9 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import os
 import boto3
+import hashlib
+import calendar
 
-from .backup import Backup
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from .backup import Backup, parse_size
+
+
+# Maximum number of keys of a DeleteObjects request
+DELETE_BATCH_SIZE = 1000
 
 
 class S3Backup(Backup):
@@ -14,76 +25,232 @@ class S3Backup(Backup):
         self.region = self.config.get('aws-region', 'eu-central-1')
         self.connection = None
         self.bucket = None
-        self.s3_keys = None
         self.bucket_name = self.config['target'].split('://')[1]
+        self.max_attempts = self.config.get('s3_max_attempts', 5)
+        self.part_size = parse_size(self.config.get('s3_part_size', '64MB'))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.part_size,
+            multipart_chunksize=self.part_size,
+            max_concurrency=self.config.get('s3_max_concurrency', 10),
+            num_download_attempts=self.max_attempts)
         self._connect()
-        self.set_s3_keys()
 
     def _connect(self):
         """Connect against aws services"""
         key_id = self.config['aws-access-key-id']
         secret_key = self.config['aws-secret-access-key']
-        self.connection = boto3.client('s3',
-                                       aws_access_key_id=key_id,
-                                       aws_secret_access_key=secret_key)
-
-    def set_s3_keys(self):
-        """Set a list of all existing key entries in the defined bucket"""
-        objects = self.connection.list_objects(Bucket=self.bucket_name)
-        contents = objects['Contents']
-        self.s3_keys = \
-            [d for d in contents if d['Key'].startswith(self.filename_prefix)]
-        self.s3_keys.reverse()
-
-    def upload(self):
-        """Upload the composed (and encrypted) backup file"""
-        if self.encrypt:
-            abs_path = '{0}.gpg'.format(self.filename_abs)
-            filename = '{0}.gpg'.format(self.filename)
+        # Every request (and so every part of a multipart transfer) gets
+        # retried on its own
+        client_config = Config(
+            retries={'max_attempts': self.max_attempts, 'mode': 'standard'},
+            max_pool_connections=self.transfer_config.max_request_concurrency)
+        self.connection = boto3.client(
+            's3',
+            region_name=self.region,
+            endpoint_url=self.config.get('s3_endpoint_url'),
+            aws_access_key_id=key_id,
+            aws_secret_access_key=secret_key,
+            config=client_config)
+
+    def iter_keys(self, prefix):
+        """Generate all objects of the bucket below the given prefix
+
+        The keys are filtered by s3 and fetched page by page (1000 keys per
+        request), so only a single page is held in memory.
+        """
+        paginator = self.connection.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=prefix):
+            for key in page.get('Contents', []):
+                yield key
+
+    def listing_key(self):
+        """Backups in the same bucket share the listing"""
+        return ('s3', self.config.get('s3_endpoint_url'), self.bucket_name,
+                self.config['aws-access-key-id'])
+
+    def fetch_entries(self, prefix):
+        """Return the entries of all objects below the prefix"""
+        return [{
+            'name': key['Key'],
+            'size': key['Size'],
+            'mtime': calendar.timegm(key['LastModified'].utctimetuple()),
+            'etag': key['ETag'].strip('"')
+        } for key in self.iter_keys(prefix)]
+
+    def resume_upload(self, path, name, journal):
+        """Upload the file as multipart upload, resume an interrupted one
+
+        The id of the multipart upload is journaled. On a resume the already
+        uploaded parts are fetched with ListParts and only skipped, if their
+        ETag matches the md5 sum of the local part.
+        """
+        size = os.path.getsize(path)
+        if size <= self.part_size:
+            with open(path, 'rb') as source:
+                self.upload_fileobj(source, name)
+            return
+        state = journal.load()
+        uploaded_parts = {}
+        if (state and state['direction'] == 'upload' and
+                state['name'] == name and state['size'] == size and
+                state.get('part_size') == self.part_size):
+            try:
+                uploaded_parts = self.uploaded_parts(name,
+                                                     state['upload_id'])
+            except ClientError:
+                # The multipart upload was aborted or completed meanwhile
+                state = None
+        elif state and state['direction'] == 'upload':
+            # The journaled upload is replaced by the new one
+            self.discard_transfer(state)
+            state = None
         else:
-            abs_path = self.filename_abs
-            filename = self.filename
-        self.connection.upload_file(abs_path, self.bucket_name, filename)
-
-    def download(self):
-        """Download the newest backup from s3"""
-        if not self.s3_keys:
-            return False
-        newest_backup = self.s3_keys[0]
-        file_target = '{0}/{1}'.format(self.workdir, newest_backup['Key'])
-        self.connection.download_file(self.bucket_name,
-                                      newest_backup['Key'],
-                                      file_target)
-        self.check_encryption_by_name(newest_backup['Key'])
-        return True
-
-    def rotate(self):
-        """Only keep the given amount of bucket keys and delete the rest"""
-        keys_to_be_deleted = self.s3_keys[self.rotation_num:]
-        for key in keys_to_be_deleted:
-            self.delete(key['Key'])
+            state = None
+        if state is None:
+            upload = self.connection.create_multipart_upload(
+                Bucket=self.bucket_name, Key=name)
+            state = {
+                'direction': 'upload',
+                'name': name,
+                'size': size,
+                'part_size': self.part_size,
+                'upload_id': upload['UploadId']
+            }
+        elif uploaded_parts:
+            print('Resuming upload of {0} with {1} uploaded parts'.format(
+                name, len(uploaded_parts)))
+        state['path'] = path
+        journal.save(state)
+
+        def upload_part(part_number):
+            with open(path, 'rb') as source:
+                source.seek((part_number - 1) * self.part_size)
+                data = source.read(self.part_size)
+            etag = uploaded_parts.get(part_number)
+            if etag == '"{0}"'.format(hashlib.md5(data).hexdigest()):
+                return etag
+            self.upload_throttle.consume(len(data))
+            response = self.connection.upload_part(
+                Bucket=self.bucket_name, Key=name, Body=data,
+                UploadId=state['upload_id'], PartNumber=part_number)
+            return response['ETag']
+        part_numbers = range(1, (size - 1) // self.part_size + 2)
+        with ThreadPoolExecutor(
+                max_workers=self.transfer_config.max_concurrency) as pool:
+            etags = list(pool.map(upload_part, part_numbers))
+        self.connection.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=name, UploadId=state['upload_id'],
+            MultipartUpload={'Parts': [
+                {'ETag': etag, 'PartNumber': number}
+                for number, etag in zip(part_numbers, etags)]})
+        self.listing_changed(name)
+
+    def discard_transfer(self, state):
+        """Abort the journaled multipart upload, S3 keeps its parts else"""
+        if not state.get('upload_id'):
+            return
+        try:
+            self.connection.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=state['name'],
+                UploadId=state['upload_id'])
+        except ClientError:
+            # The multipart upload was aborted or completed meanwhile
+            pass
+
+    def uploaded_parts(self, name, upload_id):
+        """Return the ETags of the already uploaded parts by part number"""
+        paginator = self.connection.get_paginator('list_parts')
+        parts = {}
+        for page in paginator.paginate(Bucket=self.bucket_name, Key=name,
+                                       UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+        return parts
+
+    def upload_fileobj(self, fileobj, name):
+        """Upload the content of the given file object as multipart upload
+
+        The parts are uploaded concurrently as soon as they are read from
+        the file object, so a streamed archive is uploaded while it is
+        produced.
+        """
+        fileobj = self.upload_throttle.reader(fileobj)
+        self.connection.upload_fileobj(fileobj, self.bucket_name, name,
+                                       Config=self.transfer_config)
+        self.listing_changed(name)
+
+    def download_fileobj(self, name, fileobj, offset=0):
+        """Write the content of the given backup into the file object
+
+        The object is fetched with concurrent ranged GETs, the parts are
+        written to the (not seekable) file object in order. A resumed
+        download from an offset is fetched as a single ranged GET.
+        """
+        if not offset:
+            self.connection.download_fileobj(self.bucket_name, name, fileobj,
+                                             Config=self.transfer_config)
+            return
+        response = self.connection.get_object(
+            Bucket=self.bucket_name, Key=name,
+            Range='bytes={0}-'.format(offset))
+        for data in response['Body'].iter_chunks(1024 * 1024):
+            fileobj.write(data)
+
+    def remote_size(self, name):
+        """Return the size of the given object or None, if it not exists"""
+        try:
+            response = self.connection.head_object(Bucket=self.bucket_name,
+                                                   Key=name)
+        except ClientError:
+            return None
+        return response['ContentLength']
+
+    def read_range(self, name, offset, length):
+        """Return length bytes of the given object from offset on"""
+        response = self.connection.get_object(
+            Bucket=self.bucket_name, Key=name,
+            Range='bytes={0}-{1}'.format(offset, offset + length - 1))
+        return response['Body'].read()
+
+    def list_names(self, directory):
+        """Return the names of all keys below the given prefix directory"""
+        prefix = '{0}/'.format(directory)
+        return [key['Key'][len(prefix):] for key in self.iter_keys(prefix)]
+
+    def make_directory(self, directory):
+        """Nothing to do, directories are just key prefixes on s3"""
+        pass
 
     def list(self):
         """List all available backups for this type"""
-        print('{0} (S3):'.format(self.name))
-        if not self.s3_keys:
-            print('  <no backups>\n')
-            return
-        for key, more_items in self._lookahead(self.s3_keys):
-            key_timestamp = '-'.join(key['Key'].split('-')[-1:]).split('.')[0]
-            parsed_date = datetime.strptime(key_timestamp, '%Y%m%d%H%M%S')
-            date = parsed_date.strftime('%Y-%m-%dT%H:%M:%S')
-            size = '{0:.2f}MB'.format(float(key['Size']) / 1024 / 1024)
-            if more_items:
-                tree_prefix = '├─ '
-            else:
-                tree_prefix = '└─ '
-            print('{0}{1:<53}{2:<10}{3}'.format(tree_prefix,
-                                                key['Key'],
-                                                size,
-                                                date))
-        print('')
+        self.print_listing('S3')
 
     def delete(self, name):
         """Delete the given backup object from s3 bucket"""
         self.connection.delete_object(Bucket=self.bucket_name, Key=name)
+        self.listing_changed(name, deleted=True)
+
+    def delete_names(self, names, ignore_missing=False):
+        """Delete the given objects with a DeleteObjects per 1000 keys
+
+        Deleting a missing key is no error on s3. The first failed key of
+        a batch raises a ClientError after the whole batch is done.
+        """
+        for start in range(0, len(names), DELETE_BATCH_SIZE):
+            batch = names[start:start + DELETE_BATCH_SIZE]
+            response = self.connection.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': name} for name in batch],
+                        'Quiet': True})
+            errors = response.get('Errors', [])
+            failed = set(error['Key'] for error in errors)
+            for name in batch:
+                if name not in failed:
+                    self.listing_changed(name, deleted=True)
+            if errors:
+                raise ClientError({'Error': {
+                    'Code': errors[0].get('Code'),
+                    'Message': '{0}: {1}'.format(errors[0]['Key'],
+                                                 errors[0].get('Message'))
+                }}, 'DeleteObjects')
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import re
+import asyncio
+import traceback
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .targets import target_configs
+
+
+# Semaphores per target, inherited by the worker processes
+_target_semaphores = {}
+
+
+def target_key(config):
+    """Return an identifier of the host (or directory) a backup goes to"""
+    match = re.match(r'^(\w+)://([^/]*)(.*)$', config.get('target', ''))
+    if not match:
+        return None
+    protocol, host, path = match.groups()
+    if protocol == 'file':
+        return 'file://{0}{1}'.format(host, path)
+    return '{0}://{1}'.format(protocol, host)
+
+
+def target_keys(config):
+    """Return the sorted identifiers of all targets of a backup"""
+    return sorted(set(key for key in map(target_key, target_configs(config))
+                      if key is not None))
+
+
+def _initialize(semaphores):
+    """Make the target semaphores available in a worker process"""
+    global _target_semaphores
+    _target_semaphores = semaphores
+
+
+def _run(function, name, config, arguments):
+    """Run a single backup job and catch all of its errors
+
+    If a concurrency limit is configured for targets of the backup, the
+    job waits until a slot of each of these targets is free. The slots are
+    taken in the order of the target keys, so two backups never wait for
+    each other.
+    """
+    semaphores = [_target_semaphores[key] for key in target_keys(config)
+                  if key in _target_semaphores]
+    for semaphore in semaphores:
+        semaphore.acquire()
+    try:
+        if function(name, config, arguments) is False:
+            return name, 'Backup failed'
+        return name, None
+    except Exception as error:
+        return name, '{0}\n{1}'.format(error, traceback.format_exc())
+    finally:
+        for semaphore in reversed(semaphores):
+            semaphore.release()
+
+
+class Scheduler(object):
+    """Run several configured backups in a bounded pool of processes
+
+    Every backup runs in its own process with its own working directory.
+    With the backup option target_jobs the number of concurrent backups to
+    the same target host could be limited, the lowest configured value of
+    all backups with the same target wins. A backup with several targets
+    takes a slot of each of them.
+
+    Network bound operations (like list and rotate) run on an event loop
+    instead, see run_async().
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = max(int(jobs), 1)
+        self.backups = []
+
+    def add(self, name, config):
+        """Add a backup to be run"""
+        self.backups.append((name, config))
+
+    def target_limits(self):
+        """Return the configured concurrency limit per target"""
+        limits = {}
+        for _, backup_config in self.backups:
+            for config in target_configs(backup_config):
+                key = target_key(config)
+                if key is None or 'target_jobs' not in config:
+                    continue
+                limit = int(config['target_jobs'])
+                limits[key] = min(limits.get(key, limit), limit)
+        return limits
+
+    def run(self, function, arguments):
+        """Run function(name, config, arguments) for every backup
+
+        Returns a list of (name, error) tuples in the order the backups were
+        added, where error is None for successful backups.
+        """
+        if self.jobs == 1 or len(self.backups) <= 1:
+            return [_run(function, name, config, arguments)
+                    for name, config in self.backups]
+        # The script functions can only be shared by forking
+        context = multiprocessing.get_context('fork')
+        semaphores = dict((key, context.Semaphore(limit))
+                          for key, limit in self.target_limits().items())
+        pool = context.Pool(processes=self.jobs,
+                            initializer=_initialize,
+                            initargs=(semaphores,))
+        try:
+            results = [pool.apply_async(_run, (function, name, config,
+                                               arguments))
+                       for name, config in self.backups]
+            return [result.get() for result in results]
+        finally:
+            pool.close()
+            pool.join()
+
+    async def run_async(self, function, arguments, concurrency=16):
+        """Run the coroutine function for every backup on the event loop
+
+        function(name, config, arguments, executor, turn) gets a thread
+        pool of concurrency threads for its blocking calls. Awaiting turn()
+        waits until the functions of all backups added before are done, so
+        e.g. output could be printed in order. target_jobs limits the
+        concurrent backups per target like in run(), the slot is given back
+        on turn(). Returns the same list of (name, error) tuples as run().
+        """
+        limits = dict((key, asyncio.Semaphore(limit))
+                      for key, limit in self.target_limits().items())
+        done = [asyncio.Event() for _ in self.backups]
+
+        async def run_one(position, name, config):
+            semaphores = [limits[key] for key in target_keys(config)
+                          if key in limits]
+            acquired = []
+
+            def release():
+                while acquired:
+                    acquired.pop().release()
+
+            async def turn():
+                # Waiting for others must not block their target slots
+                release()
+                for event in done[:position]:
+                    await event.wait()
+            try:
+                try:
+                    for semaphore in semaphores:
+                        await semaphore.acquire()
+                        acquired.append(semaphore)
+                    if await function(name, config, arguments, executor,
+                                      turn) is False:
+                        return name, 'Backup failed'
+                    return name, None
+                except Exception as error:
+                    return name, '{0}\n{1}'.format(error,
+                                                   traceback.format_exc())
+                finally:
+                    release()
+            finally:
+                done[position].set()
+
+        executor = ThreadPoolExecutor(max_workers=max(int(concurrency), 1))
+        try:
+            return await asyncio.gather(*[
+                run_one(position, name, config)
+                for position, (name, config) in enumerate(self.backups)])
+        finally:
+            executor.shutdown()
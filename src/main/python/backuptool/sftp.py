@@ -1,11 +1,59 @@
 # -*- coding: utf-8 -*-
 
 import re
+import errno
 import paramiko
 
-from datetime import datetime
+from paramiko.sftp import CMD_REMOVE, CMD_STATUS
+from .backup import Backup, parse_size
+from .connection import POOL, Connection, reconnecting
 
-from .backup import Backup
+
+class SFTPConnection(Connection):
+    """Pooled ssh transport with an sftp session"""
+
+    def __init__(self, transport, sftp, keepalive=30):
+        super(SFTPConnection, self).__init__(keepalive)
+        self.transport = transport
+        self.sftp = sftp
+        # Ssh keepalives keep even busy connections open
+        self.transport.set_keepalive(keepalive)
+
+    def is_healthy(self):
+        """Check the transport and the sftp session with a round trip"""
+        if not self.transport.is_active():
+            return False
+        try:
+            self.sftp.normalize('.')
+        except (EOFError, IOError, paramiko.SSHException):
+            return False
+        return True
+
+    def send_keepalive(self):
+        """Keep the idle connection open"""
+        self.transport.send_ignore()
+
+    def close(self):
+        """Close the sftp session and the transport"""
+        self.sftp.close()
+        self.transport.close()
+
+
+class _PipelinedReplies(object):
+    """Receiver of the replies of pipelined sftp requests
+
+    Implements the interface paramiko uses for the replies of the
+    prefetched reads of a file.
+    """
+
+    def __init__(self):
+        self.replies = {}
+
+    def _async_response(self, t, msg, num):
+        self.replies[num] = (t, msg)
+
+    def _check_exception(self):
+        pass
 
 
 class SFTPBackup(Backup):
@@ -13,90 +61,205 @@ class SFTPBackup(Backup):
 
     def __init__(self, *args, **kwargs):
         super(SFTPBackup, self).__init__(*args, **kwargs)
-        self.existing_backup_files = []
-        self.transport = None
-        self.sftp = None
+        self.connection = None
+        self.window_size = parse_size(
+            self.config.get('sftp_window_size', '16MB'))
+        self.max_packet_size = parse_size(
+            self.config.get('sftp_max_packet_size', '32KB'))
+        self.blocksize = parse_size(self.config.get('sftp_blocksize', '32KB'))
+        self.prefetch_requests = self.config.get('sftp_prefetch_requests',
+                                                 64)
+        self.ssh_compression = self.config.get('sftp_compression', False)
+        self.pipeline_depth = self.config.get('delete_pipeline_depth', 64)
+        self.pooling = self.config.get('connection_pooling', True)
+        self.keepalive = self.config.get('connection_keepalive', 30)
+        match = re.search(r'sftp://([^:/]+):*([^/]*)', self.config['target'])
+        self.host = match.group(1)
+        self.port = int(match.group(2) or 22)
+        self.connection_key = ('sftp', self.host, self.port,
+                               self.config['sftp_user'])
         self._connect()
-        self.set_existing_backups()
 
     def __del__(self):
-        self.sftp.close()
-        self.transport.close()
+        self.disconnect()
+
+    @property
+    def transport(self):
+        """Return the ssh transport of the current connection"""
+        return self.connection.transport
+
+    @property
+    def sftp(self):
+        """Return the sftp client of the current connection"""
+        return self.connection.sftp
+
+    def open_connection(self):
+        """Connect against the configured sftp server"""
+        # A large window keeps the link busy on connections with a high
+        # latency, the default of 2MB limits it to 2MB per round trip
+        transport = paramiko.Transport(
+            (self.host, self.port),
+            default_window_size=self.window_size,
+            default_max_packet_size=self.max_packet_size)
+        transport.use_compression(self.ssh_compression)
+        transport.connect(username=self.config['sftp_user'],
+                          password=self.config['sftp_password'])
+        sftp = paramiko.SFTPClient.from_transport(
+            transport,
+            window_size=self.window_size,
+            max_packet_size=self.max_packet_size)
+        return SFTPConnection(transport, sftp, self.keepalive)
 
     def _connect(self):
-        """Connect against the configured ftp server"""
-        match = re.search(r'sftp://([^:/]+):*([^/]*)', self.config['target'])
-        host = match.group(1)
-        port = 22
-        if match.group(2):
-            port = int(match.group(2))
-        self.transport = paramiko.Transport((host, port))
-        self.transport.connect(username=self.config['sftp_user'],
-                               password=self.config['sftp_password'])
-        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
-
-    def set_existing_backups(self):
-        """Set a list of all existing backups entries found on ftp server"""
-        for entry in self.sftp.listdir():
-            pattern = r'^{0}-\d+.tar.gz(?:.gpg)?$'
-            pattern = pattern.format(self.filename_prefix)
-            if re.match(pattern, entry):
-                stats = self.sftp.stat(entry)
-                mtime = stats.st_mtime
-                date_format = '%b %d %H:%M'
-                date = datetime.fromtimestamp(mtime).strftime(date_format)
-                self.existing_backup_files.append({
-                    'name': entry,
-                    'size': '{0}MB'.format(stats.st_size / 1024 / 1024),
-                    'date': date
-                })
-
-    def upload(self):
-        """Upload the composed (and encrypted) backup file"""
-        if self.encrypt:
-            filename = '{0}.gpg'.format(self.filename)
-            filename_abs = '{0}.gpg'.format(self.filename_abs)
+        """Take a connection to the sftp server from the pool
+
+        A new connection (with a full ssh handshake) is only made, if there
+        is no idle one.
+        """
+        if not self.pooling:
+            self.connection = self.open_connection()
+            return
+        self.connection = POOL.acquire(self.connection_key,
+                                       self.open_connection)
+
+    def reconnect(self):
+        """Replace a broken connection"""
+        connection, self.connection = self.connection, None
+        connection.close()
+        self._connect()
+
+    def disconnect(self):
+        """Give the connection back to the pool"""
+        connection, self.connection = getattr(self, 'connection',
+                                              None), None
+        if connection is None:
+            return
+        if self.pooling:
+            POOL.release(self.connection_key, connection)
         else:
-            filename = self.filename
-            filename_abs = self.filename_abs
-        self.sftp.put(filename_abs, filename)
+            connection.close()
+
+    def listing_key(self):
+        """Backups of the same sftp account share the listing"""
+        return self.connection_key
+
+    @reconnecting()
+    def fetch_entries(self, prefix):
+        """Return the entries of all files starting with the prefix
+
+        The attributes of all files are delivered with the listing itself,
+        so there is no additional round trip per backup.
+        """
+        return [{
+            'name': attributes.filename,
+            'size': attributes.st_size,
+            'mtime': attributes.st_mtime,
+            'etag': None
+        } for attributes in self.sftp.listdir_attr()
+            if attributes.filename.startswith(prefix)]
+
+    @reconnecting(retry=False)
+    def upload_fileobj(self, fileobj, name, offset=0):
+        """Upload the content of the given file object to the sftp server
+
+        The writes are pipelined, so they are not acknowledged one by one.
+        With an offset an interrupted upload is resumed: the remote file is
+        written from this position on and fileobj has to be positioned at
+        the same offset already.
+        """
+        mode = 'r+b' if offset else 'wb'
+        fileobj = self.upload_throttle.reader(fileobj)
+        with self.sftp.open(name, mode, bufsize=self.blocksize) as remote:
+            remote.set_pipelined(True)
+            if offset:
+                remote.seek(offset)
+            for data in iter(lambda: fileobj.read(self.blocksize), b''):
+                remote.write(data)
+        self.listing_changed(name)
 
     def list(self):
         """List all available backups on ftp server"""
-        print('{0} (SFTP):'.format(self.name))
-        if not self.existing_backup_files:
-            print('  <no backups>\n')
-            return
-        for entry, more_items in self._lookahead(self.existing_backup_files):
-            if more_items:
-                tree_prefix = '├─ '
-            else:
-                tree_prefix = '└─ '
-            print('{0}{1:<53}{2:<10}{3}'.format(tree_prefix,
-                                                entry['name'],
-                                                entry['size'],
-                                                entry['date']))
-        print('')
-
-    def rotate(self):
-        """Only keep the given amount of backup files and delete the rest"""
-        files = sorted(self.existing_backup_files,
-                       key=lambda k: k['name'],
-                       reverse=True)
-        files_to_be_deleted = files[self.rotation_num:]
-        for backup_file in files_to_be_deleted:
-            self.sftp.remove(backup_file['name'])
+        self.print_listing('SFTP')
+
+    @reconnecting()
+    def list_names(self, directory):
+        """Return the names of all files in the given directory"""
+        return self.sftp.listdir(directory)
 
+    @reconnecting()
+    def make_directory(self, directory):
+        """Create the given directory on the sftp server, if not exist"""
+        try:
+            self.sftp.mkdir(directory)
+        except IOError:
+            pass
+
+    @reconnecting()
     def delete(self, name):
         """Delete the given backup file from ftp server"""
         self.sftp.remove(name)
+        self.listing_changed(name, deleted=True)
 
-    def download(self):
-        """Download the newest backup from ftp server"""
-        if not self.existing_backup_files:
-            return False
-        newest_backup = self.existing_backup_files[-1]['name']
-        file_target = '{0}/{1}'.format(self.workdir, newest_backup)
-        self.sftp.get(newest_backup, file_target)
-        self.check_encryption_by_name(newest_backup)
-        return True
+    @reconnecting(retry=False)
+    def delete_names(self, names, ignore_missing=False):
+        """Delete the given files with pipelined remove requests
+
+        Up to delete_pipeline_depth requests are sent before their replies
+        are read, so the deletes do not wait for a round trip each. All
+        replies are read before the first error (e.g. a missing file, if
+        not ignore_missing) is raised. paramiko has no public interface for
+        pipelined requests, so its internals are used (see build.py for the
+        supported releases).
+        """
+        error = None
+        for start in range(0, len(names), self.pipeline_depth):
+            batch = names[start:start + self.pipeline_depth]
+            replies = _PipelinedReplies()
+            requests = [(name, self.sftp._async_request(
+                replies, CMD_REMOVE, self.sftp._adjust_cwd(name)))
+                for name in batch]
+            self.sftp._finish_responses(replies)
+            for name, number in requests:
+                reply_type, message = replies.replies[number]
+                try:
+                    if reply_type != CMD_STATUS:
+                        raise IOError('Unexpected reply to remove')
+                    self.sftp._convert_status(message)
+                except IOError as reply:
+                    missing = reply.errno == errno.ENOENT
+                    if error is None and not (ignore_missing and missing):
+                        error = reply
+                    continue
+                self.listing_changed(name, deleted=True)
+        if error is not None:
+            raise error
+
+    @reconnecting(retry=False)
+    def download_fileobj(self, name, fileobj, offset=0):
+        """Write the content of the given backup into the file object
+
+        Up to sftp_prefetch_requests reads are requested in advance. With
+        an offset only the data behind this position is downloaded, e.g. to
+        resume an interrupted download.
+        """
+        with self.sftp.open(name, 'rb') as remote:
+            size = remote.stat().st_size
+            remote.seek(offset)
+            remote.prefetch(size, self.prefetch_requests)
+            for data in iter(lambda: remote.read(self.blocksize), b''):
+                fileobj.write(data)
+
+    @reconnecting()
+    def remote_size(self, name):
+        """Return the size of the given file or None, if it not exists"""
+        try:
+            return self.sftp.stat(name).st_size
+        except IOError:
+            return None
+
+    @reconnecting()
+    def read_range(self, name, offset, length):
+        """Return length bytes of the given file from offset on"""
+        with self.sftp.open(name, 'rb') as remote:
+            remote.seek(offset)
+            return remote.read(length)
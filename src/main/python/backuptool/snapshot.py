@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+
+
+class SnapshotError(Exception):
+    """Exception class for throwing SnapshotError exceptions"""
+    pass
+
+
+class Snapshot(object):
+    """Read only snapshot of the filesystem the backup sources are on
+
+    While the snapshot exists, all source paths below source_root are read
+    from the same paths below snapshot_root, so the archive contains a
+    consistent state of the filesystem. The archive names are still the
+    original paths.
+    """
+
+    def __init__(self, name, config, workdir):
+        self.name = name
+        self.config = config
+        self.workdir = workdir
+        self.source_root = None
+        self.snapshot_root = None
+        self.devnull = open(os.devnull, 'w')
+
+    def __enter__(self):
+        try:
+            self.create()
+        except Exception:
+            # Do not leave a half created snapshot behind
+            self.remove()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.remove()
+
+    def run(self, cmd):
+        """Run a snapshot command and raise a SnapshotError if it fails"""
+        try:
+            subprocess.check_call(cmd, stdout=self.devnull)
+        except (OSError, subprocess.CalledProcessError) as error:
+            raise SnapshotError('{0} failed: {1}'.format(' '.join(cmd),
+                                                         error))
+
+    @staticmethod
+    def _move(path, old_root, new_root):
+        """Move the path from below old_root to below new_root"""
+        relative_path = os.path.relpath(path, old_root)
+        if relative_path == '.':
+            return new_root
+        if relative_path == '..' or relative_path.startswith('../'):
+            return path
+        return os.path.join(new_root, relative_path)
+
+    def snapshot_path(self, path):
+        """Return the path to read the given source path from"""
+        return self._move(path, self.source_root, self.snapshot_root)
+
+    def original_path(self, path):
+        """Return the source path of the given path inside the snapshot"""
+        return self._move(path, self.snapshot_root, self.source_root)
+
+    def create(self):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+    def remove(self):
+        """Will be overwritten by child class method"""
+        raise NotImplementedError  # pragma: no cover
+
+
+class LVMSnapshot(Snapshot):
+    """Snapshot of a logical volume, mounted read only into the workdir"""
+
+    def __init__(self, *args, **kwargs):
+        super(LVMSnapshot, self).__init__(*args, **kwargs)
+        self.volume = self.config['volume']
+        self.source_root = self.config['mountpoint']
+        self.snapshot_name = 'backuptool-{0}'.format(self.name)
+        self.device = '{0}/{1}'.format(os.path.dirname(self.volume),
+                                       self.snapshot_name)
+        self.snapshot_root = '{0}/snapshot'.format(self.workdir)
+        self.mounted = False
+        self.created = False
+
+    def create(self):
+        """Create the snapshot volume and mount it"""
+        self.run(['lvcreate', '--snapshot',
+                  '--size', str(self.config.get('size', '1G')),
+                  '--name', self.snapshot_name, self.volume])
+        self.created = True
+        os.makedirs(self.snapshot_root)
+        # xfs refuses to mount a second filesystem with the same uuid
+        options = self.config.get('mount_options', 'ro,nouuid')
+        self.run(['mount', '-o', options, self.device, self.snapshot_root])
+        self.mounted = True
+
+    def remove(self):
+        """Unmount and remove the snapshot volume"""
+        if self.mounted:
+            self.run(['umount', self.snapshot_root])
+            self.mounted = False
+        if self.created:
+            self.run(['lvremove', '--force', self.device])
+            self.created = False
+
+
+class BtrfsSnapshot(Snapshot):
+    """Read only snapshot of a btrfs subvolume"""
+
+    def __init__(self, *args, **kwargs):
+        super(BtrfsSnapshot, self).__init__(*args, **kwargs)
+        self.source_root = self.config['subvolume']
+        self.snapshot_root = self.config.get(
+            'path', '{0}/.backuptool-snapshot-{1}'.format(
+                self.source_root.rstrip('/'), self.name))
+        self.created = False
+
+    def create(self):
+        """Create the read only snapshot"""
+        self.run(['btrfs', 'subvolume', 'snapshot', '-r', self.source_root,
+                  self.snapshot_root])
+        self.created = True
+
+    def remove(self):
+        """Delete the snapshot"""
+        if self.created:
+            self.run(['btrfs', 'subvolume', 'delete', self.snapshot_root])
+            self.created = False
+
+
+SNAPSHOT_TYPES = {
+    'lvm': LVMSnapshot,
+    'btrfs': BtrfsSnapshot
+}
+
+
+def open_snapshot(name, config, workdir):
+    """Return the snapshot for the given snapshot configuration"""
+    snapshot_type = config.get('type')
+    if snapshot_type not in SNAPSHOT_TYPES:
+        raise SnapshotError(
+            'Snapshot type "{0}" is not supported'.format(snapshot_type))
+    return SNAPSHOT_TYPES[snapshot_type](name, config, workdir)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import os
+import queue
+import threading
+
+
+class StreamError(Exception):
+    """Exception class for throwing StreamError exceptions"""
+    pass
+
+
+class ArchiveStream(object):
+    """Readable stream of an archive which is produced on the fly
+
+    The given producer function gets a writable file object and writes the
+    archive into it. This happens in a separate thread, while the consumer
+    reads the result chunk by chunk from this object, so nothing has to be
+    staged on disk. If a stage is given (a function which wraps a file
+    object into a transforming writer, like an encryptor), the data passes
+    through it before it reaches the consumer. Memory usage is bounded by
+    the size of the pipe buffers and of the stage.
+    """
+
+    def __init__(self, producer, stage=None):
+        self.producer = producer
+        self.stage = stage
+        self.error = None
+        self.bytes_read = 0
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, 'rb')
+        self.writer = os.fdopen(write_fd, 'wb')
+        self.thread = threading.Thread(target=self._produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except StreamError:
+            # Do not hide the original exception of the consumer
+            if exc_type is None:
+                raise
+
+    def _produce(self):
+        """Run the producer and hand over its errors to the consumer"""
+        try:
+            if self.stage is None:
+                self.producer(self.writer)
+            else:
+                self._produce_through_stage()
+        except Exception as error:
+            self.error = error
+        finally:
+            try:
+                self.writer.close()
+            except (IOError, OSError):
+                pass
+
+    def _produce_through_stage(self):
+        """Run the producer with the stage in front of the pipe"""
+        writer = self.stage(self.writer)
+        try:
+            self.producer(writer)
+        except Exception:
+            try:
+                writer.close()
+            except Exception:
+                # The error of the producer is the relevant one
+                pass
+            raise
+        writer.close()
+
+    def read(self, size=-1):
+        """Read up to size bytes of the produced archive
+
+        The end of a failed archive is no regular end of file, the error of
+        the producer is raised instead. So a consumer never takes a
+        truncated archive as complete.
+        """
+        data = self.reader.read(size)
+        # Reading all data or no data at all means the end was reached
+        if size < 0 or (not data and size != 0):
+            self.thread.join()
+            self._check_error()
+        self.bytes_read += len(data)
+        return data
+
+    def _check_error(self):
+        """Raise the error of the producer, if there was one"""
+        if self.error:
+            raise StreamError('Unable to create archive stream: {0}'.format(
+                self.error))
+
+    def close(self):
+        """Wait for the producer and raise its error, if there was one"""
+        self.reader.close()
+        self.thread.join()
+        self._check_error()
+
+
+class _TeeReader(object):
+    """Readable end of a single branch of tee()"""
+
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.data = b''
+        self.position = 0
+        self.eof = False
+        self.error = None
+        self.closed = False
+
+    def put(self, data):
+        """Hand over data, unless the consumer stopped reading"""
+        while not self.closed:
+            try:
+                self.queue.put(data, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        """Read up to size bytes, all remaining bytes for size < 0"""
+        if size < 0:
+            return b''.join(iter(lambda: self.read(1024 * 1024), b''))
+        if self.position == len(self.data) and not self.eof:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                # The source failed, its data must not look complete
+                self.error, item = item, b''
+            self.data = item
+            self.position = 0
+            self.eof = not self.data
+        if self.error is not None:
+            raise self.error
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+
+def tee(source, consumers, chunk_size=1024 * 1024, queue_size=4):
+    """Feed the data of source to several consumers concurrently
+
+    Every consumer is a function which reads from the file object it gets
+    in its own thread. At most queue_size chunks are queued per consumer,
+    so the slowest consumer sets the pace. A failing consumer does not stop
+    the others, reading the source stops early only if all consumers
+    stopped. Returns the error (or None) of every consumer. If reading the
+    source fails, the consumers get its error instead of the end of the
+    data, and it is raised after all of them finished.
+    """
+    readers = [_TeeReader(queue_size) for _ in consumers]
+    errors = [None] * len(consumers)
+
+    def consume(position):
+        try:
+            consumers[position](readers[position])
+        except Exception as error:
+            errors[position] = error
+        finally:
+            readers[position].closed = True
+    threads = [threading.Thread(target=consume, args=(position,))
+               for position in range(len(consumers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    source_error = None
+    try:
+        for data in iter(lambda: source.read(chunk_size), b''):
+            running = [reader for reader in readers if not reader.closed]
+            if not running:
+                break
+            for reader in running:
+                reader.put(data)
+    except Exception as error:
+        source_error = error
+    finally:
+        for reader in readers:
+            reader.put(source_error or b'')
+        for thread in threads:
+            thread.join()
+    if source_error is not None:
+        raise source_error
+    return errors
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+
+# Module and class of the backup implementation per target protocol
+TARGET_CLASSES = {
+    'file': ('backuptool.file', 'FileBackup'),
+    'ftp': ('backuptool.ftp', 'FTPBackup'),
+    'sftp': ('backuptool.sftp', 'SFTPBackup'),
+    's3': ('backuptool.s3', 'S3Backup')
+}
+
+
+class TargetError(Exception):
+    """Exception class for throwing TargetError exceptions"""
+    pass
+
+
+def target_configs(config):
+    """Return the configuration of every target of a backup
+
+    The targets are either the single target or the list of targets. An
+    entry of the list is a target url or a dict with the url as target and
+    settings which override the ones of the backup for this target (like
+    rotate or the credentials).
+    """
+    targets = config.get('targets')
+    if not targets:
+        return [config]
+    configs = []
+    for target in targets:
+        if not isinstance(target, dict):
+            target = {'target': target}
+        configs.append(dict(config, **target))
+    return configs
+
+
+def state_name(name, config):
+    """Return the name of the local state files of a backup target
+
+    With several targets every target keeps its own transfer journal and
+    listing cache.
+    """
+    if not config.get('targets'):
+        return name
+    return '{0}.{1}'.format(name, re.sub(r'[^\w.-]+', '_', config['target']))
+
+
+def backup_class(config):
+    """Return the backup class for the protocol of the configured target"""
+    protocol = config.get('target', '').split('://')[0]
+    if protocol not in TARGET_CLASSES:
+        raise TargetError("Target type '{0}' is not supported".format(
+            protocol))
+    module_name, class_name = TARGET_CLASSES[protocol]
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+def open_backup(name, config, workdir):
+    """Return the backup object of the given backup
+
+    With a list of targets the first target which could be opened builds
+    the archive and distributes it to the others (see Backup.targets).
+    Targets which could not be opened are reported as failed.
+    """
+    configs = target_configs(config)
+    if len(configs) == 1:
+        return backup_class(config)(name, config=config, workdir=workdir)
+    backup = None
+    failures = []
+    for target_config in configs:
+        try:
+            target = backup_class(target_config)(
+                name, config=target_config, workdir=workdir)
+        except Exception as error:
+            print('Unable to open target {0} of {1}: {2}'.format(
+                target_config.get('target'), name, error))
+            failures.append((target_config.get('target'), error))
+            continue
+        if backup is None:
+            backup = target
+        else:
+            backup.targets.append(target)
+    if backup is None:
+        raise TargetError('Unable to open any target')
+    backup.target_failures.extend(failures)
+    return backup
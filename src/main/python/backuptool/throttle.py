@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import ctypes
+import platform
+import threading
+import multiprocessing
+
+from datetime import datetime
+
+
+# Number of the ioprio_set syscall per architecture
+_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# Buckets of the rate limits per backup, shared by the threads of a process
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+# Buckets of the rate limits for all backups of a run, see set_global_limit()
+_global_buckets = {}
+
+
+def _minutes(value):
+    """Return the minutes since midnight of a time like '08:30'"""
+    hours, minutes = value.strip().split(':')
+    if not 0 <= int(hours) <= 24 or not 0 <= int(minutes) < 60:
+        raise ValueError('Invalid time: {0}'.format(value))
+    return int(hours) * 60 + int(minutes)
+
+
+class RateLimit(object):
+    """Rate in bytes per second, which could change by the time of day
+
+    The windows are (start, end, rate) tuples with start and end like
+    '08:00', a window with an end before its start spans midnight. Within
+    a window its rate applies, else the default rate. A rate of None or 0
+    means unlimited.
+    """
+
+    def __init__(self, rate=None, windows=None):
+        self.default = rate or None
+        self.windows = [(_minutes(start), _minutes(end), rate or None)
+                        for start, end, rate in windows or []]
+
+    def rate(self, now=None):
+        """Return the rate at the given (or the current) time"""
+        if not self.windows:
+            return self.default
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            if start <= minute < end or (end < start and
+                                         (minute >= start or minute < end)):
+                return rate
+        return self.default
+
+
+class TokenBucket(object):
+    """Token bucket, which limits the bytes per second of its users
+
+    Every user takes the tokens for the bytes it transferred and sleeps, if
+    the bucket is empty. The bucket holds at most one second of the rate,
+    so bursts after an idle time are short. All threads which use the same
+    bucket share its rate. A shared bucket keeps its state in shared
+    memory, so the processes forked after its creation share it, too.
+    """
+
+    def __init__(self, limit, shared=False):
+        self.limit = limit
+        if shared:
+            self.state = multiprocessing.Array('d', [0, time.monotonic()])
+            self.lock = self.state.get_lock()
+        else:
+            self.state = [0, time.monotonic()]
+            self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take amount tokens, wait until the rate allows the transfer"""
+        rate = self.limit.rate()
+        with self.lock:
+            now = time.monotonic()
+            if not rate:
+                self.state[0], self.state[1] = 0, now
+                return
+            tokens = min(self.state[0] + (now - self.state[1]) * rate, rate)
+            # Tokens below zero are the debt of the waiting users
+            self.state[0], self.state[1] = tokens - amount, now
+        if tokens < amount:
+            time.sleep((amount - tokens) / float(rate))
+
+
+class Throttle(object):
+    """All rate limits which apply to one kind of transfer of a backup"""
+
+    def __init__(self, buckets):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+
+    def consume(self, amount):
+        """Wait until all rate limits allow the transfer of amount bytes"""
+        for bucket in self.buckets:
+            bucket.consume(amount)
+
+    def reader(self, fileobj):
+        """Return fileobj, read within the rate limits"""
+        if not self.buckets:
+            return fileobj
+        return ThrottledReader(fileobj, self)
+
+
+class ThrottledReader(object):
+    """File object wrapper which reads within the limits of a throttle"""
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        """Read from the wrapped file object and wait for the rate limits"""
+        data = self.fileobj.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+
+def set_global_limit(kind, limit):
+    """Limit the transfers of the given kind of all backups of this run
+
+    Has to be called before the worker processes are forked.
+    """
+    if limit is None:
+        _global_buckets.pop(kind, None)
+        return
+    _global_buckets[kind] = TokenBucket(limit, shared=True)
+
+
+def open_throttle(kind, name, limit, key=None):
+    """Return the throttle of the given kind of transfer of a backup
+
+    All users of the same backup, kind and key (e.g. the targets of a
+    backup with the same configured limit) share a bucket. The global limit
+    of the kind applies in addition.
+    """
+    bucket = None
+    if limit is not None:
+        with _buckets_lock:
+            bucket = _buckets.get((kind, name, key))
+            if bucket is None:
+                bucket = _buckets[(kind, name, key)] = TokenBucket(limit)
+    return Throttle([bucket, _global_buckets.get(kind)])
+
+
+class Priority(object):
+    """CPU and I/O scheduling priority of the background work of a backup
+
+    nice is the nice value (-20 to 19), ionice the I/O scheduling class
+    ('idle', 'best-effort' or 'realtime') with an optional level like
+    'best-effort:7'. Both are per thread on linux, so they could be applied
+    to single threads of the backup as well as to child processes.
+    """
+
+    def __init__(self, nice=None, ionice=None):
+        self.nice = None if nice is None else int(nice)
+        self.ioprio = None
+        if ionice is not None:
+            io_class, _, level = str(ionice).partition(':')
+            if io_class not in IOPRIO_CLASSES:
+                raise ValueError('Invalid ionice class: {0}'.format(io_class))
+            if platform.machine() not in _IOPRIO_SET:
+                raise ValueError('ionice is not supported on {0}'.format(
+                    platform.machine()))
+            level = int(level or 4) if io_class != 'idle' else 0
+            if not 0 <= level <= 7:
+                raise ValueError('Invalid ionice level: {0}'.format(level))
+            self.ioprio = (IOPRIO_CLASSES[io_class] << _IOPRIO_CLASS_SHIFT |
+                           level)
+
+    def apply(self, pid=0):
+        """Set the priority of a process, 0 is the calling thread"""
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+        if self.ioprio is not None:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.syscall(_IOPRIO_SET[platform.machine()],
+                            _IOPRIO_WHO_PROCESS, pid, self.ioprio) < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+
+
+class TransferJournal(object):
+    """State of an interrupted transfer, kept in the state directory
+
+    The state is a dict with at least the direction ('upload' or
+    'download'), the remote name, the local path and the sha256 sums of
+    all chunks which were transferred so far. It is written after every
+    chunk, so a later run could check where to resume.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Return the stored state or None"""
+        try:
+            with open(self.path) as journal_file:
+                return json.load(journal_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, state):
+        """Store the given state atomically
+
+        The journal is only needed to resume a transfer, so a state
+        directory which is not writable does not break the transfer itself.
+        """
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            temp_path = '{0}.{1}'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as journal_file:
+                json.dump(state, journal_file)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        """Remove the journal after a completed transfer"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def file_checksum(fileobj, offset, length):
+    """Return the sha256 of length bytes of the file from offset on"""
+    fileobj.seek(offset)
+    digest = hashlib.sha256()
+    remaining = length
+    while remaining > 0:
+        data = fileobj.read(min(remaining, 1024 * 1024))
+        if not data:
+            break
+        digest.update(data)
+        remaining -= len(data)
+    return digest.hexdigest()
+
+
+class ChecksumFile(object):
+    """File object wrapper which records the sha256 of every chunk
+
+    The checksum of every completed chunk is appended to the given list and
+    checkpoint() is called afterwards, e.g. to write the journal. Works for
+    reading (uploads) and writing (downloads).
+    """
+
+    def __init__(self, fileobj, chunk_size, checksums, checkpoint):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.checksums = checksums
+        self.checkpoint = checkpoint
+        self.digest = hashlib.sha256()
+        self.filled = 0
+
+    def _update(self, data):
+        """Add the data to the checksum of the current chunk"""
+        view = memoryview(data)
+        while len(view):
+            part = view[:self.chunk_size - self.filled]
+            self.digest.update(part)
+            self.filled += len(part)
+            view = view[len(part):]
+            if self.filled == self.chunk_size:
+                self.checksums.append(self.digest.hexdigest())
+                self.digest = hashlib.sha256()
+                self.filled = 0
+                self.checkpoint()
+
+    def read(self, size=-1):
+        """Read from the wrapped file object"""
+        data = self.fileobj.read(size)
+        self._update(data)
+        return data
+
+    def write(self, data):
+        """Write to the wrapped file object"""
+        self.fileobj.write(data)
+        self._update(data)
+        return len(data)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the asyncio interface of backuptool"""
+
+import os
+import shutil
+import asyncio
+import tempfile
+
+from mock import patch
+from unittest2 import TestCase
+from backuptool.aio import AsyncBackup
+
+
+class AsyncBackupTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.workdir = tempfile.mkdtemp(prefix='backuptool-aio-tests-')
+        self.target_dirs = ['{0}/target_{1}'.format(self.workdir, number)
+                            for number in range(2)]
+        for target_dir in self.target_dirs:
+            os.makedirs(target_dir)
+            for timestamp in ['20170101000000', '20170102000000']:
+                open('{0}/backup-test-{1}.tar.gz'.format(
+                    target_dir, timestamp), 'w').close()
+        self.config = {
+            'rotate': 1,
+            'state_dir': '{0}/state'.format(self.workdir),
+            'targets': ['file://{0}'.format(target_dir)
+                        for target_dir in self.target_dirs]
+        }
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.workdir)
+
+    def _open(self):
+        return self.loop.run_until_complete(
+            AsyncBackup.open('test', self.config, self.workdir))
+
+    @patch('builtins.print')
+    def test_should_list_all_targets(self, mock_print):
+        backup = self._open()
+        self.loop.run_until_complete(backup.list())
+        printed = ' '.join(str(call) for call in mock_print.call_args_list)
+        self.assertEqual(printed.count('backup-test-20170101000000'), 2)
+
+    def test_should_rotate_and_delete_on_all_targets(self):
+        backup = self._open()
+        self.loop.run_until_complete(backup.rotate())
+        for target_dir in self.target_dirs:
+            self.assertEqual(os.listdir(target_dir),
+                             ['backup-test-20170102000000.tar.gz'])
+        self.loop.run_until_complete(
+            backup.delete('backup-test-20170102000000.tar.gz'))
+        self.loop.run_until_complete(backup.close())
+        for target_dir in self.target_dirs:
+            self.assertEqual(os.listdir(target_dir), [])
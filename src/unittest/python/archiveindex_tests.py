@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the archive index of backuptool"""
+
+import io
+
+from unittest2 import TestCase
+from backuptool.archiveindex import (
+    ArchiveIndex,
+    ArchiveIndexError,
+    LimitedReader,
+    RangeReader
+)
+
+
+class ArchiveIndexTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.index = ArchiveIndex('gzip', [[0, 0], [1000, 300], [2000, 700]])
+        self.index.add('/srv/data', 0, 512, 0, None)
+        self.index.add('/srv/data/a', 512, 1024, 400, 'digest_a')
+        self.index.add('/srv/data/b', 1536, 1024, 400, 'digest_b')
+        self.index.add('/srv/other', 2560, 512, 10, 'digest_other')
+
+    def test_should_survive_serialization(self):
+        index = ArchiveIndex.loads(self.index.dumps())
+        self.assertEqual(index.compression, 'gzip')
+        self.assertEqual(index.blocks, self.index.blocks)
+        self.assertEqual(index.members, self.index.members)
+
+    def test_should_reject_invalid_index(self):
+        self.assertRaises(ArchiveIndexError, ArchiveIndex.loads, b'{')
+        self.assertRaises(ArchiveIndexError, ArchiveIndex.loads,
+                          b'{"version": 99}')
+
+    def test_should_find_directory_content(self):
+        paths = [member['path'] for member in self.index.find('/srv/data')]
+        self.assertEqual(paths, ['/srv/data', '/srv/data/a', '/srv/data/b'])
+        paths = [member['path'] for member in self.index.find('*/b')]
+        self.assertEqual(paths, ['/srv/data/b'])
+
+    def test_should_return_blocks_around_a_range(self):
+        self.assertEqual(self.index.block_range(512, 1536), (0, 0, 700))
+        self.assertEqual(self.index.block_range(2560, 3072),
+                         (2000, 700, None))
+        index = ArchiveIndex('none')
+        self.assertEqual(index.block_range(512, 1536), (512, 512, 1536))
+
+    def test_should_merge_members_of_neighbouring_blocks(self):
+        members = self.index.members
+        ranges = list(self.index.ranges([members[3], members[0]]))
+        self.assertEqual(len(ranges), 2)
+        self.assertEqual(ranges[0][:3], (0, 0, 300))
+        self.assertEqual(ranges[1][:3], (2000, 700, None))
+        ranges = list(self.index.ranges(members))
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(ranges[0][:3], (0, 0, None))
+        self.assertEqual(ranges[0][3], members)
+
+    def test_should_read_ranges_piece_by_piece(self):
+        data = bytes(bytearray(range(256))) * 10
+        reads = []
+
+        def read(offset, length):
+            reads.append((offset, length))
+            return data[offset:offset + length]
+        reader = RangeReader(read, 100, 1100, 300)
+        limited = LimitedReader(reader, 500)
+        self.assertEqual(limited.read(10), data[100:110])
+        limited.skip()
+        self.assertEqual(limited.read(), b'')
+        self.assertEqual(reader.read(), data[600:1100])
+        self.assertEqual(reads[:2], [(100, 300), (400, 300)])
+        self.assertEqual(LimitedReader(io.BytesIO(b'abc'), 2).read(), b'ab')
@@ -2,13 +2,15 @@
 
 """Test suite for testing the basic functionality of backuptool"""
 
+import io
 import os
+import gzip
 import shutil
 import tempfile
 
-from mock import patch
+from mock import patch, MagicMock
 from unittest2 import TestCase
-from backuptool.backup import Backup
+from backuptool.backup import Backup, CallingUserError, default_state_dir
 
 
 class BackupBaseTests(TestCase):
@@ -21,6 +23,10 @@ class BackupBaseTests(TestCase):
             'mysql_databases': ['test_db_1', 'test_db_2'],
             'mysql_user': 'testuser',
             'mysql_password': 'testpassword',
+            'mysql_dump_jobs': 2,
+            'mysql_single_transaction': True,
+            'mysql_restore_jobs': 2,
+            'mysql_disable_checks': True,
             'ldap_backup': {
                 'datadir': '/tmp/ldap',
                 'system_user': 'ldap',
@@ -43,7 +49,80 @@ class BackupBaseTests(TestCase):
         self.backup.restore_ldap()
         self.backup.restore_files()
 
+    @patch('subprocess.Popen')
     @patch('subprocess.check_call')
-    def test_dump_commands(self, mock_check_call):
+    def test_dump_commands(self, mock_check_call, mock_popen):
+        def popen(cmd, **kwargs):
+            process = MagicMock()
+            process.stdout = io.BytesIO(b'-- dump of ' + cmd[-1].encode())
+            process.wait.return_value = 0
+            return process
+        mock_popen.side_effect = popen
         self.backup.dump_database()
         self.backup.dump_ldap()
+        for database in ['test_db_1', 'test_db_2']:
+            dump_path = '{0}/mysql/{1}.sql.gz'.format(self.backup_test_workdir,
+                                                      database)
+            with gzip.open(dump_path) as dump:
+                self.assertEqual(dump.read(),
+                                 b'-- dump of ' + database.encode())
+            self.assertEqual(self.backup.dump_stats[database]['bytes'],
+                             len(b'-- dump of ') + len(database))
+        cmd = mock_popen.call_args_list[0][0][0]
+        self.assertIn('--single-transaction', cmd)
+        self.assertEqual(mock_popen.call_args[0][0][0], 'slapcat')
+
+    @patch('subprocess.Popen')
+    def test_should_import_dumps_concurrently(self, mock_popen):
+        imported = {}
+
+        def popen(cmd, **kwargs):
+            process = MagicMock()
+            process.stdin = io.BytesIO()
+            process.stdin.close = lambda: imported.update(
+                {cmd[-1]: process.stdin.getvalue()})
+            process.wait.return_value = 0
+            return process
+        mock_popen.side_effect = popen
+        mysql_dir = '{0}/mysql'.format(self.backup_test_workdir)
+        os.makedirs(mysql_dir)
+        with gzip.open('{0}/test_db_1.sql.gz'.format(mysql_dir), 'wb') as f:
+            f.write(b'INSERT 1;')
+        with open('{0}/test_db_2.sql'.format(mysql_dir), 'wb') as f:
+            f.write(b'INSERT 2;')
+        self.backup.restore_database()
+        self.assertEqual(imported, {'test_db_1': b'INSERT 1;',
+                                    'test_db_2': b'INSERT 2;'})
+        self.assertEqual(os.listdir(mysql_dir), [])
+        cmd = mock_popen.call_args[0][0]
+        self.assertTrue(any('FOREIGN_KEY_CHECKS=0' in option
+                            for option in cmd))
+
+    def test_should_split_dump_names(self):
+        self.assertEqual(self.backup.split_dump_name('db.sql.gz'),
+                         ('db', 'gzip'))
+        self.assertEqual(self.backup.split_dump_name('my.db.sql'),
+                         ('my.db', 'none'))
+
+    @patch('subprocess.Popen')
+    def test_should_kill_process_without_priority(self, mock_popen):
+        process = mock_popen.return_value
+        with patch.object(self.backup.priority, 'apply',
+                          side_effect=OSError(1, 'Not permitted')):
+            self.assertRaises(OSError, self.backup.start_process,
+                              ['mysqldump'])
+        process.kill.assert_called_with()
+        process.wait.assert_called_with()
+
+    def test_should_keep_the_state_of_users_in_their_home(self):
+        with patch('os.geteuid', return_value=1000), \
+                patch.dict('os.environ', {'XDG_STATE_HOME': '/home/u/state'}):
+            self.assertEqual(default_state_dir(), '/home/u/state/backuptool')
+        with patch('os.geteuid', return_value=0):
+            self.assertEqual(default_state_dir(), '/var/lib/backuptool')
+
+    def test_should_explain_an_unwritable_state_dir(self):
+        self.backup.state_dir = '/var/lib/backuptool-test'
+        with patch('os.makedirs', side_effect=PermissionError(
+                13, 'Permission denied')):
+            self.assertRaises(CallingUserError, self.backup.index_path)
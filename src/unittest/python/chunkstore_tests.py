@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the chunk store functionality of backuptool"""
+
+import io
+import os
+import random
+
+from unittest2 import TestCase
+from backuptool.chunkstore import Chunker
+
+
+class ChunkerTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.chunker = Chunker(average_size=4096)
+        generator = random.Random(42)
+        self.data = bytes(bytearray(generator.getrandbits(8)
+                                    for _ in range(256 * 1024)))
+
+    def test_should_respect_chunk_size_limits(self):
+        chunks = list(self.chunker.chunks(io.BytesIO(self.data)))
+        self.assertEqual(b''.join(chunks), self.data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(self.chunker.min_size <= len(chunk))
+            self.assertTrue(len(chunk) <= self.chunker.max_size)
+
+    def test_should_keep_chunks_after_insertion(self):
+        chunks = set(self.chunker.chunks(io.BytesIO(self.data)))
+        modified = self.data[:1000] + os.urandom(10) + self.data[1000:]
+        modified_chunks = set(self.chunker.chunks(io.BytesIO(modified)))
+        self.assertTrue(len(chunks & modified_chunks) >= len(chunks) - 2)
+
+    def test_should_handle_empty_input(self):
+        self.assertEqual(list(self.chunker.chunks(io.BytesIO(b''))), [])
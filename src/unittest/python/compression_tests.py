@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the compression functionality of backuptool"""
+
+import io
+import os
+import gzip
+
+from unittest2 import TestCase
+from backuptool.compression import (
+    CompressionError,
+    ParallelGzipWriter,
+    compression_by_name,
+    open_reader,
+    open_writer
+)
+
+
+class CompressionTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.data = os.urandom(512 * 1024) + b'compressible' * 100000
+
+    def _roundtrip(self, compression):
+        target = io.BytesIO()
+        writer = open_writer(target, compression, threads=4)
+        for position in range(0, len(self.data), 100000):
+            writer.write(self.data[position:position + 100000])
+        writer.close()
+        self.assertFalse(target.closed)
+        target.seek(0)
+        return target.getvalue(), open_reader(target, compression).read()
+
+    def test_should_roundtrip_all_compressions(self):
+        for compression in ['none', 'gzip', 'pgzip', 'zstd', 'lz4']:
+            try:
+                _, data = self._roundtrip(compression)
+            except CompressionError:
+                # Optional compression module is not installed
+                continue
+            self.assertEqual(data, self.data)
+
+    def test_parallel_gzip_should_be_gzip_compatible(self):
+        compressed, _ = self._roundtrip('pgzip')
+        self.assertEqual(gzip.decompress(compressed), self.data)
+
+    def test_parallel_gzip_should_keep_block_order(self):
+        target = io.BytesIO()
+        writer = ParallelGzipWriter(target, threads=3, block_size=1000)
+        writer.write(self.data)
+        writer.close()
+        self.assertEqual(gzip.decompress(target.getvalue()), self.data)
+
+    def test_block_writer_should_record_independent_blocks(self):
+        target = io.BytesIO()
+        writer = open_writer(target, 'gzip', threads=4, blocks=True)
+        writer.write(self.data)
+        writer.close()
+        compressed = target.getvalue()
+        self.assertEqual(writer.blocks[0], [0, 0])
+        self.assertEqual(len(writer.blocks), 2)
+        # Decompression could start at every recorded block
+        offset, compressed_offset = writer.blocks[1]
+        self.assertEqual(gzip.decompress(compressed[compressed_offset:]),
+                         self.data[offset:])
+
+    def test_should_detect_compression_by_name(self):
+        self.assertEqual(compression_by_name('backup-a-1.tar.gz.gpg'), 'gzip')
+        self.assertEqual(compression_by_name('backup-a-1.tar.zst'), 'zstd')
+        self.assertEqual(compression_by_name('backup-a-1.inc.tar.lz4'), 'lz4')
+        self.assertEqual(compression_by_name('backup-a-1.tar'), 'none')
+
+    def test_should_reject_unknown_compression(self):
+        self.assertRaises(CompressionError, open_writer, io.BytesIO(), 'rar')
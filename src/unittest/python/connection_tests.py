@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the connection pool of backuptool"""
+
+import time
+
+from mock import MagicMock, patch
+from unittest2 import TestCase
+from backuptool.connection import ConnectionPool, reconnecting
+
+
+class PooledBackup(object):
+    """Minimal user of a pooled connection"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.calls = 0
+        self.reconnect = MagicMock(side_effect=self._reconnect)
+
+    def _reconnect(self):
+        self.connection = MagicMock()
+
+    @reconnecting()
+    def operation(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise EOFError('connection lost')
+        return self.connection
+
+    @reconnecting(retry=False)
+    def stream_operation(self):
+        raise EOFError('connection lost')
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.pool = ConnectionPool()
+        self.key = ('ftp', 'ftp.example.com', 21, 'user')
+
+    def test_should_reuse_released_connections(self):
+        connection = MagicMock()
+        connection.is_healthy.return_value = True
+        connect = MagicMock(return_value=connection)
+        self.assertIs(self.pool.acquire(self.key, connect), connection)
+        self.pool.release(self.key, connection)
+        self.assertIs(self.pool.acquire(self.key, connect), connection)
+        self.assertEqual(connect.call_count, 1)
+        # A connection is only handed out once at a time
+        self.pool.acquire(self.key, connect)
+        self.assertEqual(connect.call_count, 2)
+
+    def test_should_replace_broken_connections(self):
+        broken = MagicMock()
+        broken.is_healthy.return_value = False
+        self.pool.release(self.key, broken)
+        connection = MagicMock()
+        self.assertIs(self.pool.acquire(self.key, lambda: connection),
+                      connection)
+        broken.close.assert_called_once_with()
+
+    def test_should_drop_connections_of_the_parent_process(self):
+        connection = MagicMock()
+        self.pool.release(self.key, connection)
+        with patch('os.getpid', return_value=self.pool.pid + 1):
+            self.pool.close_all()
+        connection.close.assert_not_called()
+        self.assertEqual(self.pool.idle, {})
+
+    def test_should_repeat_operation_on_new_connection(self):
+        broken = MagicMock()
+        broken.is_healthy.return_value = False
+        backup = PooledBackup(broken)
+        self.assertIsNot(backup.operation(), broken)
+        self.assertEqual(backup.calls, 2)
+        backup = PooledBackup(broken)
+        self.assertRaises(EOFError, backup.stream_operation)
+        self.assertEqual(backup.reconnect.call_count, 1)
+
+    def test_should_raise_errors_of_healthy_connections(self):
+        healthy = MagicMock()
+        healthy.is_healthy.return_value = True
+        backup = PooledBackup(healthy)
+        self.assertRaises(EOFError, backup.operation)
+        backup.reconnect.assert_not_called()
+
+    def test_should_send_keepalives_without_blocking_the_pool(self):
+        locked = []
+
+        def keepalive():
+            # Other backups could use the pool meanwhile
+            locked.append(not self.pool.lock.acquire(False))
+            self.pool.lock.release()
+        idle, broken, fresh = MagicMock(), MagicMock(), MagicMock()
+        for connection in [idle, broken, fresh]:
+            connection.keepalive = 30
+            connection.last_used = 0
+        fresh.last_used = time.time()
+        idle.send_keepalive.side_effect = keepalive
+        broken.send_keepalive.side_effect = EOFError('connection lost')
+        self.pool.idle[self.key] = [idle, broken, fresh]
+        self.assertTrue(self.pool.send_keepalives())
+        self.assertEqual(locked, [False])
+        broken.close.assert_called_once_with()
+        fresh.send_keepalive.assert_not_called()
+        self.assertEqual(self.pool.idle[self.key], [fresh, idle])
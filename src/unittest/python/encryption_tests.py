@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the encryption functionality of backuptool"""
+
+import io
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from unittest2 import TestCase
+from backuptool.encryption import (
+    AESGCMCipher,
+    DecryptionError,
+    EncryptionError,
+    GPGCipher,
+    _ProcessWriter,
+    encryption_by_name,
+    open_cipher,
+    strip_extension
+)
+
+
+class EncryptionTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.workdir = tempfile.mkdtemp(prefix='backuptool-encryption-tests-')
+        self.key_file = '{0}/backup.key'.format(self.workdir)
+        with open(self.key_file, 'w') as key_file:
+            key_file.write('{0}\n'.format('ab' * 32))
+        self.config = {
+            'encryption_key_file': self.key_file,
+            'encryption_chunk_size': 1024,
+            'encryption_threads': 4
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_should_roundtrip_aes_gcm_of_any_size(self):
+        cipher = open_cipher('aes-gcm', self.config)
+        for size in [0, 1, 1024, 4096, 10000]:
+            data = os.urandom(size)
+            self.assertEqual(cipher.decrypt(cipher.encrypt(data)), data)
+
+    def test_should_not_leak_the_plaintext_of_aes_gcm(self):
+        # A long plaintext, few random bytes appear in any ciphertext by chance
+        data = b'backuptool plaintext ' * 100
+        encrypted = open_cipher('aes-gcm', self.config).encrypt(data)
+        self.assertNotIn(data[:64], encrypted)
+
+    def test_should_read_plain_ranges_of_aes_gcm(self):
+        cipher = open_cipher('aes-gcm', self.config)
+        data = os.urandom(10000)
+        encrypted = cipher.encrypt(data)
+        reads = []
+
+        def read(offset, length):
+            reads.append(length)
+            return encrypted[offset:offset + length]
+        reader = cipher.plain_reader(read, len(encrypted))
+        self.assertEqual(reader.size, len(data))
+        for offset, length in [(0, 10), (4000, 200), (5000, 5000),
+                               (9999, 100), (10000, 1)]:
+            self.assertEqual(reader.read(offset, length),
+                             data[offset:offset + length])
+        # Only the chunks around a range are read
+        self.assertTrue(max(reads[1:]) < len(encrypted))
+
+    def test_should_stream_through_aes_gcm_stages(self):
+        cipher = open_cipher('aes-gcm', self.config)
+        data = os.urandom(50000)
+        encrypted = io.BytesIO()
+        writer = cipher.encryptor(encrypted)
+        for position in range(0, len(data), 333):
+            writer.write(data[position:position + 333])
+        writer.close()
+        decrypted = io.BytesIO()
+        writer = cipher.decryptor(decrypted)
+        encrypted = encrypted.getvalue()
+        for position in range(0, len(encrypted), 7):
+            writer.write(encrypted[position:position + 7])
+        writer.close()
+        self.assertEqual(decrypted.getvalue(), data)
+
+    def test_should_detect_modified_and_truncated_data(self):
+        cipher = open_cipher('aes-gcm', self.config)
+        encrypted = cipher.encrypt(os.urandom(4000))
+        modified = bytearray(encrypted)
+        modified[-100] ^= 1
+        self.assertRaises(DecryptionError, cipher.decrypt, bytes(modified))
+        # Cut at a chunk boundary: 3 of 4 chunks
+        header_size = len(encrypted) - 4000 - 4 * 16
+        truncated = encrypted[:header_size + 3 * (1024 + 16)]
+        self.assertRaises(DecryptionError, cipher.decrypt, truncated)
+        self.assertRaises(DecryptionError, cipher.decrypt, b'')
+        with open(self.key_file, 'wb') as key_file:
+            key_file.write(os.urandom(32))
+        other_cipher = open_cipher('aes-gcm', self.config)
+        self.assertRaises(DecryptionError, other_cipher.decrypt, encrypted)
+
+    def test_should_reject_invalid_keys(self):
+        with open(self.key_file, 'w') as key_file:
+            key_file.write('too short')
+        self.assertRaises(EncryptionError, open_cipher, 'aes-gcm',
+                          self.config)
+        self.assertRaises(EncryptionError, open_cipher, 'aes-gcm', {})
+        self.assertRaises(EncryptionError, open_cipher, 'rot13', {})
+        raw_key = os.urandom(32)
+        with open(self.key_file, 'wb') as key_file:
+            key_file.write(raw_key)
+        self.assertEqual(AESGCMCipher.read_key(self.key_file), raw_key)
+
+    def test_should_pipe_through_process(self):
+        output = io.BytesIO()
+        writer = _ProcessWriter(['cat'], output, EncryptionError, 'failed')
+        writer.write(b'x' * 200000)
+        writer.close()
+        self.assertEqual(output.getvalue(), b'x' * 200000)
+        writer = _ProcessWriter(['false'], output, EncryptionError, 'failed')
+        self.assertRaises(EncryptionError, writer.close)
+
+    @patch('backuptool.encryption._ProcessWriter')
+    def test_should_disable_gpg_compression(self, mock_writer):
+        cipher = GPGCipher({'gpg_key_id': '1A2B3C4D',
+                            'gpg_cipher': 'CAMELLIA256'})
+        cipher.encryptor(io.BytesIO())
+        cmd = mock_writer.call_args[0][0]
+        self.assertEqual(cmd[-3:], ['--recipient', '1A2B3C4D', '--encrypt'])
+        self.assertIn('--compress-algo', cmd)
+        self.assertEqual(cmd[cmd.index('--compress-algo') + 1], 'none')
+        self.assertEqual(cmd[cmd.index('--cipher-algo') + 1], 'CAMELLIA256')
+        self.assertRaises(EncryptionError, GPGCipher({}).encryptor,
+                          io.BytesIO())
+
+    def test_should_recognize_encrypted_names(self):
+        self.assertEqual(encryption_by_name('backup-a-1.tar.gz.gpg'), 'gpg')
+        self.assertEqual(encryption_by_name('backup-a-1.tar.aes'), 'aes-gcm')
+        self.assertIsNone(encryption_by_name('backup-a-1.tar.gz'))
+        self.assertEqual(strip_extension('backup-a-1.manifest.aes'),
+                         'backup-a-1.manifest')
+        self.assertEqual(strip_extension('backup-a-1.tar'), 'backup-a-1.tar')
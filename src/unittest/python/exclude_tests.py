@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the exclude functionality of backuptool"""
+
+import os
+import stat
+import shutil
+import socket
+import tarfile
+import tempfile
+
+from unittest2 import TestCase
+from backuptool.file import FileBackup
+from backuptool.exclude import ExcludeMatcher
+
+
+class FakeStats(object):
+    def __init__(self, mode, size=0):
+        self.st_mode = mode
+        self.st_size = size
+
+
+REGULAR = FakeStats(stat.S_IFREG | 0o644, 10)
+DIRECTORY = FakeStats(stat.S_IFDIR | 0o755)
+
+
+class ExcludeMatcherTests(TestCase):
+    def test_should_match_names_at_any_depth(self):
+        matcher = ExcludeMatcher(['*.log'])
+        self.assertTrue(matcher.matches('/var/log/app.log', False))
+        self.assertTrue(matcher.matches('app.log', False))
+        self.assertFalse(matcher.matches('/var/log/app.log.1', False))
+        self.assertFalse(matcher.matches('/var/app.log/data', False))
+
+    def test_should_match_directory_patterns_on_directories_only(self):
+        matcher = ExcludeMatcher(['node_modules/'])
+        self.assertTrue(matcher.matches('/src/node_modules', True))
+        self.assertFalse(matcher.matches('/src/node_modules', False))
+
+    def test_should_anchor_patterns_with_leading_slash(self):
+        matcher = ExcludeMatcher(['/data/tmp'])
+        self.assertTrue(matcher.matches('/data/tmp', True))
+        self.assertFalse(matcher.matches('/other/data/tmp', True))
+
+    def test_should_match_across_directories(self):
+        matcher = ExcludeMatcher(['**/cache/*.bin', 'a?c', '[!x]yz'])
+        self.assertTrue(matcher.matches('/home/cache/blob.bin', False))
+        self.assertTrue(matcher.matches('/home/a/b/cache/blob.bin', False))
+        self.assertFalse(matcher.matches('/home/cache/sub/blob.bin', False))
+        self.assertTrue(matcher.matches('/abc', False))
+        self.assertFalse(matcher.matches('/a/c', False))
+        self.assertTrue(matcher.matches('/ayz', False))
+        self.assertFalse(matcher.matches('/xyz', False))
+
+    def test_should_let_last_matching_pattern_win(self):
+        matcher = ExcludeMatcher(['# comment', '', '*.log', '!keep.log'])
+        self.assertTrue(matcher.matches('/var/app.log', False))
+        self.assertFalse(matcher.matches('/var/keep.log', False))
+        self.assertIsNone(matcher.any_regex)
+
+    def test_should_exclude_large_files_and_count_them(self):
+        matcher = ExcludeMatcher(['tmp/'], max_file_size=5)
+        self.assertTrue(matcher.excludes('/data/big', REGULAR))
+        self.assertFalse(matcher.excludes('/data/big', FakeStats(
+            stat.S_IFREG | 0o644, 5)))
+        self.assertTrue(matcher.excludes('/data/tmp', DIRECTORY))
+        self.assertEqual(matcher.pruned_files, 1)
+        self.assertEqual(matcher.pruned_bytes, 10)
+        self.assertEqual(matcher.pruned_directories, 1)
+
+    def test_should_skip_special_files(self):
+        fifo = FakeStats(stat.S_IFIFO | 0o644)
+        link = FakeStats(stat.S_IFLNK | 0o777)
+        self.assertFalse(ExcludeMatcher().excludes('/data/fifo', fifo))
+        matcher = ExcludeMatcher(skip_special_files=True)
+        self.assertTrue(matcher.excludes('/data/fifo', fifo))
+        self.assertFalse(matcher.excludes('/data/link', link))
+        self.assertFalse(matcher.excludes('/data', DIRECTORY))
+
+
+class ExcludeArchiveTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.workdir = tempfile.mkdtemp(prefix='backuptool-exclude-tests-')
+        self.source_dir = '{0}/source'.format(self.workdir)
+        self.backup_target_dir = '{0}/target'.format(self.workdir)
+        self.backup_test_workdir = '{0}/workdir'.format(self.workdir)
+        os.makedirs('{0}/node_modules/pkg'.format(self.source_dir))
+        os.makedirs(self.backup_target_dir)
+        os.makedirs(self.backup_test_workdir)
+        for name, data in [('keep.txt', 'keep'), ('app.log', 'log'),
+                           ('big.bin', 'x' * 100),
+                           ('node_modules/pkg/index.js', 'js')]:
+            with open('{0}/{1}'.format(self.source_dir, name), 'w') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_should_leave_excluded_files_out_of_archive(self):
+        server = socket.socket(socket.AF_UNIX)
+        server.bind('{0}/socket'.format(self.source_dir))
+        backup = FileBackup('test_backup', config={
+            'target': 'file://{0}'.format(self.backup_target_dir),
+            'state_dir': '{0}/state'.format(self.workdir),
+            'files': [self.source_dir],
+            'exclude': ['*.log', 'node_modules/'],
+            'max_file_size': 50,
+            'skip_special_files': True
+        }, workdir=self.backup_test_workdir)
+        try:
+            backup.tar_workdir()
+        finally:
+            server.close()
+        with tarfile.open(backup.filename_abs) as tar:
+            names = [os.path.basename(name) for name in tar.getnames()]
+        self.assertIn('keep.txt', names)
+        for name in ['app.log', 'big.bin', 'node_modules', 'pkg',
+                     'index.js', 'socket']:
+            self.assertNotIn(name, names)
+        self.assertEqual(backup.matcher.pruned_files, 3)
+        self.assertEqual(backup.matcher.pruned_directories, 1)
+        self.assertEqual(backup.matcher.pruned_bytes, 103)
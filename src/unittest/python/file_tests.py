@@ -2,13 +2,24 @@
 
 """Test suite for testing the file target functionality of backuptool"""
 
+import io
 import os
+import glob
+import errno
+import hashlib
 import shutil
+import socket
+import tarfile
 import tempfile
 
 from mock import patch
 from unittest2 import TestCase
 from backuptool.file import FileBackup
+from backuptool.archiveindex import ArchiveIndexError
+from backuptool.chunkstore import ChunkStore
+from backuptool.encryption import EncryptionError
+from backuptool.filecopy import FICLONE, CopyError, copy_file
+from backuptool.stream import StreamError
 
 
 class FileBackupTests(TestCase):
@@ -33,6 +44,8 @@ class FileBackupTests(TestCase):
         file_based_config = {
             'target': 'file://{0}'.format(self.backup_target_dir),
             'rotate': 3,
+            'state_dir': '{0}/state'.format(self.workdir),
+            'transfer_chunk_size': 1024,
             'files': self.file_patterns
         }
         self.backup = FileBackup('test_backup',
@@ -42,18 +55,526 @@ class FileBackupTests(TestCase):
     def tearDown(self):
         shutil.rmtree(self.workdir)
 
-    def test_copy_function(self):
-        self.backup.copy_files()
+    def test_should_archive_sources_directly(self):
+        self.backup.tar_workdir()
+        with tarfile.open(self.backup.filename_abs) as tar:
+            names = tar.getnames()
+        source_dir = './files/{0}'.format(self.file_source_dir.lstrip('/'))
+        self.assertIn('{0}/file_1'.format(source_dir), names)
+        self.assertIn('{0}/dir_1'.format(source_dir), names)
+        # Nothing is copied to the working directory
+        self.assertFalse(os.path.exists(
+            '{0}/files'.format(self.backup_test_workdir)))
+
+    def test_create_stream(self):
+        self.backup.create_stream()
+        pattern = '{0}/backup-test_backup-*.tar.gz'
+        backup_files = glob.glob(pattern.format(self.backup_target_dir))
+        self.assertEqual(len(backup_files), 1)
+        with tarfile.open(backup_files[0]) as tar:
+            names = tar.getnames()
+        expected_file = './files/{0}/file_1'.format(
+            self.file_source_dir.lstrip('/'))
+        self.assertIn(expected_file, names)
+        self.assertEqual(os.listdir(self.backup_test_workdir), [])
+
+    @patch('builtins.print')
+    def test_should_skip_sockets(self, mock_print):
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        socket_path = '{0}/dir_1/socket'.format(self.file_source_dir)
+        listener = socket.socket(socket.AF_UNIX)
+        self.addCleanup(listener.close)
+        listener.bind(socket_path)
+        for stream, incremental in [(False, False), (True, False),
+                                    (True, True)]:
+            self.backup.stream = stream
+            self.backup.incremental = incremental
+            self.backup.create()
+        self.backup.set_existing_backups()
+        for name in self.backup.backup_names():
+            with tarfile.open('{0}/{1}'.format(self.backup_target_dir,
+                                               name)) as tar:
+                names = tar.getnames()
+            self.assertIn('./files/{0}/dir_1'.format(
+                self.file_source_dir.lstrip('/')), names)
+            self.assertFalse([member for member in names
+                              if member.endswith('/socket')])
+        self.assertEqual(self.backup.matcher.pruned_files, 3)
+        with tarfile.open(fileobj=io.BytesIO(), mode='w') as tar:
+            self.assertIsNone(self.backup.add_source_file(tar, socket_path))
+        self.assertEqual(self.backup.matcher.pruned_files, 4)
+
+    def test_should_not_keep_archive_of_failed_stream(self):
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        with open('{0}/file_1'.format(self.file_source_dir), 'wb') as source:
+            source.write(os.urandom(5 * 1024 * 1024))
+        add_source_file = self.backup.add_source_file
+        added = []
+
+        def fail_after_first_file(tar, path):
+            if added:
+                raise IOError('source vanished')
+            added.append(path)
+            return add_source_file(tar, path)
+        self.backup.stream = True
+        for incremental in [False, True]:
+            del added[:]
+            self.backup.incremental = incremental
+            with patch.object(self.backup, 'add_source_file',
+                              side_effect=fail_after_first_file):
+                self.assertRaises(StreamError, self.backup.create)
+            self.backup.set_existing_backups()
+            self.assertEqual(self.backup.backup_names(), [])
+            # Neither a partial copy nor an index is left behind
+            self.assertEqual(os.listdir(self.backup_target_dir), [])
+
+    @patch('builtins.print')
+    def test_restore_stream(self, mock_print):
+        source_file = '{0}/file_1'.format(self.file_source_dir)
+        with open(source_file, 'w') as source:
+            source.write('original')
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        self.backup.create_stream()
+        with open(source_file, 'w') as source:
+            source.write('modified')
+        self.backup.set_existing_backups()
+        self.backup.restore_stream()
+        with open(source_file) as source:
+            self.assertEqual(source.read(), 'original')
+        self.assertEqual(os.listdir(self.backup_test_workdir), [])
+
+    @patch('builtins.print')
+    def test_should_restore_hardlinks_of_stream(self, mock_print):
+        source_file = '{0}/file_1'.format(self.file_source_dir)
+        link_file = '{0}/dir_1/link'.format(self.file_source_dir)
+        with open(source_file, 'w') as source:
+            source.write('original')
+        os.link(source_file, link_file)
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        self.backup.create_stream()
+        os.remove(source_file)
+        os.remove(link_file)
+        self.backup.set_existing_backups()
+        self.backup.restore_stream()
+        with open(link_file) as link:
+            self.assertEqual(link.read(), 'original')
+        self.assertTrue(os.path.samefile(source_file, link_file))
+
+    @patch('builtins.print')
+    def test_restore_aes_gcm_encrypted_stream(self, mock_print):
+        key_file = '{0}/backup.key'.format(self.workdir)
+        with open(key_file, 'wb') as key:
+            key.write(os.urandom(32))
+        self.backup.config['encryption_key_file'] = key_file
+        self.backup.encrypt = True
+        self.backup.encryption = 'aes-gcm'
+        source_file = '{0}/file_1'.format(self.file_source_dir)
+        with open(source_file, 'w') as source:
+            source.write('original')
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        self.backup.create_stream()
+        self.assertEqual(sorted(os.listdir(self.backup_target_dir)),
+                         ['{0}.aes'.format(self.backup.filename),
+                          '{0}.aes.index'.format(self.backup.filename)])
+        with open(source_file, 'w') as source:
+            source.write('modified')
+        self.backup.set_existing_backups()
+        self.backup.encrypt = False
+        self.backup.restore_stream()
+        with open(source_file) as source:
+            self.assertEqual(source.read(), 'original')
+
+    def create_selective_sources(self):
+        """Write three files spread over several compression blocks"""
+        contents = {}
+        for number in range(3):
+            path = '{0}/dir_1/file_{1}'.format(self.file_source_dir, number)
+            contents[path] = os.urandom(700 * 1024)
+            with open(path, 'wb') as source:
+                source.write(contents[path])
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        self.backup.create_stream()
+        self.backup.set_existing_backups()
+        for path in contents:
+            with open(path, 'wb') as source:
+                source.write(b'modified')
+        return sorted(contents.items())
+
+    @patch('builtins.print')
+    def test_restore_single_path_with_ranged_reads(self, mock_print):
+        files = self.create_selective_sources()
+        with patch.object(self.backup, 'download_fileobj',
+                          wraps=self.backup.download_fileobj) as download:
+            self.backup.restore(pattern=files[1][0])
+        # Only the index is downloaded, the archive is read in ranges
+        self.assertEqual(download.call_count, 1)
+        for position, (path, content) in enumerate(files):
+            with open(path, 'rb') as restored:
+                expected = content if position == 1 else b'modified'
+                self.assertEqual(restored.read(), expected)
+
+    @patch('builtins.print')
+    def test_restore_hardlink_with_ranged_reads(self, mock_print):
+        source_file = '{0}/file_1'.format(self.file_source_dir)
+        link_file = '{0}/dir_1/link'.format(self.file_source_dir)
+        content = os.urandom(700 * 1024)
+        with open(source_file, 'wb') as source:
+            source.write(content)
+        os.link(source_file, link_file)
+        files = self.create_selective_sources()
+        os.remove(source_file)
+        os.remove(link_file)
+        self.backup.restore(pattern=link_file)
+        # The target of the link is read from its own block
+        with open(link_file, 'rb') as restored:
+            self.assertEqual(restored.read(), content)
+        self.assertTrue(os.path.samefile(source_file, link_file))
+        with open(files[0][0], 'rb') as unselected:
+            self.assertEqual(unselected.read(), b'modified')
+
+    @patch('builtins.print')
+    def test_restore_directory_of_aes_gcm_encrypted_backup(self, mock_print):
+        key_file = '{0}/backup.key'.format(self.workdir)
+        with open(key_file, 'wb') as key:
+            key.write(os.urandom(32))
+        self.backup.config['encryption_key_file'] = key_file
+        self.backup.config['encryption_chunk_size'] = 4096
+        self.backup.encrypt = True
+        self.backup.encryption = 'aes-gcm'
+        files = self.create_selective_sources()
+        self.backup.restore(self.backup.newest_backup(),
+                            '{0}/dir_1'.format(self.file_source_dir))
+        for path, content in files:
+            with open(path, 'rb') as restored:
+                self.assertEqual(restored.read(), content)
+
+    @patch('builtins.print')
+    def test_restore_path_without_index_streams_archive(self, mock_print):
+        self.backup.index_archives = False
+        files = self.create_selective_sources()
+        self.assertEqual(len(os.listdir(self.backup_target_dir)), 1)
+        self.backup.restore(pattern='*/file_2')
+        for position, (path, content) in enumerate(files):
+            with open(path, 'rb') as restored:
+                expected = content if position == 2 else b'modified'
+                self.assertEqual(restored.read(), expected)
+
+    def test_restore_unknown_archive(self):
+        self.assertRaises(ArchiveIndexError, self.backup.restore,
+                          'backup-test_backup-20000101000000.tar.gz')
+
+    @patch('builtins.print')
+    def test_dedup_create_restore_and_rotate(self, mock_print):
+        source_file = '{0}/file_1'.format(self.file_source_dir)
+        with open(source_file, 'w') as source:
+            source.write('original')
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        self.backup.dedup = True
+        self.backup.rotation_num = 1
+        self.backup.create_dedup()
+        chunk_dir = '{0}/chunks-test_backup'.format(self.backup_target_dir)
+        chunks = os.listdir(chunk_dir)
+        self.assertTrue(chunks)
+        with open(source_file, 'w') as source:
+            source.write('modified')
+        self.backup.set_existing_backups()
+        self.backup.restore_dedup()
+        with open(source_file) as source:
+            self.assertEqual(source.read(), 'original')
+        # Let the old manifest become outdated and collect its chunks
+        with open(source_file, 'w') as source:
+            source.write('modified')
+        os.rename('{0}/{1}'.format(self.backup_target_dir,
+                                   self.backup.filename),
+                  '{0}/backup-test_backup-20000101000000.manifest'.format(
+                      self.backup_target_dir))
+        self.backup.create_dedup()
+        self.backup.set_existing_backups()
+        self.backup.rotate()
+        self.assertEqual(len(os.listdir(self.backup_target_dir)), 2)
+        self.assertTrue(set(chunks) - set(os.listdir(chunk_dir)))
+
+    @patch('builtins.print')
+    def test_should_key_the_ids_of_encrypted_chunks(self, mock_print):
+        key_file = '{0}/backup.key'.format(self.workdir)
+        with open(key_file, 'wb') as key:
+            key.write(os.urandom(32))
+        self.backup.config['encryption_key_file'] = key_file
+        source_file = '{0}/file_1'.format(self.file_source_dir)
+        with open(source_file, 'w') as source:
+            source.write('original')
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        self.backup.dedup = True
+        self.backup.encrypt = True
+        self.assertRaises(EncryptionError, self.backup.create_dedup)
+        self.backup.encryption = 'aes-gcm'
+        self.backup.create_dedup()
+        self.backup.set_existing_backups()
+        store = ChunkStore(self.backup)
+        manifest = store.read_manifest(self.backup.newest_backup())
+        plain = io.BytesIO()
+        store.restore(manifest, plain)
+        plain_ids = set(hashlib.sha256(chunk).hexdigest()
+                        for chunk in store.chunker.chunks(
+                            io.BytesIO(plain.getvalue())))
+        self.assertTrue(manifest['chunks'])
+        self.assertFalse(plain_ids & set(manifest['chunks']))
+        with open(source_file, 'w') as source:
+            source.write('modified')
+        self.backup.restore_dedup()
+        with open(source_file) as source:
+            self.assertEqual(source.read(), 'original')
+
+    @patch('builtins.print')
+    def test_incremental_create_and_restore(self, mock_print):
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        self.backup.incremental = True
+        self.backup.state_dir = '{0}/state'.format(self.workdir)
+        file_2 = '{0}/dir_1/file_2'.format(self.file_source_dir)
+        with open(file_2, 'w') as source:
+            source.write('file 2')
+        self.backup.create_incremental()
+        self.backup.set_existing_backups()
+        self.assertFalse(self.backup.is_incremental_name(
+            self.backup.newest_backup()))
+        os.remove('{0}/file_1'.format(self.file_source_dir))
+        file_3 = '{0}/dir_1/file_3'.format(self.file_source_dir)
+        with open(file_3, 'w') as source:
+            source.write('file 3')
+        # Ensure a newer timestamp in the name of the second backup
+        os.rename('{0}/{1}'.format(self.backup_target_dir,
+                                   self.backup.filename),
+                  '{0}/backup-test_backup-20000101000000.tar.gz'.format(
+                      self.backup_target_dir))
+        self.backup.create_incremental()
+        self.backup.set_existing_backups()
+        incremental = self.backup.newest_backup()
+        self.assertTrue(self.backup.is_incremental_name(incremental))
+        with tarfile.open('{0}/{1}'.format(self.backup_target_dir,
+                                           incremental)) as tar:
+            names = tar.getnames()
+        self.assertIn('./files/{0}'.format(file_3.lstrip('/')), names)
+        self.assertNotIn('./files/{0}'.format(file_2.lstrip('/')), names)
+        shutil.rmtree(self.file_source_dir)
+        os.makedirs(self.file_source_dir)
+        open('{0}/file_1'.format(self.file_source_dir), 'w').close()
+        self.backup.restore_incremental()
+        with open(file_2) as source:
+            self.assertEqual(source.read(), 'file 2')
+        with open(file_3) as source:
+            self.assertEqual(source.read(), 'file 3')
+        self.assertFalse(os.path.exists(
+            '{0}/file_1'.format(self.file_source_dir)))
+
+    def test_should_keep_incrementals_of_kept_full_backups(self):
+        names = [
+            'backup-test_backup-20170101000000.tar.gz',
+            'backup-test_backup-20170102000000.inc.tar.gz',
+            'backup-test_backup-20170103000000.tar.gz',
+            'backup-test_backup-20170104000000.inc.tar.gz',
+            'backup-test_backup-20170105000000.tar.gz',
+            'backup-test_backup-20170106000000.inc.tar.gz'
+        ]
+        self.backup.rotation_num = 2
+        self.assertEqual(sorted(self.backup.expired_backups(names)),
+                         names[:2])
+
+    def test_should_create_archives_with_configured_compression(self):
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        self.backup.compression = 'pgzip'
+        self.backup.tar_workdir()
+        self.assertTrue(self.backup.filename.endswith('.tar.gz'))
+        self.backup.upload()
+        self.backup.set_existing_backups()
+        self.assertTrue(self.backup.is_backup_name(
+            self.backup.newest_backup()))
+        os.remove(self.backup.filename_abs)
+        self.assertTrue(self.backup.download())
+        self.backup.untar_backup_file()
         expected_file = '{0}/files/{1}/file_1'.format(self.backup_test_workdir,
                                                       self.file_source_dir)
-        expected_dir = '{0}/files/{1}/dir_1'.format(self.backup_test_workdir,
-                                                    self.file_source_dir)
         self.assertTrue(os.path.isfile(expected_file))
-        self.assertTrue(os.path.isdir(expected_dir))
+
+    def test_should_recognize_compressed_backup_names(self):
+        for extension in ['tar', 'tar.gz', 'tar.zst', 'inc.tar.lz4.gpg']:
+            name = 'backup-test_backup-20170101000000.{0}'.format(extension)
+            self.assertTrue(self.backup.is_backup_name(name))
+        self.assertFalse(self.backup.is_backup_name(
+            'backup-test_backup-20170101000000.zip'))
 
     def test_copy_from_backup_source(self):
         self.assertTrue(self.backup.download())
 
+    def _partial_upload(self, data, partial_data):
+        """Leave a partial copy of an interrupted upload on the target"""
+        name = 'backup-test_backup-20170101000000.tar.gz'
+        local_path = '{0}/{1}'.format(self.backup_test_workdir, name)
+        with open(local_path, 'wb') as local_file:
+            local_file.write(data)
+        with open(self.backup.partial_path(name), 'wb') as partial_file:
+            partial_file.write(partial_data)
+        return name, local_path
+
+    @patch('builtins.print')
+    def test_should_resume_interrupted_upload(self, mock_print):
+        data = os.urandom(5000)
+        name, local_path = self._partial_upload(data, data[:2500])
+        with patch('backuptool.file.copy_file',
+                   side_effect=IOError('Disk detached')):
+            self.assertRaises(IOError, self.backup.upload_file,
+                              local_path, name)
+        # The archive survives the removal of the working directory
+        os.remove(local_path)
+        self.assertTrue(os.path.isfile(self.backup.pending_path(name)))
+        with patch('backuptool.file.copy_file',
+                   side_effect=copy_file) as mock_copy:
+            self.backup.resume_pending_upload()
+        self.assertEqual(mock_copy.call_args[0][3], 2048)
+        with open('{0}/{1}'.format(self.backup_target_dir, name),
+                  'rb') as target:
+            self.assertEqual(target.read(), data)
+        self.assertFalse(os.path.exists(self.backup.partial_path(name)))
+        self.assertFalse(os.path.exists(self.backup.pending_path(name)))
+        self.assertIsNone(self.backup.transfer_journal().load())
+
+    def test_should_not_trust_changed_partial_upload(self):
+        data = os.urandom(5000)
+        name, local_path = self._partial_upload(
+            data, data[:1500] + b'corrupted' + data[1509:2500])
+        with patch('backuptool.file.copy_file',
+                   side_effect=copy_file) as mock_copy:
+            self.backup.upload_file(local_path, name)
+        self.assertEqual(mock_copy.call_args[0][3], 0)
+        with open('{0}/{1}'.format(self.backup_target_dir, name),
+                  'rb') as target:
+            self.assertEqual(target.read(), data)
+
+    @patch('builtins.print')
+    def test_should_resume_interrupted_download(self, mock_print):
+        data = os.urandom(5000)
+        name = 'backup-test_backup-20170101000000.tar.gz'
+        with open('{0}/{1}'.format(self.backup_target_dir, name),
+                  'wb') as remote_file:
+            remote_file.write(data)
+        local_path = '{0}/{1}'.format(self.backup_test_workdir, name)
+
+        def interrupted_copy(source_path, target_path, *args, **kwargs):
+            with open(target_path, 'wb') as target_file:
+                target_file.write(data[:3500])
+            raise IOError('Disk detached')
+        with patch('backuptool.file.copy_file', side_effect=interrupted_copy):
+            self.assertRaises(IOError, self.backup.download_file,
+                              name, local_path)
+        self.assertTrue(os.path.isfile(self.backup.pending_path(name)))
+        os.remove(local_path)
+        with patch('backuptool.file.copy_file',
+                   side_effect=copy_file) as mock_copy:
+            self.backup.download_file(name, local_path)
+        self.assertEqual(mock_copy.call_args[0][3], 3072)
+        with open(local_path, 'rb') as local_file:
+            self.assertEqual(local_file.read(), data)
+        self.assertFalse(os.path.exists(self.backup.pending_path(name)))
+        self.assertIsNone(self.backup.transfer_journal().load())
+
+    @patch('builtins.print')
+    @patch('time.sleep')
+    def test_should_rate_limit_resumed_upload(self, mock_sleep, mock_print):
+        data = os.urandom(5000)
+        name, local_path = self._partial_upload(data, data[:2500])
+        self.backup.config['upload_limit'] = 1000
+        self.backup.upload_throttle = self.backup.open_throttle('upload')
+        with patch('backuptool.file.copy_file') as mock_copy:
+            self.backup.upload_file(local_path, name)
+        self.assertFalse(mock_copy.called)
+        # Only the 2952 bytes after the verified chunks are uploaded
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 2.952, places=1)
+        with open('{0}/{1}'.format(self.backup_target_dir, name),
+                  'rb') as target:
+            self.assertEqual(target.read(), data)
+
+    def test_should_hide_partial_files_from_listing(self):
+        self._partial_upload(b'data', b'da')
+        self.backup.set_existing_backups()
+        self.assertFalse([name for name in self.backup.backup_names()
+                          if name.endswith('.part')])
+
+    def _copy_source(self, data):
+        """Write the source file of the copy method tests"""
+        source_path = '{0}/source'.format(self.workdir)
+        with open(source_path, 'wb') as source_file:
+            source_file.write(data)
+        return source_path
+
+    def test_should_copy_files_with_every_method(self):
+        data = os.urandom(300000)
+        source_path = self._copy_source(data)
+        for method in ['auto', 'hardlink', 'copy_file_range', 'sendfile',
+                       'stream']:
+            target_path = '{0}/target-{1}'.format(self.workdir, method)
+            try:
+                used_method = copy_file(source_path, target_path, method)
+            except OSError as error:
+                # Not every method is supported on every filesystem
+                self.assertIn(error.errno, [errno.EXDEV, errno.EINVAL,
+                                            errno.ENOSYS, errno.EPERM,
+                                            errno.EOPNOTSUPP])
+                continue
+            with open(target_path, 'rb') as target_file:
+                self.assertEqual(target_file.read(), data)
+            if method != 'auto':
+                self.assertEqual(used_method, method)
+        target_path = '{0}/target-offset'.format(self.workdir)
+        with open(target_path, 'wb') as target_file:
+            target_file.write(data[:1000])
+        self.assertIn(copy_file(source_path, target_path, offset=1000),
+                      ['copy_file_range', 'sendfile', 'stream'])
+        with open(target_path, 'rb') as target_file:
+            self.assertEqual(target_file.read(), data)
+
+    def test_should_clone_files_with_reflinks(self):
+        data = os.urandom(3000)
+        source_path = self._copy_source(data)
+        target_path = '{0}/copy'.format(self.workdir)
+
+        def clone(target_fd, request, source_fd):
+            os.write(target_fd, os.pread(source_fd, len(data), 0))
+        with patch('fcntl.ioctl', side_effect=clone) as mock_ioctl:
+            self.assertEqual(copy_file(source_path, target_path), 'reflink')
+        self.assertEqual(mock_ioctl.call_args[0][1], FICLONE)
+        with open(target_path, 'rb') as target_file:
+            self.assertEqual(target_file.read(), data)
+        # Filesystems without reflinks fall back to the next method
+        with patch('fcntl.ioctl',
+                   side_effect=OSError(errno.EOPNOTSUPP, 'Not supported')):
+            self.assertEqual(copy_file(source_path, target_path),
+                             'hardlink')
+            self.assertRaises(OSError, copy_file, source_path, target_path,
+                              'reflink')
+
+    def test_should_copy_file_ranges_until_complete(self):
+        data = os.urandom(3000)
+        source_path = self._copy_source(data)
+        target_path = '{0}/copy'.format(self.workdir)
+        with open(target_path, 'wb') as target_file:
+            target_file.write(data[:1000])
+
+        def copy_range(source_fd, target_fd, count, offset_src, offset_dst):
+            # The kernel could copy less than requested
+            chunk = os.pread(source_fd, min(count, 700), offset_src)
+            return os.pwrite(target_fd, chunk, offset_dst)
+        with patch('os.copy_file_range', create=True,
+                   side_effect=copy_range) as mock_copy_range:
+            self.assertEqual(copy_file(source_path, target_path,
+                                       'copy_file_range', offset=1000),
+                             'copy_file_range')
+        self.assertEqual(mock_copy_range.call_count, 3)
+        with open(target_path, 'rb') as target_file:
+            self.assertEqual(target_file.read(), data)
+
+    def test_should_reject_unknown_copy_method(self):
+        self.assertRaises(CopyError, copy_file, '/dev/null', '/dev/null',
+                          'teleport')
+
     def test_should_remove_file(self):
         file_to_remove = '{0}/file_to_remove'.format(self.backup_test_workdir)
         open(file_to_remove, 'w').close()
@@ -63,6 +584,31 @@ class FileBackupTests(TestCase):
     def test_should_rotate_backup_files(self):
         self.backup.rotate()
 
+    def _rotation_files(self):
+        """Write five backups, the oldest one with an index"""
+        os.remove('{0}/existing_backup.tar.gz'.format(self.backup_target_dir))
+        names = ['backup-test_backup-2017010100000{0}.tar.gz'.format(number)
+                 for number in range(5)]
+        for name in names + ['{0}.index'.format(names[0])]:
+            open('{0}/{1}'.format(self.backup_target_dir, name), 'w').close()
+        self.backup.set_existing_backups()
+        return names
+
+    @patch('builtins.print')
+    def test_should_only_report_rotation_on_dry_run(self, mock_print):
+        names = self._rotation_files()
+        plans = self.backup.plan_rotation()
+        self.assertEqual(plans, [(self.backup, (names[1::-1], []))])
+        self.backup.print_rotation(plans)
+        mock_print.assert_any_call('  would delete {0}'.format(names[0]))
+        self.assertEqual(len(os.listdir(self.backup_target_dir)), 6)
+
+    def test_should_delete_expired_backups_with_their_index(self):
+        names = self._rotation_files()
+        self.backup.rotate()
+        self.assertEqual(sorted(os.listdir(self.backup_target_dir)),
+                         names[2:])
+
     @patch('builtins.print')
     def test_should_list_backup_files(self, mock_print):
         self.backup.list()
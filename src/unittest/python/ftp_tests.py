@@ -3,18 +3,19 @@
 """Test suite for testing the ftp target functionality of backuptool"""
 
 import os
+import ftplib  # nosec
 import shutil
 import tempfile
 
 from mock import patch
 from unittest2 import TestCase
 from backuptool.ftp import FTPBackup
+from backuptool.connection import POOL
 
 
 class FTPBackupTests(TestCase):
-    @patch('backuptool.ftp.FTPBackup.set_existing_backups', autospec=True)
     @patch('ftplib.FTP', autospec=True)
-    def setUp(self, mock_ftp, mock_set_existing_backups):
+    def setUp(self, mock_ftp):
         """Preparations to be done before every test"""
         self.workdir = tempfile.mkdtemp(prefix='backuptool-ftp-tests-')
         self.file_source_dir = '{0}/file_source'.format(self.workdir)
@@ -30,6 +31,7 @@ class FTPBackupTests(TestCase):
             'ftp_password': 'testpassword',
             'target': 'ftp://testftp.example.com',
             'rotate': 3,
+            'state_dir': '{0}/state'.format(self.workdir),
             'files': self.file_patterns
         }
 
@@ -41,23 +43,89 @@ class FTPBackupTests(TestCase):
         shutil.rmtree(self.workdir)
 
     def test_ftp_backup(self):
-        self.backup.copy_files()
         self.backup.tar_workdir()
         self.backup.upload()
 
+    @patch('ftplib.FTP', autospec=True)
+    def test_should_log_in_once_and_share_the_connection(self, mock_ftp):
+        config = dict(self.ftp_based_config,
+                      target='ftp://pooled.example.com:2121')
+        first = FTPBackup('first', config=config,
+                          workdir=self.backup_test_workdir)
+        mock_ftp.return_value.connect.assert_called_once_with(
+            'pooled.example.com', 2121)
+        mock_ftp.return_value.login.assert_called_once_with(
+            'testuser', 'testpassword')
+        first.close()
+        second = FTPBackup('second', config=config,
+                           workdir=self.backup_test_workdir)
+        self.assertEqual(mock_ftp.call_count, 1)
+        mock_ftp.return_value.voidcmd.assert_called_with('NOOP')
+        second.close()
+        POOL.close_all()
+        mock_ftp.return_value.quit.assert_called_once_with()
+
     def test_should_rotate_backup_files(self):
         self.backup.rotate()
 
+    def test_should_pipeline_deletes(self):
+        self.backup.pipeline_depth = 2
+        commands = []
+        self.backup.ftp.putcmd.side_effect = commands.append
+        self.backup.ftp.voidresp.side_effect = [
+            '250 Deleted', ftplib.error_perm('550 Not found'), '250 Deleted']
+        self.assertRaises(ftplib.error_perm, self.backup.delete_names,
+                          ['a', 'b', 'c'])
+        self.assertEqual(commands, ['DELE a', 'DELE b', 'DELE c'])
+        self.assertEqual(self.backup.ftp.voidresp.call_count, 3)
+        self.backup.ftp.voidresp.side_effect = [
+            ftplib.error_perm('550 Not found')]
+        self.backup.delete_names(['a.index'], ignore_missing=True)
+        # Only a missing file is ignored, a denied delete is not
+        self.backup.ftp.voidresp.side_effect = [
+            ftplib.error_perm('550 Permission denied')]
+        self.assertRaises(ftplib.error_perm, self.backup.delete_names,
+                          ['a.index'], ignore_missing=True)
+
     @patch("builtins.print")
     def test_should_list_backup_files(self, mock_print):
-        entry = ('-rw-r--r--   1 user   group   826948694 Jul 25 04:27 ' +
-                 'backup-listtest-20150725062606.tar.gz')
-        self.backup.existing_backup_listings = [entry]
-        self.backup.existing_backup_files = \
-            ['backup-listtest-20150725062606.tar.gz']
+        self.backup.existing_backups = [{
+            'name': 'backup-test_backup-20150725062606.tar.gz',
+            'size': 826948694,
+            'mtime': 1437798420,
+            'etag': None
+        }]
         self.backup.list()
 
     def test_should_download_backup_files(self):
-        entry = 'backup-listtest-20150725062606.tar.gz'
-        self.backup.existing_backup_files = [entry]
+        self.backup.existing_backups = [{
+            'name': 'backup-test_backup-20150725062606.tar.gz',
+            'size': 826948694,
+            'mtime': 1437798420,
+            'etag': None
+        }]
+        self.backup.ftp.size.return_value = 826948694
         self.backup.download()
+
+    def test_should_parse_mlsd_listing(self):
+        self.backup.ftp.mlsd.return_value = [
+            ('.', {'type': 'cdir'}),
+            ('backup-test_backup-20150725062606.tar.gz',
+             {'type': 'file', 'size': '42', 'modify': '20150725042700'}),
+            ('backup-other-20150725062606.tar.gz',
+             {'type': 'file', 'size': '42', 'modify': '20150725042700'})
+        ]
+        self.assertEqual(self.backup.backups(), [{
+            'name': 'backup-test_backup-20150725062606.tar.gz',
+            'size': 42,
+            'mtime': 1437798420,
+            'etag': None
+        }])
+
+    def test_should_parse_list_output_without_mlsd(self):
+        self.backup.ftp.mlsd.side_effect = ftplib.error_perm('500')
+        self.backup.ftp.dir.side_effect = lambda callback: callback(
+            '-rw-r--r--   1 user   group   826948694 Jul 25 04:27 '
+            'backup-test_backup-20150725062606.tar.gz')
+        self.assertEqual(self.backup.backup_names(),
+                         ['backup-test_backup-20150725062606.tar.gz'])
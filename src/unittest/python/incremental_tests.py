@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the incremental functionality of backuptool"""
+
+import os
+import shutil
+import tempfile
+
+from unittest2 import TestCase
+from backuptool.incremental import FileIndex
+
+
+class FileIndexTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.workdir = tempfile.mkdtemp(prefix='backuptool-index-tests-')
+        self.index_path = '{0}/test.index'.format(self.workdir)
+        self.file_path = '{0}/file_1'.format(self.workdir)
+        open(self.file_path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_should_detect_modified_files(self):
+        index = FileIndex(self.index_path)
+        stats = os.lstat(self.file_path)
+        self.assertTrue(index.is_modified(self.file_path, stats))
+        index.update(self.file_path, stats)
+        index.commit(full=True)
+        index.close()
+        index = FileIndex(self.index_path)
+        self.assertFalse(index.is_modified(self.file_path, stats))
+        with open(self.file_path, 'w') as changed_file:
+            changed_file.write('changed')
+        self.assertTrue(index.is_modified(self.file_path,
+                                          os.lstat(self.file_path)))
+        index.close()
+
+    def test_should_report_deleted_paths(self):
+        index = FileIndex(self.index_path)
+        index.update(self.file_path, os.lstat(self.file_path))
+        index.update('/vanished', os.lstat(self.file_path))
+        index.commit(full=True)
+        index.close()
+        index = FileIndex(self.index_path)
+        index.mark_seen(self.file_path)
+        self.assertEqual(index.deleted_paths(), ['/vanished'])
+        index.commit(full=False)
+        self.assertEqual(index.get_meta('incrementals'), 1)
+        index.close()
+
+    def test_should_discard_uncommitted_changes(self):
+        index = FileIndex(self.index_path)
+        index.update(self.file_path, os.lstat(self.file_path))
+        index.close()
+        index = FileIndex(self.index_path)
+        self.assertTrue(index.is_empty())
+        index.close()
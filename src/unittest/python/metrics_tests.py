@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the metrics functionality of backuptool"""
+
+import os
+import json
+import shutil
+import getpass
+import tempfile
+import threading
+
+from unittest2 import TestCase
+from backuptool.file import FileBackup
+from backuptool.metrics import Metrics
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.workdir = tempfile.mkdtemp(prefix='backuptool-metrics-tests-')
+        self.json_path = '{0}/metrics.json'.format(self.workdir)
+        self.textfile_dir = '{0}/textfiles'.format(self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_should_count_bytes_into_running_phase(self):
+        metrics = Metrics('test', self.json_path)
+        metrics.start('create')
+        metrics.count(bytes_in=1)
+        with metrics.phase('tar_workdir'):
+            thread = threading.Thread(target=metrics.count,
+                                      kwargs={'bytes_in': 300})
+            thread.start()
+            thread.join()
+            metrics.count(bytes_out=100)
+        self.assertEqual(len(metrics.phases), 1)
+        phase = metrics.phases[0]
+        self.assertEqual(phase.bytes_in, 300)
+        self.assertEqual(phase.bytes_out, 100)
+        self.assertEqual(phase.compression_ratio, 3.0)
+        self.assertTrue(phase.succeeded)
+        self.assertGreaterEqual(phase.wall_seconds, 0)
+        self.assertGreater(phase.peak_rss, 0)
+
+    def test_should_record_failed_phase(self):
+        metrics = Metrics('test')
+        metrics.start('create')
+        with self.assertRaises(ValueError):
+            with metrics.phase('upload'):
+                raise ValueError('connection lost')
+        self.assertFalse(metrics.phases[0].succeeded)
+        self.assertIsNone(metrics.phases[0].compression_ratio)
+
+    def test_should_write_json_lines_and_textfile(self):
+        metrics = Metrics('test', self.json_path, self.textfile_dir)
+        metrics.start('create')
+        with metrics.phase('dump_database'):
+            metrics.count(1000, 250)
+        with metrics.phase('upload'):
+            metrics.count(bytes_out=250)
+        metrics.write(True)
+        with open(self.json_path) as json_file:
+            records = [json.loads(line) for line in json_file]
+        self.assertEqual([record['phase'] for record in records],
+                         ['dump_database', 'upload'])
+        self.assertEqual(records[0]['compression_ratio'], 4.0)
+        self.assertEqual(records[0]['backup'], 'test')
+        self.assertTrue(records[1]['run_succeeded'])
+        with open('{0}/backuptool_test_create.prom'.format(
+                self.textfile_dir)) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn('backuptool_phase_bytes_in{backup="test",'
+                      'operation="create",phase="dump_database"} 1000.0',
+                      lines)
+        self.assertIn('backuptool_last_run_success{backup="test",'
+                      'operation="create"} 1', lines)
+        # No ratio without bytes_in
+        self.assertFalse([line for line in lines if line.startswith(
+            'backuptool_phase_compression_ratio') and 'upload' in line])
+        self.assertEqual(os.listdir(self.textfile_dir),
+                         ['backuptool_test_create.prom'])
+
+    def test_should_record_phases_of_created_backup(self):
+        source_dir = '{0}/source'.format(self.workdir)
+        target_dir = '{0}/target'.format(self.workdir)
+        backup_workdir = '{0}/workdir'.format(self.workdir)
+        for directory in [source_dir, target_dir, backup_workdir]:
+            os.makedirs(directory)
+        with open('{0}/file_1'.format(source_dir), 'w') as f:
+            f.write('a' * 10000)
+        backup = FileBackup('test_backup', config={
+            'user': getpass.getuser(),
+            'target': 'file://{0}'.format(target_dir),
+            'state_dir': '{0}/state'.format(self.workdir),
+            'files': [source_dir],
+            'metrics_file': self.json_path
+        }, workdir=backup_workdir)
+        backup.create()
+        with open(self.json_path) as json_file:
+            records = dict((record['phase'], record) for record
+                           in map(json.loads, json_file))
+        self.assertEqual(sorted(records), [
+            'dump_database', 'dump_ldap', 'tar_workdir', 'upload'])
+        self.assertEqual(records['tar_workdir']['bytes_in'], 10000)
+        self.assertGreater(records['tar_workdir']['compression_ratio'], 1)
+        self.assertEqual(records['upload']['bytes_out'],
+                         records['tar_workdir']['bytes_out'])
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the scheduling functionality of backuptool"""
+
+import time
+import asyncio
+
+from unittest2 import TestCase
+from backuptool.scheduler import Scheduler, target_key, target_keys
+
+
+def succeeding_backup(name, config, arguments):
+    return True
+
+
+def failing_backup(name, config, arguments):
+    if name == 'broken':
+        raise IOError('disk full')
+    if name == 'handled':
+        return False
+    return True
+
+
+async def remote_backup(name, config, arguments, executor, turn):
+    loop = asyncio.get_running_loop()
+    # Later backups finish their blocking work first
+    await loop.run_in_executor(executor, time.sleep, config['delay'])
+    await turn()
+    arguments['order'].append(name)
+    if name == 'broken':
+        raise IOError('host unreachable')
+    return name != 'handled'
+
+
+async def slow_backup(name, config, arguments, executor, turn):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, time.sleep, config['delay'])
+    return True
+
+
+class SchedulerTests(TestCase):
+    def test_should_identify_targets_by_host(self):
+        self.assertEqual(target_key({'target': 'sftp://host:2222/path'}),
+                         'sftp://host:2222')
+        self.assertEqual(target_key({'target': 'file:///srv/backup'}),
+                         'file:///srv/backup')
+        self.assertEqual(target_key({}), None)
+
+    def test_should_use_lowest_target_limit(self):
+        scheduler = Scheduler(4)
+        scheduler.add('a', {'target': 'sftp://host', 'target_jobs': 3})
+        scheduler.add('b', {'target': 'sftp://host', 'target_jobs': 2})
+        scheduler.add('c', {'target': 's3://bucket'})
+        self.assertEqual(scheduler.target_limits(), {'sftp://host': 2})
+
+    def test_should_limit_every_target_of_a_backup(self):
+        scheduler = Scheduler(4)
+        scheduler.add('a', {'targets': [
+            'sftp://host/a', {'target': 's3://bucket', 'target_jobs': 1}],
+            'target_jobs': 2})
+        scheduler.add('b', {'target': 'sftp://host/b', 'target_jobs': 3})
+        self.assertEqual(scheduler.target_limits(),
+                         {'sftp://host': 2, 's3://bucket': 1})
+        self.assertEqual(target_keys(scheduler.backups[0][1]),
+                         ['s3://bucket', 'sftp://host'])
+
+    def test_should_take_the_slots_of_all_targets(self):
+        scheduler = Scheduler()
+        config = {'targets': ['sftp://host', 's3://bucket'], 'delay': 0.2,
+                  'target_jobs': 1}
+        scheduler.add('a', config)
+        scheduler.add('b', dict(config, targets=['s3://bucket']))
+        scheduler.add('c', dict(config, targets=['sftp://host']))
+        arguments = {'order': []}
+        loop = asyncio.new_event_loop()
+        try:
+            started = time.time()
+            loop.run_until_complete(
+                scheduler.run_async(slow_backup, arguments, 4))
+        finally:
+            loop.close()
+        # b and c both wait for the slots a holds, but not for each other
+        self.assertGreater(time.time() - started, 0.39)
+        self.assertLess(time.time() - started, 0.55)
+
+    def test_should_run_backups_in_parallel(self):
+        scheduler = Scheduler(2)
+        for name in ['a', 'b', 'c']:
+            scheduler.add(name, {'target': 'sftp://host', 'target_jobs': 1})
+        results = scheduler.run(succeeding_backup, {})
+        self.assertEqual(results, [('a', None), ('b', None), ('c', None)])
+
+    def test_should_aggregate_failures(self):
+        for jobs in [1, 3]:
+            scheduler = Scheduler(jobs)
+            for name in ['ok', 'broken', 'handled']:
+                scheduler.add(name, {'target': 'file:///tmp'})
+            results = dict(scheduler.run(failing_backup, {}))
+            self.assertEqual(results['ok'], None)
+            self.assertIn('disk full', results['broken'])
+            self.assertEqual(results['handled'], 'Backup failed')
+
+    def test_should_overlap_async_backups_and_keep_their_order(self):
+        scheduler = Scheduler()
+        for position, name in enumerate(['ok', 'broken', 'handled', 'last']):
+            scheduler.add(name, {'target': 'sftp://host', 'target_jobs': 2,
+                                 'delay': 0.2 - position * 0.05})
+        arguments = {'order': []}
+        loop = asyncio.new_event_loop()
+        try:
+            started = time.time()
+            results = loop.run_until_complete(
+                scheduler.run_async(remote_backup, arguments, 4))
+        finally:
+            loop.close()
+        self.assertLess(time.time() - started, 0.45)
+        self.assertEqual(arguments['order'],
+                         ['ok', 'broken', 'handled', 'last'])
+        results = dict(results)
+        self.assertEqual(results['ok'], None)
+        self.assertIn('host unreachable', results['broken'])
+        self.assertEqual(results['handled'], 'Backup failed')
@@ -2,13 +2,18 @@
 
 """Test suite for testing the ftp target functionality of backuptool"""
 
+import io
 import os
 import shutil
 import tempfile
 
-from mock import patch
+from functools import partial
+from mock import patch, MagicMock
+from paramiko import Message, SFTPClient
+from paramiko.sftp import CMD_STATUS, SFTP_NO_SUCH_FILE, SFTP_OK
 from unittest2 import TestCase
 from backuptool.sftp import SFTPBackup
+from backuptool.connection import POOL
 
 
 class SFTPBackupTests(TestCase):
@@ -30,32 +35,104 @@ class SFTPBackupTests(TestCase):
             'sftp_password': 'testpassword',
             'target': 'sftp://testftp.example.com',
             'rotate': 3,
+            'state_dir': '{0}/state'.format(self.workdir),
             'files': self.file_patterns
         }
         existing_backups = ({
-            'name': 'backup-listtest-20150725062606.tar.gz',
-            'size': '826948694',
-            'date': 'Jul 25 04:27 '
+            'name': 'backup-test_backup-20150725062606.tar.gz',
+            'size': 826948694,
+            'mtime': 1437798420,
+            'etag': None
         })
         self.backup = SFTPBackup('test_backup',
                                  config=self.sftp_based_config,
                                  workdir=self.backup_test_workdir)
-        self.backup.existing_backup_files = [existing_backups]
+        self.backup.existing_backups = [existing_backups]
 
     def tearDown(self):
         shutil.rmtree(self.workdir)
+        # Every test gets the connection of its own paramiko mock
+        self.backup.close()
+        POOL.close_all()
 
     def test_ftp_backup(self):
-        self.backup.copy_files()
         self.backup.tar_workdir()
         self.backup.upload()
 
     def test_should_rotate_backup_files(self):
         self.backup.rotate()
 
+    def _pipelined_replies(self, codes):
+        """Let the sftp client answer remove requests with the codes"""
+        requests = []
+
+        def request(replies, command, path):
+            requests.append((replies, path))
+            return len(requests)
+
+        def finish(replies):
+            for number, (receiver, _) in enumerate(requests, 1):
+                if receiver is replies and number not in replies.replies:
+                    message = Message()
+                    message.add_int(codes[number - 1])
+                    message.add_string('')
+                    message.rewind()
+                    replies._async_response(CMD_STATUS, message, number)
+        self.backup.sftp._async_request.side_effect = request
+        self.backup.sftp._adjust_cwd.side_effect = lambda path: path
+        self.backup.sftp._finish_responses.side_effect = finish
+        self.backup.sftp._convert_status.side_effect = partial(
+            SFTPClient._convert_status, None)
+        return requests
+
+    def test_should_pipeline_deletes(self):
+        self.backup.pipeline_depth = 2
+        requests = self._pipelined_replies([SFTP_OK, SFTP_NO_SUCH_FILE,
+                                            SFTP_OK])
+        self.assertRaises(IOError, self.backup.delete_names,
+                          ['a', 'b', 'c'])
+        self.assertEqual([path for _, path in requests], ['a', 'b', 'c'])
+        self.assertEqual(self.backup.sftp._finish_responses.call_count, 2)
+
+    def test_should_ignore_missing_files_on_delete(self):
+        self._pipelined_replies([SFTP_NO_SUCH_FILE])
+        self.backup.delete_names(['a.index'], ignore_missing=True)
+
     @patch("builtins.print")
     def test_should_list_backup_files(self, mock_print):
         self.backup.list()
 
+    def _remote_file(self, data):
+        remote = MagicMock()
+        remote.__enter__.return_value = remote
+        content = io.BytesIO(data)
+        remote.seek.side_effect = content.seek
+        remote.read.side_effect = content.read
+        remote.write.side_effect = content.write
+        remote.stat.return_value.st_size = len(data)
+        self.backup.sftp.stat.return_value.st_size = len(data)
+        self.backup.sftp.open.return_value = remote
+        return remote, content
+
     def test_should_download_backup_files(self):
-        self.backup.download()
+        self._remote_file(b'backup data')
+        self.assertTrue(self.backup.download())
+        file_target = '{0}/backup-test_backup-20150725062606.tar.gz'.format(
+            self.backup_test_workdir)
+        with open(file_target, 'rb') as target:
+            self.assertEqual(target.read(), b'backup data')
+
+    def test_should_resume_download_from_offset(self):
+        remote, _ = self._remote_file(b'0123456789')
+        target = io.BytesIO()
+        self.backup.download_fileobj('name', target, offset=4)
+        self.assertEqual(target.getvalue(), b'456789')
+        remote.prefetch.assert_called_with(10, 64)
+
+    def test_should_resume_upload_from_offset(self):
+        remote, content = self._remote_file(b'0123xxxxxx')
+        self.backup.upload_fileobj(io.BytesIO(b'456789'), 'name', offset=4)
+        self.assertEqual(content.getvalue(), b'0123456789')
+        self.backup.sftp.open.assert_called_with('name', 'r+b',
+                                                 bufsize=32768)
+        remote.set_pipelined.assert_called_with(True)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the snapshot functionality of backuptool"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+
+from mock import patch
+from unittest2 import TestCase
+from backuptool.file import FileBackup
+from backuptool.snapshot import SnapshotError, open_snapshot
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.workdir = tempfile.mkdtemp(prefix='backuptool-snapshot-tests-')
+        self.source_dir = '{0}/source'.format(self.workdir)
+        self.snapshot_dir = '{0}/snapshot'.format(self.workdir)
+        self.backup_target_dir = '{0}/target'.format(self.workdir)
+        self.backup_test_workdir = '{0}/workdir'.format(self.workdir)
+        os.makedirs('{0}/data'.format(self.source_dir))
+        os.makedirs(self.backup_target_dir)
+        os.makedirs(self.backup_test_workdir)
+        with open('{0}/data/file_1'.format(self.source_dir), 'w') as f:
+            f.write('live')
+        self.snapshot_config = {
+            'type': 'btrfs',
+            'subvolume': self.source_dir,
+            'path': self.snapshot_dir
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _fake_btrfs(self, cmd, **kwargs):
+        """Emulate the btrfs snapshot commands with copies"""
+        if cmd[:3] == ['btrfs', 'subvolume', 'snapshot']:
+            shutil.copytree(cmd[-2], cmd[-1])
+            with open('{0}/data/file_1'.format(cmd[-1]), 'w') as f:
+                f.write('snapshot')
+        elif cmd[:3] == ['btrfs', 'subvolume', 'delete']:
+            shutil.rmtree(cmd[-1])
+
+    def test_should_map_paths_into_snapshot(self):
+        snapshot = open_snapshot('test', self.snapshot_config, self.workdir)
+        path = '{0}/data/file_1'.format(self.source_dir)
+        snapshot_path = '{0}/data/file_1'.format(self.snapshot_dir)
+        self.assertEqual(snapshot.snapshot_path(path), snapshot_path)
+        self.assertEqual(snapshot.original_path(snapshot_path), path)
+        self.assertEqual(snapshot.snapshot_path('/etc/hosts'), '/etc/hosts')
+
+    def test_should_reject_unknown_snapshot_type(self):
+        self.assertRaises(SnapshotError, open_snapshot, 'test',
+                          {'type': 'zfs'}, self.workdir)
+
+    @patch('subprocess.check_call')
+    def test_should_archive_from_snapshot(self, mock_check_call):
+        mock_check_call.side_effect = self._fake_btrfs
+        backup = FileBackup('test_backup', config={
+            'target': 'file://{0}'.format(self.backup_target_dir),
+            'files': ['{0}/data'.format(self.source_dir)],
+            'snapshot': self.snapshot_config
+        }, workdir=self.backup_test_workdir)
+        with backup.source_snapshot():
+            backup.tar_workdir()
+        self.assertFalse(os.path.exists(self.snapshot_dir))
+        member = './files/{0}/data/file_1'.format(self.source_dir.lstrip('/'))
+        with tarfile.open(backup.filename_abs) as tar:
+            self.assertEqual(tar.extractfile(member).read(), b'snapshot')
+
+    @patch('subprocess.check_call')
+    def test_should_remove_half_created_lvm_snapshot(self, mock_check_call):
+        def check_call(cmd, **kwargs):
+            if cmd[0] == 'mount':
+                raise OSError('mount failed')
+        mock_check_call.side_effect = check_call
+        snapshot = open_snapshot('test', {
+            'type': 'lvm',
+            'volume': '/dev/vg0/data',
+            'mountpoint': '/data'
+        }, self.workdir)
+        with self.assertRaises(SnapshotError):
+            with snapshot:
+                pass
+        mock_check_call.assert_called_with(
+            ['lvremove', '--force', '/dev/vg0/backuptool-test'],
+            stdout=snapshot.devnull)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the streaming functionality of backuptool"""
+
+import io
+import os
+import shutil
+
+from unittest2 import TestCase
+from backuptool.stream import ArchiveStream, StreamError, tee
+
+
+class ArchiveStreamTests(TestCase):
+    def test_should_stream_produced_data(self):
+        def producer(fileobj):
+            for _ in range(100):
+                fileobj.write(b'x' * 1024)
+        with ArchiveStream(producer) as stream:
+            data = stream.read()
+        self.assertEqual(len(data), 100 * 1024)
+
+    def test_should_raise_producer_errors(self):
+        def producer(fileobj):
+            fileobj.write(b'partial')
+            raise IOError('source vanished')
+        stream = ArchiveStream(producer)
+        self.assertRaises(StreamError, stream.read)
+        self.assertRaises(StreamError, stream.close)
+
+    def test_should_not_end_a_failed_stream_regularly(self):
+        def producer(fileobj):
+            fileobj.write(b'partial')
+            raise IOError('source vanished')
+        with self.assertRaises(StreamError):
+            with ArchiveStream(producer) as stream:
+                self.assertEqual(stream.read(7), b'partial')
+                stream.read(7)
+
+    def test_tee_should_feed_all_consumers(self):
+        data = os.urandom(100000)
+        results = [io.BytesIO(), io.BytesIO()]
+
+        def failing(fileobj):
+            fileobj.read(10)
+            raise IOError('target gone')
+        consumers = [lambda fileobj: results[0].write(fileobj.read()),
+                     failing,
+                     lambda fileobj: shutil.copyfileobj(fileobj, results[1],
+                                                        333)]
+        errors = tee(io.BytesIO(data), consumers, chunk_size=1000,
+                     queue_size=1)
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], IOError)
+        self.assertIsNone(errors[2])
+        self.assertEqual(results[0].getvalue(), data)
+        self.assertEqual(results[1].getvalue(), data)
+
+    def test_tee_should_pass_source_errors_on(self):
+        def producer(fileobj):
+            fileobj.write(b'x' * 5000)
+            raise IOError('source vanished')
+        errors = []
+
+        def consumer(fileobj):
+            try:
+                fileobj.read()
+            except StreamError as error:
+                errors.append(error)
+                # The error is raised again, the data never looks complete
+                self.assertRaises(StreamError, fileobj.read, 10)
+        with self.assertRaises(StreamError):
+            tee(ArchiveStream(producer), [consumer, consumer],
+                chunk_size=1000)
+        self.assertEqual(len(errors), 2)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing multiple targets of a backup"""
+
+import os
+import shutil
+import getpass
+import tempfile
+
+from mock import patch
+from unittest2 import TestCase
+from backuptool.file import FileBackup
+from backuptool.targets import (
+    TargetError,
+    open_backup,
+    state_name,
+    target_configs
+)
+
+
+class TargetsTests(TestCase):
+    def setUp(self):
+        """Preparations to be done before every test"""
+        self.workdir = tempfile.mkdtemp(prefix='backuptool-targets-tests-')
+        self.source_dir = '{0}/source'.format(self.workdir)
+        self.target_dirs = ['{0}/target_{1}'.format(self.workdir, number)
+                            for number in range(2)]
+        for directory in [self.source_dir] + self.target_dirs:
+            os.makedirs(directory)
+        with open('{0}/file_1'.format(self.source_dir), 'w') as source:
+            source.write('original')
+        self.config = {
+            'user': getpass.getuser(),
+            'files': [self.source_dir],
+            'state_dir': '{0}/state'.format(self.workdir),
+            'targets': [
+                'file://{0}'.format(self.target_dirs[0]),
+                {'target': 'file://{0}'.format(self.target_dirs[1]),
+                 'rotate': 1}
+            ]
+        }
+        self.backup_workdir = '{0}/workdir'.format(self.workdir)
+        os.makedirs(self.backup_workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_should_merge_target_settings(self):
+        configs = target_configs(self.config)
+        self.assertEqual(configs[0]['target'],
+                         'file://{0}'.format(self.target_dirs[0]))
+        self.assertEqual(configs[1]['rotate'], 1)
+        self.assertNotIn('rotate', configs[0])
+        self.assertNotEqual(state_name('test', configs[0]),
+                            state_name('test', configs[1]))
+        self.assertEqual(target_configs({'target': 'file:///backup'}),
+                         [{'target': 'file:///backup'}])
+
+    def test_should_reject_unknown_target_type(self):
+        self.assertRaises(TargetError, open_backup, 'test',
+                          {'target': 'gopher://host'}, self.backup_workdir)
+
+    @patch('builtins.print')
+    def test_should_build_archive_once_for_all_targets(self, mock_print):
+        for stream in [False, True]:
+            self.config['stream'] = stream
+            backup = open_backup('test', self.config, self.backup_workdir)
+            self.assertEqual(len(backup.targets), 2)
+            with patch.object(backup, 'write_archive',
+                              wraps=backup.write_archive) as write_archive:
+                backup.create()
+            self.assertEqual(write_archive.call_count, 1)
+            for target_dir in self.target_dirs:
+                self.assertIn(backup.encrypted_name(backup.filename),
+                              os.listdir(target_dir))
+
+    @patch('builtins.print')
+    def test_failed_target_should_not_stop_the_others(self, mock_print):
+        self.config['stream'] = True
+        backup = open_backup('test', self.config, self.backup_workdir)
+        with patch.object(backup.targets[0], 'upload_fileobj',
+                          side_effect=IOError('Disk detached')):
+            self.assertRaises(TargetError, backup.create)
+        self.assertEqual(os.listdir(self.target_dirs[0]), [])
+        self.assertIn(backup.filename, os.listdir(self.target_dirs[1]))
+
+    @patch('builtins.print')
+    def test_should_skip_targets_which_could_not_be_opened(self, mock_print):
+        shutil.rmtree(self.target_dirs[0])
+        backup = open_backup('test', self.config, self.backup_workdir)
+        self.assertIsInstance(backup, FileBackup)
+        self.assertEqual(backup.targets, [backup])
+        self.assertRaises(TargetError, backup.create)
+        self.assertIn(backup.filename, os.listdir(self.target_dirs[1]))
+
+    @patch('builtins.print')
+    def test_should_rotate_targets_independently(self, mock_print):
+        for number, timestamp in enumerate(['20170101000000',
+                                            '20170102000000']):
+            name = 'backup-test-{0}.tar.gz'.format(timestamp)
+            for target_dir in self.target_dirs:
+                open('{0}/{1}'.format(target_dir, name), 'w').close()
+        backup = open_backup('test', self.config, self.backup_workdir)
+        backup.rotate()
+        self.assertEqual(len(os.listdir(self.target_dirs[0])), 2)
+        self.assertEqual(os.listdir(self.target_dirs[1]),
+                         ['backup-test-20170102000000.tar.gz'])
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Test suite for testing the rate limits and priorities of backuptool"""
+
+import io
+import os
+
+from datetime import datetime
+from mock import MagicMock, patch
+from unittest2 import TestCase
+from backuptool.backup import parse_rate_limit
+from backuptool.throttle import (
+    Priority,
+    RateLimit,
+    Throttle,
+    TokenBucket,
+    open_throttle,
+    set_global_limit
+)
+
+
+class RateLimitTests(TestCase):
+    def test_should_parse_rate_limits(self):
+        limit = parse_rate_limit('10MB, 08:00-18:00=1MB, 22:00-06:00=0')
+        self.assertEqual(limit.rate(datetime(2020, 1, 1, 7, 59)),
+                         10 * 1024 ** 2)
+        self.assertEqual(limit.rate(datetime(2020, 1, 1, 8, 0)), 1024 ** 2)
+        self.assertEqual(limit.rate(datetime(2020, 1, 1, 18, 0)),
+                         10 * 1024 ** 2)
+        self.assertIsNone(limit.rate(datetime(2020, 1, 1, 23, 0)))
+        self.assertIsNone(limit.rate(datetime(2020, 1, 1, 5, 0)))
+
+    def test_should_be_unlimited_outside_of_the_windows(self):
+        limit = parse_rate_limit('08:00-18:00=64KB')
+        self.assertEqual(limit.rate(datetime(2020, 1, 1, 12, 0)), 65536)
+        self.assertIsNone(limit.rate(datetime(2020, 1, 1, 20, 0)))
+        self.assertIsNone(parse_rate_limit(None))
+
+    def test_should_reject_invalid_rate_limits(self):
+        self.assertRaises(ValueError, parse_rate_limit, 'fast')
+        self.assertRaises(ValueError, parse_rate_limit, '08:00=1MB')
+        self.assertRaises(ValueError, parse_rate_limit, '08:00-25:00=1MB')
+
+
+class TokenBucketTests(TestCase):
+    def test_should_wait_for_the_rate(self):
+        bucket = TokenBucket(RateLimit(100000))
+        with patch('time.sleep') as sleep:
+            bucket.consume(50000)
+            self.assertAlmostEqual(sleep.call_args[0][0], 0.5, places=1)
+            # The next user waits for the debt of the first one, too
+            bucket.consume(50000)
+            self.assertAlmostEqual(sleep.call_args[0][0], 1.0, places=1)
+
+    def test_should_not_wait_without_a_rate(self):
+        bucket = TokenBucket(RateLimit(None), shared=True)
+        with patch('time.sleep') as sleep:
+            bucket.consume(10 ** 9)
+        self.assertFalse(sleep.called)
+
+    def test_should_throttle_reads(self):
+        throttle = Throttle([TokenBucket(RateLimit(1000))])
+        reader = throttle.reader(io.BytesIO(b'x' * 3000))
+        with patch('time.sleep') as sleep:
+            self.assertEqual(reader.read(1500), b'x' * 1500)
+            self.assertEqual(reader.read(), b'x' * 1500)
+        self.assertAlmostEqual(sleep.call_args[0][0], 3.0, places=1)
+        fileobj = io.BytesIO()
+        self.assertIs(Throttle([None]).reader(fileobj), fileobj)
+
+    def test_should_share_buckets(self):
+        limit = RateLimit(1000)
+        first = open_throttle('upload', 'backup', limit, '1000')
+        second = open_throttle('upload', 'backup', limit, '1000')
+        other = open_throttle('upload', 'backup', limit, '2000')
+        self.assertIs(first.buckets[0], second.buckets[0])
+        self.assertIsNot(first.buckets[0], other.buckets[0])
+        set_global_limit('upload', RateLimit(5000))
+        try:
+            self.assertEqual(len(open_throttle('upload', 'other', None,
+                                               'None').buckets), 1)
+        finally:
+            set_global_limit('upload', None)
+        self.assertEqual(open_throttle('upload', 'other', None,
+                                       'None').buckets, [])
+
+
+class PriorityTests(TestCase):
+    @patch('os.setpriority')
+    def test_should_set_the_nice_value(self, mock_setpriority):
+        Priority(nice=10).apply(1234)
+        mock_setpriority.assert_called_with(os.PRIO_PROCESS, 1234, 10)
+
+    @patch('os.setpriority')
+    def test_should_do_nothing_without_priority(self, mock_setpriority):
+        Priority().apply()
+        self.assertFalse(mock_setpriority.called)
+
+    @patch('platform.machine', MagicMock(return_value='x86_64'))
+    def test_should_parse_ionice(self):
+        self.assertEqual(Priority(ionice='idle').ioprio, 3 << 13)
+        self.assertEqual(Priority(ionice='best-effort:7').ioprio,
+                         2 << 13 | 7)
+        self.assertEqual(Priority(ionice='best-effort').ioprio, 2 << 13 | 4)
+        self.assertRaises(ValueError, Priority, ionice='lazy')
+        self.assertRaises(ValueError, Priority, ionice='realtime:8')